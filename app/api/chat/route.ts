@@ -5,11 +5,29 @@ import { StringOutputParser } from "@langchain/core/output_parsers";
 import { PromptTemplate } from "@langchain/core/prompts";
 import { RunnableBranch, RunnableLambda, RunnableMap, RunnableSequence } from "@langchain/core/runnables";
 import { AstraDBVectorStore, AstraLibArgs } from "@langchain/community/vectorstores/astradb";
+import { AstraDB } from "@datastax/astra-db-ts";
 
 import { StreamingTextResponse, Message } from "ai";
 
 const { ASTRA_DB_APPLICATION_TOKEN, ASTRA_DB_API_ENDPOINT, COHERE_API_KEY, OPENAI_API_KEY } = process.env;
 
+const astraDb = new AstraDB(ASTRA_DB_APPLICATION_TOKEN, ASTRA_DB_API_ENDPOINT);
+
+// The ingest pipeline rotates the embeddings collection, and records the one to search in the suggestions doc
+const embeddingCollection = async (): Promise<string> => {
+    try {
+        const suggestionsCollection = await astraDb.collection("article_suggestions");
+        const suggestionsDoc = await suggestionsCollection.findOne(
+            { _id: "recent_articles" },
+            { projection: { embedding_collection: 1 } },
+        );
+        return suggestionsDoc?.embedding_collection ?? "article_embeddings";
+    } catch (e) {
+        console.log("Error reading the embedding collection, using the default...");
+        return "article_embeddings";
+    }
+};
+
 interface ChainInput {
     chat_history: string;
     question: string;
@@ -89,7 +107,7 @@ export async function POST(req: Request) {
         const astraConfig: AstraLibArgs = {
             token: ASTRA_DB_APPLICATION_TOKEN,
             endpoint: ASTRA_DB_API_ENDPOINT,
-            collection: "article_embeddings",
+            collection: await embeddingCollection(),
             contentKey: "content",
             collectionOptions: {
                 vector: {
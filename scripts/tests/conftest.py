@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the wikichat package is in the scripts directory, so the tests can be run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
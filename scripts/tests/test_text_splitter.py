@@ -0,0 +1,180 @@
+"""
+Checks :class:`~wikichat.utils.text_splitter.RecursiveTextSplitter` makes the same chunks as LangChain's
+``RecursiveCharacterTextSplitter``, and that the chunk hashes do not change.
+
+The expected chunks and hashes are in fixtures/text_splitter_chunks.json, made with LangChain. When LangChain is
+installed the chunks are also compared with it directly. If the splitter is changed on purpose, regenerate the
+fixtures with LangChain installed, from the scripts directory:
+
+    python3 -m tests.test_text_splitter
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Callable, Optional
+
+import pytest
+
+from wikichat.utils.text_splitter import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    RecursiveTextSplitter,
+    chunk_and_hash,
+)
+
+_FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+_CHUNKS_FILE = os.path.join(_FIXTURES_DIR, "text_splitter_chunks.json")
+_ARTICLE_FILE = os.path.join(_FIXTURES_DIR, "article.txt")
+
+
+def _read_article() -> str:
+    with open(_ARTICLE_FILE, mode="r", encoding="utf-8") as file:
+        return file.read()
+
+
+# name, text, chunk_size, chunk_overlap
+_CASES: list[tuple[str, str, int, int]] = [
+    ("empty", "", CHUNK_SIZE, CHUNK_OVERLAP),
+    ("whitespace", "   \n\n  \t ", CHUNK_SIZE, CHUNK_OVERLAP),
+    ("short", "word", CHUNK_SIZE, CHUNK_OVERLAP),
+    ("one under chunk size", "x" * (CHUNK_SIZE - 1), CHUNK_SIZE, CHUNK_OVERLAP),
+    ("chunk size", "x" * CHUNK_SIZE, CHUNK_SIZE, CHUNK_OVERLAP),
+    ("no separators", "x" * (CHUNK_SIZE * 3 + 7), CHUNK_SIZE, CHUNK_OVERLAP),
+    ("words", " ".join(["y" * 50] * 100), CHUNK_SIZE, CHUNK_OVERLAP),
+    ("words longer than chunk", " ".join(["z" * 60] * 3), 50, 10),
+    ("paragraphs", "para one.\n\npara two.\nline two\n\n\n" * 40, 100, 20),
+    ("lines", "line of text\n" * 50, 64, 16),
+    ("tabs", "tab\tseparated\ttext " * 30, 40, 10),
+    ("no overlap", " ".join(f"w{i}" for i in range(300)), 60, 0),
+    ("overlap half", " ".join(f"w{i}" for i in range(300)), 60, 30),
+    ("overlap is chunk size", " ".join(f"w{i}" for i in range(100)), 30, 30),
+    ("unicode", "Überlandstraße café naïve 東京 " * 60, 70, 15),
+    ("article", _read_article(), CHUNK_SIZE, CHUNK_OVERLAP),
+    ("article small chunks", _read_article(), 256, 64),
+    ("article no overlap", _read_article(), 100, 0),
+]
+
+
+def _hash(chunk: str) -> str:
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+
+def _langchain_split_func(
+    chunk_size: int, chunk_overlap: int
+) -> Optional[Callable[[str], list[str]]]:
+    try:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+    except ImportError:
+        try:
+            from langchain.text_splitter import (  # type: ignore[no-redef]
+                RecursiveCharacterTextSplitter,
+            )
+        except ImportError:
+            return None
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=len
+    ).split_text
+
+
+def _expected() -> dict[str, Any]:
+    with open(_CHUNKS_FILE, mode="r", encoding="utf-8") as file:
+        return {case["name"]: case for case in json.load(file)["cases"]}
+
+
+_EXPECTED = _expected()
+_CASE_IDS = [name for name, _, _, _ in _CASES]
+
+
+def test_fixtures_cover_every_case():
+    assert sorted(_EXPECTED) == sorted(_CASE_IDS)
+
+
+@pytest.mark.parametrize("name,text,chunk_size,chunk_overlap", _CASES, ids=_CASE_IDS)
+def test_same_chunks_as_fixtures(
+    name: str, text: str, chunk_size: int, chunk_overlap: int
+):
+    expected = _EXPECTED[name]
+    assert (expected["chunk_size"], expected["chunk_overlap"]) == (
+        chunk_size,
+        chunk_overlap,
+    )
+    splitter = RecursiveTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    assert splitter.split_text(text) == [chunk["text"] for chunk in expected["chunks"]]
+
+
+@pytest.mark.parametrize("name,text,chunk_size,chunk_overlap", _CASES, ids=_CASE_IDS)
+def test_same_chunks_as_langchain(
+    name: str, text: str, chunk_size: int, chunk_overlap: int
+):
+    langchain_split = _langchain_split_func(chunk_size, chunk_overlap)
+    if langchain_split is None:
+        pytest.skip("LangChain is not installed, the fixtures are checked instead")
+    splitter = RecursiveTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    assert splitter.split_text(text) == langchain_split(text)
+
+
+@pytest.mark.parametrize("name,text,chunk_size,chunk_overlap", _CASES, ids=_CASE_IDS)
+def test_chunk_hashes_are_stable(
+    name: str, text: str, chunk_size: int, chunk_overlap: int
+):
+    # the hashes are the _id of the chunks in the db, if they change every chunk is stored again
+    [chunks] = chunk_and_hash([text], chunk_size, chunk_overlap)
+    assert chunks == [
+        (chunk["text"], chunk["hash"]) for chunk in _EXPECTED[name]["chunks"]
+    ]
+
+
+def test_chunks_are_within_chunk_size():
+    for name, text, chunk_size, chunk_overlap in _CASES:
+        splitter = RecursiveTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+        for chunk in splitter.split_text(text):
+            # a piece with no separator in it that is longer than the chunk size is kept whole
+            assert len(chunk) <= chunk_size or not any(
+                sep in chunk for sep in ("\n", " ")
+            ), name
+
+
+def test_chunk_and_hash_keeps_text_order():
+    long_text = " ".join(["word"] * CHUNK_SIZE)
+    results = chunk_and_hash(["first text", "", long_text], CHUNK_SIZE, CHUNK_OVERLAP)
+    assert results[0] == [("first text", _hash("first text"))]
+    assert results[1] == []
+    assert len(results[2]) > 1
+    assert results[2] == [
+        (chunk, _hash(chunk)) for chunk in RecursiveTextSplitter().split_text(long_text)
+    ]
+
+
+def test_overlap_larger_than_chunk_size_is_an_error():
+    with pytest.raises(ValueError):
+        RecursiveTextSplitter(chunk_size=10, chunk_overlap=11)
+
+
+def _write_fixtures() -> None:
+    cases = []
+    for name, text, chunk_size, chunk_overlap in _CASES:
+        langchain_split = _langchain_split_func(chunk_size, chunk_overlap)
+        if langchain_split is None:
+            raise SystemExit("LangChain is needed to make the fixtures")
+        cases.append(
+            {
+                "name": name,
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap,
+                "chunks": [
+                    {"text": chunk, "hash": _hash(chunk)}
+                    for chunk in langchain_split(text)
+                ],
+            }
+        )
+    with open(_CHUNKS_FILE, mode="w", encoding="utf-8") as file:
+        json.dump({"cases": cases}, file, indent=1, ensure_ascii=False)
+        file.write("\n")
+    print(f"Wrote {len(cases)} cases to {_CHUNKS_FILE}")
+
+
+if __name__ == "__main__":
+    _write_fixtures()
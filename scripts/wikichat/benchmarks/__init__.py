@@ -0,0 +1,7 @@
+"""
+Micro benchmarks for parts of the pipeline, they do not need the database or Cohere.
+
+Run them from the scripts/ directory, for example:
+
+    python3 -m wikichat.benchmarks.chunking --help
+"""
@@ -0,0 +1,143 @@
+"""
+Checks :class:`~wikichat.utils.text_splitter.RecursiveTextSplitter` makes the same chunks as LangChain's
+``RecursiveCharacterTextSplitter`` and compares how long they take.
+
+Uses a generated corpus of article like text and edge cases, or the text files passed with --file. The parity
+check needs LangChain to be installed, it is in requirements.txt. Exits with a non zero status if any chunks are
+different.
+
+    python3 -m wikichat.benchmarks.chunking
+    python3 -m wikichat.benchmarks.chunking --articles 500 --repeats 5
+"""
+
+import argparse
+import random
+import sys
+import time
+from typing import Callable
+
+from wikichat.utils.text_splitter import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    RecursiveTextSplitter,
+    chunk_and_hash,
+)
+
+EDGE_CASES = [
+    "",
+    " ",
+    "   \n\n  ",
+    "word",
+    "x" * (CHUNK_SIZE - 1),
+    "x" * CHUNK_SIZE,
+    "x" * (CHUNK_SIZE * 3 + 7),
+    " ".join(["y" * 50] * 100),
+    " ".join(["z" * (CHUNK_SIZE + 10)] * 3),
+    "para one.\n\npara two.\nline two\n\n\n" * 200,
+    "tab\tseparated\ttext " * 300,
+]
+
+
+def _generate_corpus(articles: int, seed: int) -> list[str]:
+    """Text that looks like a cleaned article, words and punctuation separated by single spaces"""
+    rnd = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocab = [
+        "".join(rnd.choice(letters) for _ in range(rnd.randint(1, 12)))
+        for _ in range(5000)
+    ]
+    corpus = []
+    for _ in range(articles):
+        words = rnd.randint(100, 20000)
+        corpus.append(" ".join(rnd.choice(vocab) for _ in range(words)))
+    return corpus
+
+
+def _langchain_split_func() -> Callable[[str], list[str]] | None:
+    try:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+    except ImportError:
+        try:
+            from langchain.text_splitter import (  # type: ignore[no-redef]
+                RecursiveCharacterTextSplitter,
+            )
+        except ImportError:
+            return None
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, length_function=len
+    )
+    return splitter.split_text
+
+
+def _time(func: Callable[[str], list[str]], texts: list[str], repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for text in texts:
+            func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--file", action="append", default=[], help="Text file to chunk, can repeat."
+    )
+    parser.add_argument(
+        "--articles", type=int, default=200, help="Number of articles to generate."
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=3, help="Times to run each, the best is used."
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    texts: list[str] = []
+    for path in args.file:
+        with open(path, mode="r") as file:
+            texts.append(file.read())
+    if not texts:
+        texts = _generate_corpus(args.articles, args.seed)
+    total_chars = sum(len(text) for text in texts)
+
+    splitter = RecursiveTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    langchain_split = _langchain_split_func()
+
+    if langchain_split is None:
+        print(
+            "LangChain is not installed, skipping parity check, tests/test_text_splitter.py checks the saved chunks"
+        )
+    else:
+        mismatches = 0
+        for i, text in enumerate(EDGE_CASES + texts):
+            if splitter.split_text(text) != langchain_split(text):
+                mismatches += 1
+                print(f"Chunks are different for text {i}: {text[:80]!r}...")
+        print(
+            f"Parity check: {len(EDGE_CASES) + len(texts)} texts, {mismatches} different"
+        )
+        if mismatches:
+            return 1
+
+    print(
+        f"Chunking {len(texts)} texts, {total_chars:,} characters, best of {args.repeats}"
+    )
+    results = {"wikichat": _time(splitter.split_text, texts, args.repeats)}
+    if langchain_split is not None:
+        results["langchain"] = _time(langchain_split, texts, args.repeats)
+    results["wikichat + sha256"] = _time(
+        lambda text: chunk_and_hash([text], CHUNK_SIZE, CHUNK_OVERLAP)[0],
+        texts,
+        args.repeats,
+    )
+    for name, secs in results.items():
+        mchars_per_sec = total_chars / secs / 1e6
+        print(f"    {name:20} {secs:8.3f} s {mchars_per_sec:8.2f} M chars/s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
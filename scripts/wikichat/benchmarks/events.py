@@ -0,0 +1,245 @@
+"""
+Compares decoding every event from the Wikipedia recent changes stream with the pre-filter in
+:mod:`wikichat.utils.events` that skips events for other wikis and namespaces before decoding them.
+
+Uses a recorded file of events passed with --file, one event data JSON per line, or generated events with a mix of
+wikis similar to the live stream. Record events from the live stream with --record, this needs a network
+connection. Exits with a non zero status if the pre-filter drops any event the listener would process, or the
+listener would count a different number of bot events.
+
+    python3 -m wikichat.benchmarks.events
+    python3 -m wikichat.benchmarks.events --record 5000 --file events.ndjson
+    python3 -m wikichat.benchmarks.events --file events.ndjson
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from typing import Any, Callable
+
+from wikichat.utils.events import (
+    JSON_BACKEND,
+    is_bot_event,
+    might_be_article_edit,
+    parse_event_data,
+)
+
+WIKIPEDIA_CHANGES_URL = "https://stream.wikimedia.org/v2/stream/recentchange"
+
+# rough share of the events on the stream for each wiki
+WIKI_WEIGHTS = {
+    "wikidatawiki": 45,
+    "commonswiki": 25,
+    "enwiki": 12,
+    "dewiki": 3,
+    "frwiki": 3,
+    "eswiki": 2,
+    "jawiki": 2,
+    "ruwiki": 2,
+    "itwiki": 2,
+    "zhwiki": 2,
+    "plwiki": 2,
+}
+
+
+def _generate_events(count: int, seed: int) -> list[str]:
+    """Event data shaped like the recentchange schema"""
+    rnd = random.Random(seed)
+    wikis = list(WIKI_WEIGHTS)
+    weights = list(WIKI_WEIGHTS.values())
+    events = []
+    for i in range(count):
+        wiki = rnd.choices(wikis, weights)[0]
+        domain = "canary" if rnd.random() < 0.001 else f"{wiki[:2]}.wikipedia.org"
+        title = f"Article {rnd.randint(1, 100000)}"
+        event = {
+            "$schema": "/mediawiki/recentchange/1.0.0",
+            "meta": {
+                "uri": f"https://{domain}/wiki/{title.replace(' ', '_')}",
+                "request_id": f"{rnd.getrandbits(64):016x}",
+                "id": f"{rnd.getrandbits(128):032x}",
+                "dt": "2024-01-01T00:00:00Z",
+                "domain": domain,
+                "stream": "mediawiki.recentchange",
+                "topic": "eqiad.mediawiki.recentchange",
+                "partition": 0,
+                "offset": i,
+            },
+            "id": rnd.randint(1, 2**31),
+            "type": rnd.choices(["edit", "new", "log", "categorize"], [70, 8, 7, 15])[
+                0
+            ],
+            "namespace": rnd.choices([0, 1, 2, 4, 6, 14], [60, 8, 10, 4, 10, 8])[0],
+            "title": title,
+            "title_url": f"https://{domain}/wiki/{title.replace(' ', '_')}",
+            "comment": " ".join(
+                rnd.choice(["fix", "typo", "add", "ref", "cite", "update", "revert"])
+                for _ in range(rnd.randint(1, 12))
+            ),
+            "timestamp": 1704067200 + i,
+            "user": f"User{rnd.randint(1, 5000)}",
+            "bot": rnd.random() < 0.3,
+            "minor": rnd.random() < 0.4,
+            "length": {"old": rnd.randint(0, 50000), "new": rnd.randint(0, 50000)},
+            "revision": {
+                "old": rnd.randint(1, 2**30),
+                "new": rnd.randint(1, 2**30),
+            },
+            "server_url": f"https://{domain}",
+            "server_name": domain,
+            "server_script_path": "/w",
+            "wiki": wiki,
+            "parsedcomment": "",
+        }
+        events.append(json.dumps(event, separators=(",", ":")))
+    return events
+
+
+def _is_processed(event_doc: Any) -> bool:
+    """True if listen_for_changes would process the event, or count it as a canary"""
+    match event_doc:
+        case {"meta": {"domain": "canary"}}:
+            return True
+        case {"bot": True}:
+            return False
+        case {"namespace": 0, "wiki": "enwiki", "type": "edit"}:
+            return True
+    return False
+
+
+def _is_bot(event_doc: Any) -> bool:
+    """True if listen_for_changes would count the decoded event as a bot event"""
+    match event_doc:
+        case {"meta": {"domain": "canary"}}:
+            return False
+        case {"bot": True}:
+            return True
+    return False
+
+
+def _decode_all(loads: Callable[[str], Any]) -> Callable[[list[str]], list[int]]:
+    def run(events: list[str]) -> list[int]:
+        return [i for i, data in enumerate(events) if _is_processed(loads(data))]
+
+    return run
+
+
+def _prefilter(loads: Callable[[str], Any]) -> Callable[[list[str]], list[int]]:
+    def run(events: list[str]) -> list[int]:
+        return [
+            i
+            for i, data in enumerate(events)
+            if might_be_article_edit(data) and _is_processed(loads(data))
+        ]
+
+    return run
+
+
+async def _record(path: str, count: int) -> None:
+    from aiohttp_sse_client2.client import EventSource  # type: ignore[import-untyped]
+
+    recorded = 0
+    with open(path, mode="w") as file:
+        async with EventSource(WIKIPEDIA_CHANGES_URL, timeout=None) as event_source:
+            async for event in event_source:
+                if event.type != "message" or not event.data:
+                    continue
+                file.write(event.data.replace("\n", " ") + "\n")
+                recorded += 1
+                if recorded >= count:
+                    break
+    print(f"Recorded {recorded} events to {path}")
+
+
+def _time(
+    func: Callable[[list[str]], list[int]], events: list[str], repeats: int
+) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(events)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--file", help="File of recorded events, one event data JSON per line."
+    )
+    parser.add_argument(
+        "--record",
+        type=int,
+        default=0,
+        help="Record this many events from the live stream to --file, then benchmark them.",
+    )
+    parser.add_argument(
+        "--events", type=int, default=100000, help="Number of events to generate."
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=3, help="Times to run each, the best is used."
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.record:
+        if not args.file:
+            parser.error("--record needs --file to record to")
+        asyncio.run(_record(args.file, args.record))
+
+    events: list[str]
+    if args.file:
+        with open(args.file, mode="r") as file:
+            events = [line.strip() for line in file if line.strip()]
+    else:
+        events = _generate_events(args.events, args.seed)
+
+    baseline = _decode_all(json.loads)
+    expected = baseline(events)
+    runs: dict[str, Callable[[list[str]], list[int]]] = {
+        "json, every event": baseline,
+        "pre-filter + json": _prefilter(json.loads),
+    }
+    if JSON_BACKEND != "json":
+        runs[f"{JSON_BACKEND}, every event"] = _decode_all(parse_event_data)
+        runs[f"pre-filter + {JSON_BACKEND}"] = _prefilter(parse_event_data)
+
+    for name, func in runs.items():
+        if func(events) != expected:
+            print(f"{name} processed different events to decoding every event")
+            return 1
+    bots = sum(1 for data in events if _is_bot(json.loads(data)))
+    prefiltered_bots = sum(
+        1
+        for data in events
+        if (
+            _is_bot(json.loads(data))
+            if might_be_article_edit(data)
+            else is_bot_event(data)
+        )
+    )
+    if prefiltered_bots != bots:
+        print(
+            f"The pre-filter counted {prefiltered_bots} bot events, decoding every event counted {bots}"
+        )
+        return 1
+    passed = sum(1 for data in events if might_be_article_edit(data))
+    print(
+        f"Checked {len(events)} events, {len(expected)} processed, {passed} passed the pre-filter, best of {args.repeats}"
+    )
+    if JSON_BACKEND == "json":
+        print("orjson is not installed, only timing the json module")
+
+    for name, func in runs.items():
+        secs = _time(func, events, args.repeats)
+        print(f"    {name:24} {secs:8.3f} s {len(events) / secs:12,.0f} events/s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
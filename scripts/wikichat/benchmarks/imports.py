@@ -0,0 +1,109 @@
+"""
+Measures how long the command line entry points take to import with ``python -X importtime``, and checks them
+against a budget so slow imports at startup are noticed.
+
+Each module is imported in a new interpreter, the time is the cumulative time ``-X importtime`` reports for it, which
+includes everything it imports. ``wikichat.cli`` is what ``--help`` imports, the database commands only need
+``wikichat.commands.database``, and the pipeline commands import everything.
+
+    python3 -m wikichat.benchmarks.imports
+    python3 -m wikichat.benchmarks.imports --repeats 5 --budget wikichat.cli=200
+
+Exits with a non zero status if a module takes longer than its budget.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# module to the most milliseconds it should take to import
+BUDGETS_MS: dict[str, int] = {
+    "wikichat.cli": 300,
+    "wikichat.commands.database": 400,
+    "wikichat.commands.pipeline": 1500,
+}
+
+# the directory the wikichat package is in, so the new interpreter can import it
+_SCRIPTS_DIR = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+
+def _import_times(module: str) -> dict[str, int]:
+    """Import the module in a new interpreter, returns the cumulative microseconds for each module it imported"""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=_SCRIPTS_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Error importing {module}:\n{completed.stderr}")
+
+    # lines are "import time: <self us> | <cumulative us> | <indented module name>"
+    times: dict[str, int] = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def _parse_budget(budget: str) -> tuple[str, int]:
+    module, sep, millis = budget.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(
+            f"Invalid budget '{budget}', expected <module>=<milliseconds>"
+        )
+    return module.strip(), int(millis)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--budget",
+        type=_parse_budget,
+        action="append",
+        default=[],
+        help="Budget for a module as <module>=<milliseconds>, can repeat. Adds the module if it has no budget.",
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=3, help="Times to import each, the best is used."
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=5,
+        help="Number of the slowest imports to show for a module that is over budget.",
+    )
+    args = parser.parse_args()
+
+    budgets = {**BUDGETS_MS, **dict(args.budget)}
+    print(f"Import times, best of {args.repeats}")
+    over_budget = 0
+    for module, budget_ms in budgets.items():
+        runs = [_import_times(module) for _ in range(args.repeats)]
+        best = min(runs, key=lambda times: times.get(module, 0))
+        took_ms = best.get(module, 0) / 1000
+        status = "ok" if took_ms <= budget_ms else "OVER BUDGET"
+        print(f"    {module:30} {took_ms:8.1f} ms  budget {budget_ms:5} ms  {status}")
+
+        if took_ms > budget_ms:
+            over_budget += 1
+            slowest = sorted(
+                (item for item in best.items() if item[0] != module),
+                key=lambda item: item[1],
+                reverse=True,
+            )
+            for name, micros in slowest[: args.top]:
+                print(f"        {name:40} {micros / 1000:8.1f} ms")
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
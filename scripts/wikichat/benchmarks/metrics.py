@@ -0,0 +1,98 @@
+"""
+Measures the cost of updating :data:`~wikichat.utils.metrics.METRICS` from the pipeline steps.
+
+Compares the lock free ``update_*`` methods with the same counters updated under an ``asyncio.Lock``, which is how
+they were updated before, and with plain attribute increments as a lower bound. Each is run by a number of
+concurrent tasks to show the effect of contention on the lock.
+
+    python3 -m wikichat.benchmarks.metrics
+    python3 -m wikichat.benchmarks.metrics --updates 200000 --tasks 20
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from typing import Awaitable, Callable
+
+from wikichat.utils.metrics import METRICS, Chunks
+
+
+class _LockedChunks:
+    """The chunk counters updated under a lock, as METRICS did before"""
+
+    def __init__(self):
+        self._chunks = Chunks()
+        self._async_lock = asyncio.Lock()
+
+    async def update_chunks(self, chunks_created: int = 0, chunk_diff_new: int = 0):
+        async with self._async_lock:
+            self._chunks.chunks_created += chunks_created
+            self._chunks.chunk_diff_new += chunk_diff_new
+
+
+async def _time_updates(
+    update: Callable[[], Awaitable[None]], updates: int, tasks: int
+) -> float:
+    per_task = updates // tasks
+
+    async def run():
+        for i in range(per_task):
+            await update()
+            if i % 100 == 0:
+                # let the other tasks run, like the steps do when they await IO
+                await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run() for _ in range(tasks)))
+    return time.perf_counter() - start
+
+
+async def _run(updates: int, tasks: int, repeats: int) -> None:
+    locked = _LockedChunks()
+    plain = Chunks()
+
+    async def lock_free_update():
+        await METRICS.update_chunks(chunks_created=1, chunk_diff_new=1)
+
+    async def locked_update():
+        await locked.update_chunks(chunks_created=1, chunk_diff_new=1)
+
+    async def plain_update():
+        plain.chunks_created += 1
+        plain.chunk_diff_new += 1
+
+    runs = {
+        "asyncio.Lock": locked_update,
+        "lock free (METRICS)": lock_free_update,
+        "plain increment": plain_update,
+    }
+    print(f"{updates:,} updates from {tasks} tasks, best of {repeats}")
+    for name, update in runs.items():
+        best = min(
+            [await _time_updates(update, updates, tasks) for _ in range(repeats)]
+        )
+        print(f"    {name:22} {best:8.3f} s {best / updates * 1e9:8.0f} ns/update")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--updates", type=int, default=500000, help="Number of updates to time."
+    )
+    parser.add_argument(
+        "--tasks", type=int, default=10, help="Number of tasks making the updates."
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=3, help="Times to run each, the best is used."
+    )
+    args = parser.parse_args()
+
+    asyncio.run(_run(args.updates, args.tasks, args.repeats))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
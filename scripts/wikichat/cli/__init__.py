@@ -60,32 +60,118 @@ class PipelineCommand(CliCommand):
     async def _run_func(
         self, command_func: Callable, command_args: model.CommonPipelineArgs
     ):
+        from wikichat.utils import cpu, prometheus
         from wikichat.utils.pipeline import AsyncPipeline
         from wikichat import processing
         from wikichat import database
-
+        from wikichat.processing import (
+            articles,
+            chunk_hash_cache,
+            embeddings,
+            retention,
+            suggestions,
+            wikipedia,
+        )
+        from wikichat.processing.model import RECENT_ARTICLES
+
+        await database.create_collections()
+        # a saved cache is out of date if we truncate the collections, opening the cache deletes the saved file so
+        # it is not loaded by a later run if this one is killed
+        chunk_hash_cache.open_cache(
+            command_args.chunk_hash_cache_max_entries,
+            database.METADATA_COLLECTION.name,
+            path=command_args.chunk_hash_cache_file or None,
+            load_saved=not command_args.truncate_first,
+        )
         if command_args.truncate_first:
             await database.truncate_all_collections()
+        # so the suggestions doc points the chat app at the collections we write to
+        RECENT_ARTICLES.embedding_collection = database.EMBEDDINGS_COLLECTION.name
+        await database.drop_stale_collections_later()
 
-        pipeline: AsyncPipeline = processing.create_pipeline(
-            max_items=command_args.max_articles,
-            rotate_collection_every=command_args.rotate_collections_every,
+        await wikipedia.open_session(
+            connections_per_host=command_args.http_connections_per_host,
+            revalidation_cache_size=command_args.revalidation_cache_size,
         )
-        metrics_task = asyncio.create_task(METRICS.metrics_reporter_task(pipeline))
+        if command_args.cpu_workers > 0:
+            cpu.start_pool(command_args.cpu_workers)
+        if command_args.embedding_cache_file:
+            embeddings.open_cache(
+                command_args.embedding_cache_file,
+                command_args.embedding_cache_max_entries,
+            )
+        try:
+            pipeline: AsyncPipeline = processing.create_pipeline(
+                max_items=command_args.max_articles,
+                rotate_collection_every=command_args.rotate_collections_every,
+                rotate_switch_after=command_args.rotate_switch_after,
+                queue_size=command_args.queue_size,
+                step_queue_sizes=command_args._step_queue_sizes,
+                chunk_batch_size=command_args.chunk_batch_size,
+                chunk_max_wait_ms=command_args.chunk_max_wait_ms,
+                diff_batch_size=command_args.diff_batch_size,
+                diff_max_wait_ms=command_args.diff_max_wait_ms,
+                embed_batch_size=command_args.embed_batch_size,
+                embed_max_wait_ms=command_args.embed_max_wait_ms,
+                store_batch_size=command_args.store_batch_size,
+                store_max_in_flight=command_args.store_max_in_flight,
+            )
+            if command_args.store_coalesce_ms > 0:
+                articles.start_embedding_writer(command_args.store_coalesce_ms)
+            if command_args.suggestions_flush_secs > 0:
+                suggestions.start_writer(command_args.suggestions_flush_secs)
+            if (
+                command_args.retain_max_chunks > 0
+                or command_args.retain_max_age_hours > 0
+            ):
+                retention.start_sweeper(
+                    max_chunks=command_args.retain_max_chunks,
+                    max_age_secs=command_args.retain_max_age_hours * 3600,
+                    sweep_interval_secs=command_args.retention_sweep_secs,
+                    batch_size=command_args.retention_batch_size,
+                )
+            if command_args.metrics_port > 0:
+                await prometheus.start_server(
+                    pipeline, command_args.metrics_port, command_args.metrics_host
+                )
+            metrics_task = asyncio.create_task(METRICS.metrics_reporter_task(pipeline))
+
+            logging.info("Starting...")
+            await command_func(pipeline, command_args)
+
+            await pipeline.join_all_steps()
+            await pipeline.cancel_and_gather()
+
+            metrics_task.cancel()
+            try:
+                logging.debug("Waiting for metrics task to finish")
+                await metrics_task
+            except asyncio.CancelledError:
+                logging.debug("Metrics task cancelled")
+        finally:
+            await prometheus.stop_server()
+            await retention.stop_sweeper()
+            await articles.stop_embedding_writer()
+            await suggestions.stop_writer()
+            await wikipedia.close_session()
+            cpu.stop_pool()
+            embeddings.close_cache()
+            chunk_hash_cache.close_cache()
+            await database.wait_for_dropped_collections()
+        return
 
-        logging.info("Starting...")
-        await command_func(pipeline, command_args)
 
-        await pipeline.join_all_steps()
-        await pipeline.cancel_and_gather()
+@dataclass
+class BenchCommand(PipelineCommand):
+    async def _run_func(
+        self, command_func: Callable, command_args: model.CommonPipelineArgs
+    ):
+        from wikichat.commands import bench
 
-        metrics_task.cancel()
-        try:
-            logging.debug("Waiting for metrics task to finish")
-            await metrics_task
-        except asyncio.CancelledError:
-            logging.debug("Metrics task cancelled")
-        return
+        assert isinstance(command_args, model.BenchArgs)
+        # the stand-ins must be in place before the pipeline uses the database
+        async with bench.local_services(command_args):
+            return await super()._run_func(command_func, command_args)
 
 
 # ======================================================================================================================
@@ -111,6 +197,12 @@ def _load_and_listen() -> Callable:
     return pipeline.load_and_listen
 
 
+def _run_bench() -> Callable:
+    from wikichat.commands import bench
+
+    return bench.run_bench
+
+
 def _embed_and_search() -> Callable:
     from wikichat.commands import database
 
@@ -153,6 +245,12 @@ ALL_COMMANDS: list[CliCommand] = [
         func_supplier=_load_and_listen,
         args_cls=model.LoadPipelineArgs,
     ),
+    BenchCommand(
+        name="bench",
+        help="Benchmark the pipeline using local stand-ins for Wikipedia, Cohere and Astra DB",
+        func_supplier=_run_bench,
+        args_cls=model.BenchArgs,
+    ),
     CliCommand(
         name="embed-and-search",
         help="Embed a question and search the database for similar articles",
@@ -188,6 +286,18 @@ def _add_command_args(args_cls, parser: ArgumentParser) -> ArgumentParser:
                 if arg_field.default_factory is not MISSING
                 else arg_field.default
             )
+            if arg_field.type is bool:
+                # bool("false") is True, so parse the value ourselves, and allow the flag on its own
+                parser.add_argument(
+                    f"--{arg_field.name}",
+                    type=_parse_bool,
+                    nargs="?",
+                    const=True,
+                    required=False,
+                    default=default,
+                    help=arg_field.metadata.get("help", ""),
+                )
+                continue
             parser.add_argument(
                 f"--{arg_field.name}",
                 type=arg_field.type,
@@ -204,6 +314,15 @@ def _add_command_args(args_cls, parser: ArgumentParser) -> ArgumentParser:
     return parser
 
 
+def _parse_bool(value: str) -> bool:
+    match value.strip().lower():
+        case "true" | "yes" | "1":
+            return True
+        case "false" | "no" | "0":
+            return False
+    raise argparse.ArgumentTypeError(f"Expected true or false, got '{value}'")
+
+
 def config_arg_parse():
     # Create the top-level parser
     parser = ArgumentParser(
@@ -0,0 +1,508 @@
+"""
+Benchmark for the whole ingest pipeline, using local stand-ins for Wikipedia, Cohere and Astra DB.
+
+The bench command runs the real pipeline from :func:`~wikichat.processing.create_pipeline` with the same options
+as the load command, so changes to the pipeline settings can be measured without calling the real services.
+:func:`local_services` puts the stand-ins in place before the pipeline is created:
+
+* An HTTP server on localhost serving article HTML, either recorded pages from ``--html_dir`` or generated pages.
+* A Cohere client whose ``embed`` waits for the configured latency and returns random vectors.
+* Collections that keep the documents in memory, wait for the configured latency and fail a fraction of requests
+  with an API style error. Or with ``--local_database_file`` the SQLite collections from
+  :mod:`wikichat.utils.local_collection`, to include their cost.
+
+The stand-ins run on the same event loop as the pipeline, so they use some of the CPU the pipeline would have.
+
+:func:`run_bench` puts the articles to the pipeline, waits for it to finish and prints the results as JSON.
+"""
+
+import asyncio
+import contextlib
+import glob
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable, Optional
+
+from aiohttp import web
+
+from wikichat.commands.model import BenchArgs
+from wikichat.processing.model import ArticleMetadata
+from wikichat.utils.histogram import percentile
+from wikichat.utils.errors import DuplicateDocumentsError
+from wikichat.utils.metrics import METRICS
+from wikichat.utils.pipeline import AsyncPipeline
+
+# the real pages say their canonical url is on en.wikipedia.org, which the parser would treat as a redirect
+_PATTERN_CANONICAL_LINK = re.compile(
+    rb"<link[^>]*rel=\"canonical\"[^>]*>", re.IGNORECASE
+)
+
+# the same size as the Cohere model used by wikichat.processing.embeddings
+_VECTOR_DIMENSION = 1024
+# the fake embed returns one of these for each text, so making the vectors does not slow the benchmark
+_VECTOR_POOL_SIZE = 256
+
+# the comparisons the bench collections support in a filter on one field, missing fields never compare
+_COMPARISONS: dict[str, Callable[[Any, Any], bool]] = {
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$gte": lambda value, arg: value is not None and value >= arg,
+    "$exists": lambda value, arg: (value is not None) == bool(arg),
+}
+
+# set by local_services()
+_WIKIPEDIA: Optional["_LocalWikipedia"] = None
+_COHERE_CLIENT: Optional["_LocalCohereClient"] = None
+
+
+def _sleep_secs(rnd: random.Random, latency_ms: float, jitter_ms: float) -> float:
+    return max(0.0, latency_ms + rnd.uniform(-jitter_ms, jitter_ms)) / 1000
+
+
+class _LocalWikipedia:
+    """HTTP server for article pages, the page for an article is picked from the url so each url has the same page"""
+
+    def __init__(
+        self, pages: list[bytes], latency_ms: float, jitter_ms: float, seed: int
+    ):
+        self._pages = pages
+        self._latency_ms = latency_ms
+        self._jitter_ms = jitter_ms
+        self._rnd = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url: str = ""
+        self.requests: int = 0
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/wiki/{title}", self._handle_page)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host="127.0.0.1", port=0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+        logging.info(
+            f"Serving {len(self._pages)} article pages on {self.base_url}/wiki/"
+        )
+
+    async def stop(self) -> None:
+        if self._runner is None:
+            return
+        runner, self._runner = self._runner, None
+        await runner.cleanup()
+
+    def metadata(self, article_number: int) -> ArticleMetadata:
+        title = f"Bench_{article_number}"
+        return ArticleMetadata(url=f"{self.base_url}/wiki/{title}", title=title)
+
+    async def _handle_page(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(_sleep_secs(self._rnd, self._latency_ms, self._jitter_ms))
+        _, _, number = request.match_info["title"].rpartition("_")
+        if not number.isdigit():
+            raise web.HTTPNotFound()
+        return web.Response(
+            body=self._pages[int(number) % len(self._pages)],
+            content_type="text/html",
+            charset="utf-8",
+        )
+
+
+def _load_pages(html_dir: str) -> list[bytes]:
+    pages: list[bytes] = []
+    for path in sorted(glob.glob(os.path.join(html_dir, "*.htm*"))):
+        with open(path, mode="rb") as file:
+            pages.append(_PATTERN_CANONICAL_LINK.sub(b"", file.read()))
+    if not pages:
+        raise ValueError(f"No .html files found in {html_dir}")
+    return pages
+
+
+def _generate_pages(count: int, seed: int) -> list[bytes]:
+    """Pages shaped like a Wikipedia article, headings and paragraphs of random words in the content element"""
+    rnd = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocab = [
+        "".join(rnd.choice(letters) for _ in range(rnd.randint(1, 12)))
+        for _ in range(5000)
+    ]
+    pages: list[bytes] = []
+    for page_number in range(count):
+        sections: list[str] = []
+        for section in range(rnd.randint(2, 15)):
+            sections.append(f"<h2>Section {section}</h2>")
+            for _ in range(rnd.randint(1, 8)):
+                words = " ".join(rnd.choice(vocab) for _ in range(rnd.randint(20, 200)))
+                sections.append(f"<p>{words}</p>")
+        pages.append(
+            (
+                f"<html><head><title>Page {page_number}</title></head><body>"
+                f'<h1 id="firstHeading">Page {page_number}</h1>'
+                f'<div id="mw-content-text">{"".join(sections)}</div>'
+                "</body></html>"
+            ).encode("utf-8")
+        )
+    return pages
+
+
+class _LocalCohereClient:
+    """Stands in for the cohere.AsyncClient, only has the embed() call used by wikichat.processing.embeddings"""
+
+    def __init__(self, latency_ms: float, jitter_ms: float, seed: int):
+        self._latency_ms = latency_ms
+        self._jitter_ms = jitter_ms
+        self._rnd = random.Random(seed)
+        self._vectors: list[list[float]] = [
+            [self._rnd.uniform(-1, 1) for _ in range(_VECTOR_DIMENSION)]
+            for _ in range(_VECTOR_POOL_SIZE)
+        ]
+        self.requests: int = 0
+        self.texts: int = 0
+
+    async def embed(self, texts: list[str], **kwargs) -> Any:
+        self.requests += 1
+        self.texts += len(texts)
+        await asyncio.sleep(_sleep_secs(self._rnd, self._latency_ms, self._jitter_ms))
+        return SimpleNamespace(
+            embeddings=SimpleNamespace(
+                float=[self._vectors[hash(text) % _VECTOR_POOL_SIZE] for text in texts]
+            )
+        )
+
+
+class _LocalCursor:
+    """Like the astrapy AsyncCursor the request is made when the cursor is read"""
+
+    def __init__(self, collection: "_LocalCollection", docs: list[dict[str, Any]]):
+        self._collection = collection
+        self._docs = docs
+
+    async def to_list(self) -> list[dict[str, Any]]:
+        await self._collection._request()
+        return self._docs
+
+    async def __aiter__(self) -> AsyncIterator[dict[str, Any]]:
+        for doc in await self.to_list():
+            yield doc
+
+
+class _LocalCollection:
+    """Keeps the documents in memory, with only the AsyncCollection methods and filters the pipeline uses.
+
+    Every request waits for the latency, then fails with probability error_rate. The error is a ValueError with
+    an API error code in it, so the pipeline counts it like an error from the Data API. Inserting a document whose
+    _id already exists keeps the existing document and raises a DuplicateDocumentsError, like the local database.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        latency_ms: float,
+        jitter_ms: float,
+        error_rate: float,
+        seed: int,
+    ):
+        self.name = name
+        self._latency_ms = latency_ms
+        self._jitter_ms = jitter_ms
+        self._error_rate = error_rate
+        self._rnd = random.Random(seed)
+        self._docs: dict[str, dict[str, Any]] = {}
+        self.requests: int = 0
+        self.errors: int = 0
+
+    async def _request(self) -> None:
+        self.requests += 1
+        await asyncio.sleep(_sleep_secs(self._rnd, self._latency_ms, self._jitter_ms))
+        if self._rnd.random() < self._error_rate:
+            self.errors += 1
+            raise ValueError(
+                json.dumps(
+                    [
+                        {
+                            "message": f"Error injected by the bench command into {self.name}",
+                            "errorCode": "BENCH_INJECTED_ERROR",
+                        }
+                    ]
+                )
+            )
+
+    def _matching_ids(self, filter: dict[str, Any]) -> list[str]:
+        if not filter:
+            return list(self._docs)
+        match filter.get("_id"):
+            case {"$in": ids}:
+                return [doc_id for doc_id in ids if doc_id in self._docs]
+            case str(doc_id):
+                return [doc_id] if doc_id in self._docs else []
+        match list(filter.items()):
+            case [
+                (str(field), dict(conditions))
+            ] if conditions.keys() <= _COMPARISONS.keys():
+                return [
+                    doc_id
+                    for doc_id, doc in self._docs.items()
+                    if all(
+                        _COMPARISONS[operator](doc.get(field), arg)
+                        for operator, arg in conditions.items()
+                    )
+                ]
+        raise ValueError(f"Filter not supported by the bench collections: {filter}")
+
+    async def insert_many(self, documents: list[dict[str, Any]], **kwargs) -> None:
+        await self._request()
+        inserted_ids: list[Any] = []
+        duplicate_ids: list[Any] = []
+        for doc in documents:
+            if doc["_id"] in self._docs:
+                duplicate_ids.append(doc["_id"])
+            else:
+                self._docs[doc["_id"]] = doc
+                inserted_ids.append(doc["_id"])
+        if duplicate_ids:
+            raise DuplicateDocumentsError(inserted_ids, duplicate_ids)
+
+    async def delete_many(self, filter: dict[str, Any], **kwargs) -> None:
+        await self._request()
+        for doc_id in self._matching_ids(filter):
+            del self._docs[doc_id]
+
+    async def find_one_and_replace(
+        self,
+        filter: dict[str, Any],
+        replacement: dict[str, Any],
+        upsert: bool = False,
+        **kwargs,
+    ) -> Optional[dict[str, Any]]:
+        await self._request()
+        matching_ids = self._matching_ids(filter)
+        if not matching_ids and not upsert:
+            return None
+        doc_id = matching_ids[0] if matching_ids else filter["_id"]
+        previous = self._docs.get(doc_id)
+        self._docs[doc_id] = {**replacement, "_id": doc_id}
+        return previous
+
+    def find(
+        self,
+        filter: Optional[dict[str, Any]] = None,
+        sort: Optional[dict[str, Any]] = None,
+        limit: int = 0,
+        **kwargs,
+    ) -> _LocalCursor:
+        docs = [dict(self._docs[doc_id]) for doc_id in self._matching_ids(filter or {})]
+        for field, direction in (sort or {}).items():
+            docs.sort(key=lambda doc: doc.get(field) or 0, reverse=direction < 0)
+        return _LocalCursor(self, docs[:limit] if limit else docs)
+
+    async def find_one(
+        self, filter: Optional[dict[str, Any]] = None, **kwargs
+    ) -> Optional[dict[str, Any]]:
+        docs = await self.find(filter, limit=1).to_list()
+        return docs[0] if docs else None
+
+    async def estimated_document_count(self, **kwargs) -> int:
+        await self._request()
+        return len(self._docs)
+
+    async def drop(self) -> None:
+        await self._request()
+        self._docs.clear()
+
+
+@dataclass
+class _QueueSampler:
+    """Samples the depth of the step queues while the benchmark runs"""
+
+    pipeline: AsyncPipeline
+    interval_secs: float
+    samples: int = 0
+    depth_sums: dict[str, int] = field(default_factory=dict)
+    depth_max: dict[str, int] = field(default_factory=dict)
+
+    async def run(self) -> None:
+        while True:
+            for step_name, depth in self.pipeline.queue_depths().items():
+                self.depth_sums[step_name] = self.depth_sums.get(step_name, 0) + depth
+                self.depth_max[step_name] = max(self.depth_max.get(step_name, 0), depth)
+            self.samples += 1
+            await asyncio.sleep(self.interval_secs)
+
+    def depth_mean(self) -> dict[str, float]:
+        return {
+            step_name: round(total / max(1, self.samples), 2)
+            for step_name, total in self.depth_sums.items()
+        }
+
+
+@contextlib.asynccontextmanager
+async def local_services(args: BenchArgs) -> AsyncIterator[None]:
+    """Put the stand-ins for Wikipedia, Cohere and Astra DB in place for run_bench()
+
+    Must be entered before the pipeline is created, the collections can only be replaced before they are used.
+    """
+    global _WIKIPEDIA, _COHERE_CLIENT
+    from wikichat import database
+    from wikichat.processing import embeddings
+
+    pages = (
+        _load_pages(args.html_dir)
+        if args.html_dir
+        else _generate_pages(args.generated_pages, args.seed)
+    )
+    wikipedia = _LocalWikipedia(
+        pages, args.wiki_latency_ms, args.wiki_jitter_ms, args.seed
+    )
+    if args.local_database_file:
+        # imported here as it imports NumPy, which the in-memory collections do not need
+        from wikichat.utils.local_collection import LocalDatabase
+
+        local_database = LocalDatabase(args.local_database_file)
+        database.use_collections(local_database.get_collection)
+    else:
+        collection_seeds = itertools.count(args.seed)
+        database.use_collections(
+            lambda name: _LocalCollection(
+                name,
+                args.db_latency_ms,
+                args.db_jitter_ms,
+                args.db_error_rate,
+                next(collection_seeds),
+            )
+        )
+    cohere_client = _LocalCohereClient(
+        args.embed_latency_ms, args.embed_jitter_ms, args.seed
+    )
+    embeddings.use_client(cohere_client)
+    await wikipedia.start()
+    _WIKIPEDIA, _COHERE_CLIENT = wikipedia, cohere_client
+    try:
+        yield
+    finally:
+        _WIKIPEDIA, _COHERE_CLIENT = None, None
+        await wikipedia.stop()
+        embeddings.use_client(None)
+
+
+async def run_bench(pipeline: AsyncPipeline, args: BenchArgs) -> None:
+    """Put max_articles articles to the pipeline, wait for them to finish and print the results as JSON"""
+    from wikichat import database
+
+    wikipedia, cohere_client = _WIKIPEDIA, _COHERE_CLIENT
+    if wikipedia is None or cohere_client is None:
+        raise Exception("Local services not started, see local_services()")
+
+    if args.trace_memory:
+        tracemalloc.start()
+    sampler = _QueueSampler(pipeline, args.sample_ms / 1000)
+    sampler_task = asyncio.create_task(sampler.run())
+
+    logging.info(f"Starting benchmark with {args.max_articles} articles")
+    start_secs = time.perf_counter()
+    for article_number in range(args.max_articles):
+        if not await pipeline.put_to_first_step(wikipedia.metadata(article_number)):
+            break
+    await pipeline.join_all_steps()
+    elapsed_secs = time.perf_counter() - start_secs
+
+    sampler_task.cancel()
+    try:
+        await sampler_task
+    except asyncio.CancelledError:
+        pass
+    tracemalloc_peak: Optional[int] = None
+    if args.trace_memory:
+        _, tracemalloc_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    snapshot = await METRICS.snapshot()
+    results: dict[str, Any] = {
+        "git_commit": _git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "elapsed_secs": round(elapsed_secs, 3),
+        "articles": args.max_articles,
+        "articles_stored": snapshot.database.articles_inserted,
+        "articles_per_sec": round(
+            snapshot.database.articles_inserted / elapsed_secs, 2
+        ),
+        "chunks_created": snapshot.chunks.chunks_created,
+        "chunks_inserted": snapshot.database.chunks_inserted,
+        "chunks_per_sec": round(snapshot.database.chunks_inserted / elapsed_secs, 2),
+        "errors": snapshot.error_by_code,
+        "queue_depth_mean": sampler.depth_mean(),
+        "queue_depth_max": sampler.depth_max,
+        "queue_high_water": pipeline.queue_high_water_marks(),
+        "step_latency_ms": {
+            step.name: {
+                f"{kind}_p{int(fraction * 100)}": _millis(
+                    percentile(histogram.snapshot(), fraction)
+                )
+                for kind, histogram in (
+                    ("wait", step.wait_histogram),
+                    ("service", step.service_histogram),
+                )
+                for fraction in (0.5, 0.99)
+            }
+            for step in pipeline.steps
+        },
+        "memory_mb": {
+            "max_rss": _max_rss_mb(),
+            "tracemalloc_peak": None
+            if tracemalloc_peak is None
+            else round(tracemalloc_peak / 1024 / 1024, 1),
+        },
+        "requests": {
+            "wikipedia": wikipedia.requests,
+            "cohere": cohere_client.requests,
+            **{
+                # not counted when using the local database
+                name: getattr(collection, "requests", None)
+                for name, collection in database._HANDLES.items()
+            },
+        },
+        "args": args.to_dict(),  # type: ignore[attr-defined]
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.results_file:
+        # one line per run so the results from different commits can be compared
+        with open(args.results_file, mode="a") as file:
+            file.write(json.dumps(results) + "\n")
+        logging.info(f"Appended benchmark results to {args.results_file}")
+
+
+def _millis(secs: Optional[float]) -> Optional[float]:
+    return None if secs is None else round(secs * 1000, 2)
+
+
+def _max_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return round(max_rss / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
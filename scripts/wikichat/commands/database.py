@@ -10,7 +10,6 @@ import logging
 
 from wikichat import database
 from wikichat.commands.model import EmbedAndSearchArgs, SuggestedSearchArgs
-from wikichat.database import EMBEDDINGS_COLLECTION, SUGGESTIONS_COLLECTION
 from wikichat.processing import embeddings
 from wikichat.processing.model import RecentArticles
 
@@ -42,7 +41,8 @@ async def embed_and_search(args: EmbedAndSearchArgs) -> None:
 
     limit = args.limit or 5
     filter = args._filter or {}
-    resp = EMBEDDINGS_COLLECTION.find(
+    await database.use_searched_collections()
+    resp = database.EMBEDDINGS_COLLECTION.find(
         filter,
         sort={"$vector": question_vector},
         projection={"title": 1, "url": 1, "content": 1},
@@ -60,7 +60,7 @@ async def embed_and_search(args: EmbedAndSearchArgs) -> None:
 async def suggested_search(args: SuggestedSearchArgs) -> None:
     count = 1
     while args.repeats == 0 or (args.repeats != 0 and count <= args.repeats):
-        resp_list = await SUGGESTIONS_COLLECTION.find(
+        resp_list = await database.SUGGESTIONS_COLLECTION.find(
             filter={"_id": "recent_articles"},
             limit=1,
         ).to_list()
@@ -72,7 +72,9 @@ async def suggested_search(args: SuggestedSearchArgs) -> None:
         )
         question_vector: list[float] = question_vectors[0]
 
-        resp = EMBEDDINGS_COLLECTION.find(
+        # search the same collection as the chat app, it changes when the pipeline rotates the collections
+        await database.use_searched_collections()
+        resp = database.EMBEDDINGS_COLLECTION.find(
             sort={"$vector": question_vector},
             projection={"title": 1, "url": 1, "content": 1},
             limit=args.limit,
@@ -6,12 +6,19 @@ load other parts of the wikichat application.
 """
 
 import json
+import os
 
 from typing import Any
 from dataclasses import dataclass, field
 
 from dataclasses_json import dataclass_json
 
+# the caches and checkpoints default to the scripts/cache directory wherever the scripts are run from
+_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "cache",
+)
+
 
 # ======================================================================================================================
 # pipeline commands
@@ -34,12 +41,224 @@ class CommonPipelineArgs:
     )
 
     rotate_collections_every: int = field(
+        default=0,
+        metadata={
+            "help": "Rotate the database collection every N chunks, 0 to disable. Disables --retain_max_chunks and --retain_max_age_hours."
+        },
+    )
+
+    rotate_switch_after: int = field(
+        default=-1,
+        metadata={
+            "help": "After rotating, switch the chat app to the new collections once N chunks are in them and drop the old collections, -1 for half of --rotate_collections_every."
+        },
+    )
+
+    retain_max_chunks: int = field(
         default=100000,
         metadata={
-            "help": "Rotate the database collection every N chunks, 0 to disable."
+            "help": "Delete the articles stored longest ago to keep the database under N chunks, 0 to disable."
+        },
+    )
+
+    retain_max_age_hours: float = field(
+        default=0,
+        metadata={
+            "help": "Delete the articles that have not been stored for N hours, 0 to disable."
+        },
+    )
+
+    retention_sweep_secs: float = field(
+        default=60.0,
+        metadata={
+            "help": "Seconds between deleting the oldest articles when --retain_max_chunks or --retain_max_age_hours is set."
+        },
+    )
+
+    retention_batch_size: int = field(
+        default=20,
+        metadata={"help": "Number of articles to delete at a time for retention."},
+    )
+
+    queue_size: int = field(
+        default=100,
+        metadata={
+            "help": "Maximum number of items waiting in each pipeline step queue, 0 for unbounded."
+        },
+    )
+
+    step_queue_sizes: str = field(
+        default="",
+        metadata={
+            "help": "Per step queue sizes that override --queue_size, e.g. 'load_article=500,vectorize_diffs=20'."
+        },
+    )
+    http_connections_per_host: int = field(
+        default=20,
+        metadata={
+            "help": "Maximum number of open connections to each host when scraping articles."
+        },
+    )
+
+    chunk_batch_size: int = field(
+        default=10,
+        metadata={
+            "help": "Maximum number of articles to chunk in one call to the CPU pool."
+        },
+    )
+
+    chunk_max_wait_ms: int = field(
+        default=20,
+        metadata={
+            "help": "Maximum time to wait for more articles to fill a batch to chunk."
+        },
+    )
+
+    diff_batch_size: int = field(
+        default=20,
+        metadata={
+            "help": "Maximum number of articles to read the previous metadata for in one database request."
         },
     )
 
+    diff_max_wait_ms: int = field(
+        default=20,
+        metadata={
+            "help": "Maximum time to wait for more articles to fill a batch of metadata reads."
+        },
+    )
+
+    embed_batch_size: int = field(
+        default=96,
+        metadata={
+            "help": "Maximum number of new chunks, from one or more articles, to send to Cohere in one call."
+        },
+    )
+
+    embed_max_wait_ms: int = field(
+        default=50,
+        metadata={
+            "help": "Maximum time to wait for more articles to fill a batch of chunks to embed."
+        },
+    )
+
+    edit_quiet_secs: float = field(
+        default=10.0,
+        metadata={
+            "help": "When listening, hold an edited article until it has not been edited for N seconds so a burst of edits is processed once. 0 to process every edit."
+        },
+    )
+
+    edit_max_hold_secs: float = field(
+        default=60.0,
+        metadata={
+            "help": "When listening, the longest to hold an article that keeps being edited before processing it."
+        },
+    )
+
+    listen_checkpoint_file: str = field(
+        default=os.path.join(_CACHE_DIR, "listen_checkpoint.json"),
+        metadata={
+            "help": "File to save where we are in the Wikipedia changes stream, so listening resumes from there after a restart. Empty to always listen from now."
+        },
+    )
+
+    revalidation_cache_size: int = field(
+        default=10000,
+        metadata={
+            "help": "Number of pages to remember the ETag and revision for, to skip fetching unchanged articles. 0 to disable."
+        },
+    )
+
+    metrics_port: int = field(
+        default=0,
+        metadata={
+            "help": "Serve the metrics for Prometheus on http://<metrics_host>:<port>/metrics, 0 to disable."
+        },
+    )
+
+    metrics_host: str = field(
+        default="127.0.0.1",
+        metadata={
+            "help": "Address to serve the metrics for Prometheus on, 0.0.0.0 to serve them to other hosts."
+        },
+    )
+
+    cpu_workers: int = field(
+        default=2,
+        metadata={
+            "help": "Number of processes used to parse and chunk articles, 0 to do it on the event loop."
+        },
+    )
+
+    embedding_cache_file: str = field(
+        default=os.path.join(_CACHE_DIR, "embeddings.sqlite"),
+        metadata={
+            "help": "SQLite file to cache embeddings in so we do not embed the same chunk twice, empty to disable."
+        },
+    )
+
+    embedding_cache_max_entries: int = field(
+        default=50000,
+        metadata={
+            "help": "Maximum number of embeddings to cache, each uses about 8KB on disk."
+        },
+    )
+
+    store_batch_size: int = field(
+        default=20,
+        metadata={
+            "help": "Number of chunks to insert or delete in each database request."
+        },
+    )
+
+    store_max_in_flight: int = field(
+        default=4,
+        metadata={
+            "help": "Maximum number of insert or delete requests in flight at once for an article, or for all articles when coalescing inserts."
+        },
+    )
+
+    store_coalesce_ms: int = field(
+        default=100,
+        metadata={
+            "help": "Maximum time to wait for chunks from other articles to fill an insert batch, 0 to insert each article on its own."
+        },
+    )
+
+    suggestions_flush_secs: float = field(
+        default=5.0,
+        metadata={
+            "help": "Write the recent articles used for suggestions at most once every N seconds, 0 to write for every article."
+        },
+    )
+
+    chunk_hash_cache_max_entries: int = field(
+        default=10000,
+        metadata={
+            "help": "Maximum number of articles to keep the chunk hashes for when calculating diffs."
+        },
+    )
+
+    chunk_hash_cache_file: str = field(
+        default=os.path.join(_CACHE_DIR, "chunk_hashes.json"),
+        metadata={
+            "help": "File to save the chunk hashes cache to between runs, empty to only keep it in memory."
+        },
+    )
+
+    _step_queue_sizes: dict[str, int] = field(init=False)
+
+    def __post_init__(self):
+        self._step_queue_sizes = _parse_step_sizes(self.step_queue_sizes)
+        # retention keeps the collections from growing unless rotating them is asked for, we do not do both
+        if self.rotate_collections_every > 0:
+            self.retain_max_chunks = 0
+            self.retain_max_age_hours = 0
+        # the chat app searches the new collections from the switch, make sure they have enough in them to be useful
+        if self.rotate_switch_after < 0:
+            self.rotate_switch_after = self.rotate_collections_every // 2
+
 
 @dataclass_json
 @dataclass
@@ -52,8 +271,132 @@ class LoadPipelineArgs(CommonPipelineArgs):
     )
     file: str = field(
         default="scripts/data/wiki_links.txt",
-        metadata={"help": "File of urls, one per line"},
+        metadata={
+            "help": "File of urls, one per line, can be compressed with gzip (.gz) or bzip2 (.bz2)"
+        },
+    )
+    load_checkpoint_file: str = field(
+        default=os.path.join(_CACHE_DIR, "load_checkpoint.json"),
+        metadata={
+            "help": "File to record the lines of the file that have been processed in, empty to disable."
+        },
+    )
+    resume: bool = field(
+        default=False,
+        metadata={
+            "help": "Skip the lines of the file the load checkpoint says have been processed. Implies --truncate_first false."
+        },
+    )
+
+    def __post_init__(self):
+        super().__post_init__()
+        # truncating would delete the articles we are skipping
+        if self.resume:
+            self.truncate_first = False
+
+
+@dataclass_json
+@dataclass
+class BenchArgs(CommonPipelineArgs):
+    # defaults that differ from the other pipeline commands
+    max_articles: int = field(
+        default=500,
+        metadata={"help": "Number of articles to put through the pipeline."},
+    )
+    embedding_cache_file: str = field(
+        default="",
+        metadata={
+            "help": "SQLite file to cache embeddings in, empty to disable. A cache from an earlier run will skip the embed step."
+        },
+    )
+    chunk_hash_cache_file: str = field(
+        default="",
+        metadata={
+            "help": "File to save the chunk hashes cache to between runs, empty to only keep it in memory."
+        },
+    )
+
+    html_dir: str = field(
+        default="",
+        metadata={
+            "help": "Directory of recorded article .html files to serve, empty to serve generated articles."
+        },
+    )
+    generated_pages: int = field(
+        default=200,
+        metadata={
+            "help": "Number of different articles to generate when there is no --html_dir."
+        },
+    )
+    wiki_latency_ms: float = field(
+        default=50.0,
+        metadata={"help": "Time the local Wikipedia takes to return a page."},
+    )
+    wiki_jitter_ms: float = field(
+        default=25.0,
+        metadata={"help": "Random variation, plus or minus, in the Wikipedia time."},
     )
+    embed_latency_ms: float = field(
+        default=150.0,
+        metadata={"help": "Time the local Cohere takes to embed a batch of chunks."},
+    )
+    embed_jitter_ms: float = field(
+        default=50.0,
+        metadata={"help": "Random variation, plus or minus, in the Cohere time."},
+    )
+    db_latency_ms: float = field(
+        default=20.0,
+        metadata={"help": "Time the local collections take for each request."},
+    )
+    db_jitter_ms: float = field(
+        default=10.0,
+        metadata={"help": "Random variation, plus or minus, in the collection time."},
+    )
+    db_error_rate: float = field(
+        default=0.0,
+        metadata={
+            "help": "Fraction of collection requests that fail with an API error, e.g. 0.01."
+        },
+    )
+    local_database_file: str = field(
+        default="",
+        metadata={
+            "help": "SQLite file to use the local database in rather than the in-memory collections, the db latency and error options are not used."
+        },
+    )
+    sample_ms: int = field(
+        default=100,
+        metadata={"help": "How often to sample the step queue depths."},
+    )
+    trace_memory: bool = field(
+        default=False,
+        metadata={
+            "help": "Report the peak Python memory from tracemalloc as well as the max RSS, slows the pipeline."
+        },
+    )
+    results_file: str = field(
+        default="",
+        metadata={
+            "help": "File to append the JSON results to as a single line, to compare runs on different commits."
+        },
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": "Seed for the generated articles, latencies and errors."},
+    )
+
+
+def _parse_step_sizes(step_sizes: str) -> dict[str, int]:
+    """Parse a string like 'load_article=500,vectorize_diffs=20' into a dict of step name to size"""
+    sizes: dict[str, int] = {}
+    for pair in step_sizes.split(","):
+        if not pair.strip():
+            continue
+        name, sep, size = pair.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid step size '{pair}', expected <step_name>=<size>")
+        sizes[name.strip()] = int(size)
+    return sizes
 
 
 # ======================================================================================================================
@@ -2,9 +2,12 @@
 COmmands that process articles through the pipeline
 """
 
-import json
+import bz2
+import gzip
 import logging
-from typing import Any, Optional
+import time
+from datetime import datetime, timezone
+from typing import IO, Any, Callable, Iterator, Optional
 
 from aiohttp import ClientPayloadError
 from aiohttp_sse_client2.client import MessageEvent, EventSource  # type: ignore[import-untyped]
@@ -12,11 +15,23 @@ from aiohttp_sse_client2.client import MessageEvent, EventSource  # type: ignore
 from wikichat.commands.model import CommonPipelineArgs, LoadPipelineArgs
 from wikichat.processing.articles import process_article_metadata
 from wikichat.processing.model import ArticleMetadata
+from wikichat.utils.checkpoint import ListenerCheckpoint, LoadCheckpoint
+from wikichat.utils.debounce import KeyedDebouncer
+from wikichat.utils.events import (
+    is_bot_event,
+    might_be_article_edit,
+    parse_event_data,
+)
 from wikichat.utils.metrics import METRICS
 from wikichat.utils.pipeline import AsyncPipeline
 
 WIKIPEDIA_CHANGES_URL = "https://stream.wikimedia.org/v2/stream/recentchange"
 
+# save the listen and load checkpoints at most this often
+CHECKPOINT_INTERVAL_SECS = 5
+# edits older than this when we get them are counted as catching up rather than live
+CATCHUP_LAG_SECS = 60
+
 
 # ======================================================================================================================
 # Commands
@@ -24,9 +39,35 @@ WIKIPEDIA_CHANGES_URL = "https://stream.wikimedia.org/v2/stream/recentchange"
 
 
 async def load_base_data(pipeline: AsyncPipeline, args: LoadPipelineArgs) -> bool:
-    return await process_article_metadata(
-        pipeline, read_popular_links(args.file, max_file_lines=args.max_file_lines)
-    )
+    if not args.load_checkpoint_file:
+        return await process_article_metadata(
+            pipeline, read_popular_links(args.file, max_file_lines=args.max_file_lines)
+        )
+
+    checkpoint: LoadCheckpoint = LoadCheckpoint(file_path=args.file)
+    if args.resume:
+        checkpoint = LoadCheckpoint.load(args.load_checkpoint_file, args.file)
+        logging.info(
+            f"Resuming load of {args.file}, lines up to {checkpoint.done_through} and {checkpoint.done_ranges()} have been processed"
+        )
+    progress = _LoadProgress(checkpoint, args.load_checkpoint_file)
+    pipeline.add_done_listener(progress.item_done)
+
+    all_put: bool = False
+    try:
+        all_put = await process_article_metadata(
+            pipeline,
+            progress.track(
+                read_popular_links(
+                    args.file,
+                    max_file_lines=args.max_file_lines,
+                    skip_line=checkpoint.is_done,
+                )
+            ),
+        )
+        return all_put
+    finally:
+        progress.finished_reading(all_put)
 
 
 async def listen_for_changes(pipeline: AsyncPipeline, args: CommonPipelineArgs) -> bool:
@@ -35,13 +76,51 @@ async def listen_for_changes(pipeline: AsyncPipeline, args: CommonPipelineArgs)
     event: MessageEvent
     keep_listening: bool = True
 
+    # where we are in the stream, so we resume from there when we reconnect or are restarted rather than from now
+    position: ListenerCheckpoint = ListenerCheckpoint()
+    if args.listen_checkpoint_file:
+        position = ListenerCheckpoint.load(args.listen_checkpoint_file)
+        if not position.is_empty():
+            logging.info(
+                f"Resuming listening from checkpoint {args.listen_checkpoint_file}, last event at {_format_timestamp(position.event_timestamp)}"
+            )
+    progress = _ListenProgress(position, args.listen_checkpoint_file)
+    pipeline.add_done_listener(progress.item_done)
+
+    # hold each article until it has not been edited for a while, so a burst of edits is processed once
+    debouncer: Optional[KeyedDebouncer] = None
+    if args.edit_quiet_secs > 0:
+        debouncer = KeyedDebouncer(
+            lambda metadata, tag: progress.put(pipeline, metadata, tag),
+            quiet_secs=args.edit_quiet_secs,
+            max_hold_secs=args.edit_max_hold_secs,
+        )
+        debouncer.start()
+        progress.debouncer = debouncer
+
     # Issue with timeout
     # see https://github.com/rtfol/aiohttp-sse-client/issues/2
     while keep_listening:
-        async with EventSource(WIKIPEDIA_CHANGES_URL, timeout=None) as event_source:
+        async with EventSource(
+            WIKIPEDIA_CHANGES_URL, timeout=None, **resume_kwargs(progress.position)
+        ) as event_source:
             try:
                 async for event in event_source:
-                    event_doc: Optional[dict[Any, Any]] = maybe_parse_wiki_event(event)
+                    # most events are for other wikis, skip them without decoding
+                    prefiltered: bool = event.type == "message" and not (
+                        might_be_article_edit(event.data)
+                    )
+                    event_doc: Optional[dict[Any, Any]] = (
+                        None if prefiltered else maybe_parse_wiki_event(event)
+                    )
+                    before_event: ListenerCheckpoint = progress.position
+                    event_timestamp: Optional[float] = (
+                        event_doc.get("timestamp") if event_doc else None
+                    )
+                    progress.position = ListenerCheckpoint(
+                        last_event_id=event.last_event_id or before_event.last_event_id,
+                        event_timestamp=event_timestamp or before_event.event_timestamp,
+                    )
                     match event_doc:
                         case {"meta": {"domain": "canary"}}:
                             # these are events used by wikipedia to test the service, ignore them
@@ -53,28 +132,59 @@ async def listen_for_changes(pipeline: AsyncPipeline, args: CommonPipelineArgs)
                             # ignore bot edits
                             await METRICS.update_listener(total_events=1, bot_events=1)
                             pass
+                        case None if prefiltered and is_bot_event(event.data):
+                            # bot edits the pre-filter skipped are still counted as bot events, as if we had decoded them
+                            await METRICS.update_listener(total_events=1, bot_events=1)
                         case {"namespace": 0, "wiki": "enwiki", "type": "edit"}:
                             # namespace 0 is the  wikipedia article namespace, this skips talk pages etc.
                             # see https://en.wikipedia.org/wiki/Wikipedia:Namespace
                             article_metadata: ArticleMetadata = ArticleMetadata(
                                 title=event_doc["title"],  # type: ignore[index]
                                 url=event_doc["title_url"],  # type: ignore[index]
+                                revision=event_doc.get("revision", {}).get("new"),  # type: ignore[union-attr]
                             )
 
+                            # edits older than this were made while we were not listening
+                            lag_secs: float = (
+                                time.time() - event_timestamp if event_timestamp else 0
+                            )
+                            catchup: bool = lag_secs > CATCHUP_LAG_SECS
+
                             # Let's process this article!
-                            if not await process_article_metadata(
-                                pipeline, [article_metadata]
-                            ):
-                                keep_listening = False
-                                break
+                            merged: bool = False
+                            tag: _EditTag = progress.next_tag(before_event)
+                            if debouncer is None:
+                                if not await progress.put(
+                                    pipeline, article_metadata, tag
+                                ):
+                                    keep_listening = False
+                                    break
+                            else:
+                                if not debouncer.accepting:
+                                    keep_listening = False
+                                    break
+                                merged = debouncer.add(
+                                    article_metadata.url,
+                                    article_metadata,
+                                    tag=tag,
+                                )
                             await METRICS.update_listener(
-                                total_events=1, enwiki_edits=1
+                                total_events=1,
+                                enwiki_edits=1,
+                                merged_edits=1 if merged else 0,
+                                catchup_edits=1 if catchup else 0,
+                                live_edits=0 if catchup else 1,
+                                event_lag_secs=lag_secs,
                             )
                         case _:
                             await METRICS.update_listener(
-                                total_events=1, skipped_events=1
+                                total_events=1,
+                                skipped_events=1,
+                                prefiltered_events=1 if prefiltered else 0,
                             )
 
+                    progress.maybe_save()
+
             except ConnectionError:
                 pass
             except ClientPayloadError:
@@ -85,6 +195,10 @@ async def listen_for_changes(pipeline: AsyncPipeline, args: CommonPipelineArgs)
                     exc_info=True,
                 )
                 pass
+
+    if debouncer is not None:
+        await debouncer.stop()
+    progress.finished_listening()
     return False
 
 
@@ -104,25 +218,191 @@ async def load_and_listen(pipeline: AsyncPipeline, args: LoadPipelineArgs) -> bo
 # ======================================================================================================================
 
 
-def read_popular_links(file_path: str, max_file_lines: int):
-    """Read the popular links file we use to bootstrap the system"""
+def read_popular_links(
+    file_path: str,
+    max_file_lines: int,
+    skip_line: Optional[Callable[[int], bool]] = None,
+) -> Iterator[ArticleMetadata]:
+    """Read the popular links file we use to bootstrap the system
+
+    Yields the links as they are read so the first articles go into the pipeline straight away and memory does not
+    grow with the size of the file. Files ending in .gz or .bz2 are decompressed as they are read. Lines are
+    numbered from 1 in the source_line of the metadata, lines skip_line() returns True for are not yielded.
+    """
     # Sample of the line in the file
 
-    links: list[ArticleMetadata] = list()
     logging.info(f"Reading links from file {file_path} limit is {max_file_lines}")
     line_count = 0
-    with open(file_path, mode="r", newline="") as file:
-        while max_file_lines == 0 or line_count < max_file_lines:
-            url: str = file.readline().strip()
+    link_count = 0
+    with _open_links_file(file_path) as file:
+        for line in file:
+            if max_file_lines and line_count >= max_file_lines:
+                break
             line_count += 1
 
-            if not url:
-                # end of file
-                break
-            links.append(ArticleMetadata(url=url))
+            url: str = line.strip()
+            if not url or (skip_line is not None and skip_line(line_count)):
+                continue
+            link_count += 1
+            yield ArticleMetadata(url=url, source_line=line_count)
+
+    logging.info(f"Read {link_count} links from file {file_path}")
+
+
+class _LoadProgress:
+    """Records the lines of the links file that have left the pipeline in the load checkpoint.
+
+    A line is done when its article has been stored, or was skipped because there was nothing to store, articles
+    that failed with an error are left to be processed again when the load is resumed. The checkpoint is saved every
+    few seconds, and once every line we read has left the pipeline.
+    """
+
+    def __init__(self, checkpoint: LoadCheckpoint, path: str):
+        self.checkpoint: LoadCheckpoint = checkpoint
+        self.path: str = path
+        self._in_flight: int = 0
+        self._reading: bool = True
+        self._last_saved_secs: float = time.monotonic()
+
+    def track(self, links: Iterator[ArticleMetadata]) -> Iterator[ArticleMetadata]:
+        for link in links:
+            self._in_flight += 1
+            yield link
+
+    def finished_reading(self, all_put: bool) -> None:
+        # process_article_metadata() stops at the first link the pipeline would not take
+        if not all_put and self._in_flight:
+            self._in_flight -= 1
+        self._reading = False
+        self._maybe_save()
+
+    async def item_done(self, item: Any, succeeded: bool) -> None:
+        line: Optional[int] = getattr(item, "source_line", None)
+        if line is None:
+            # not from the links file, e.g. listening for changes after the load
+            return
+        self._in_flight -= 1
+        if succeeded:
+            self.checkpoint.mark_done(line)
+        self._maybe_save()
+
+    def _maybe_save(self) -> None:
+        finished = not self._reading and self._in_flight <= 0
+        if (
+            finished
+            or time.monotonic() - self._last_saved_secs >= CHECKPOINT_INTERVAL_SECS
+        ):
+            self.checkpoint.save(self.path)
+            self._last_saved_secs = time.monotonic()
+            if finished:
+                logging.info(
+                    f"Saved load checkpoint {self.path}, lines up to {self.checkpoint.done_through} have been processed"
+                )
+
+
+# the number of the edit, counting from 1 as they are read from the stream, and the position before its event
+_EditTag = tuple[int, ListenerCheckpoint]
+
+
+class _ListenProgress:
+    """Records how far through the Wikipedia changes stream the edits have left the pipeline, in the listen checkpoint.
+
+    Each edit is tagged with the position before its event when it is read. The checkpoint is the position before
+    the oldest edit that is still held by the debouncer or in the pipeline, or the last event read when there are
+    none, so resuming from it reads again every edit whose article has not been stored. Articles that failed with an
+    error are not held back for, they are processed again when the article is next edited. The checkpoint is saved
+    every few seconds, and once every edit has left the pipeline after we stop listening.
+    """
+
+    def __init__(self, position: ListenerCheckpoint, path: str):
+        # the last event read from the stream
+        self.position: ListenerCheckpoint = position
+        self.path: str = path
+        self.debouncer: Optional[KeyedDebouncer] = None
+        self._edit_count: int = 0
+        # keyed on id() of the metadata put to the pipeline, which is the item the done listener is called with
+        self._in_flight: dict[int, tuple[ArticleMetadata, _EditTag]] = {}
+        # set when the pipeline would not take an edit, nothing after that is processed
+        self._refused_at: Optional[ListenerCheckpoint] = None
+        self._listening: bool = True
+        self._last_saved_secs: float = time.monotonic()
+
+    def next_tag(self, before_event: ListenerCheckpoint) -> _EditTag:
+        self._edit_count += 1
+        return self._edit_count, before_event
+
+    async def put(
+        self, pipeline: AsyncPipeline, metadata: ArticleMetadata, tag: _EditTag
+    ) -> bool:
+        """Put the edit to the pipeline, returns False if the pipeline would not take it"""
+        self._in_flight[id(metadata)] = (metadata, tag)
+        if await process_article_metadata(pipeline, [metadata]):
+            return True
+        # the debouncer drops the articles it still holds, so resume from before them as well
+        self._refused_at = self.checkpoint()
+        del self._in_flight[id(metadata)]
+        return False
+
+    async def item_done(self, item: Any, succeeded: bool) -> None:
+        if self._in_flight.pop(id(item), None) is None:
+            # not an edit from the stream, e.g. loading the links file before listening
+            return
+        self.maybe_save()
+
+    def finished_listening(self) -> None:
+        self._listening = False
+        self.maybe_save()
+
+    def checkpoint(self) -> ListenerCheckpoint:
+        if self._refused_at is not None:
+            return self._refused_at
+        tags: list[_EditTag] = [tag for _, tag in self._in_flight.values()]
+        held: Optional[_EditTag] = (
+            self.debouncer.oldest_tag() if self.debouncer is not None else None
+        )
+        if held is not None:
+            tags.append(held)
+        if not tags:
+            return self.position
+        return min(tags, key=lambda tag: tag[0])[1]
+
+    def maybe_save(self) -> None:
+        if not self.path:
+            return
+        finished = not self._listening and not self._in_flight
+        if (
+            finished
+            or time.monotonic() - self._last_saved_secs >= CHECKPOINT_INTERVAL_SECS
+        ):
+            self.checkpoint().save(self.path)
+            self._last_saved_secs = time.monotonic()
+
+
+def _open_links_file(file_path: str) -> IO[str]:
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, mode="rt", newline="")
+    if file_path.endswith(".bz2"):
+        return bz2.open(file_path, mode="rt", newline="")
+    return open(file_path, mode="r", newline="")
+
+
+def resume_kwargs(position: ListenerCheckpoint) -> dict[str, Any]:
+    """Args for the EventSource to resume the stream after the position, see
+    https://wikitech.wikimedia.org/wiki/Event_Platform/EventStreams#Historical_Consumption
+
+    The stream uses the Last-Event-ID header if we have an event id, otherwise the since parameter.
+    """
+    if position.last_event_id:
+        return {"headers": {"Last-Event-ID": position.last_event_id}}
+    if position.event_timestamp:
+        return {"params": {"since": _format_timestamp(position.event_timestamp)}}
+    return {}
+
 
-    logging.info(f"Read {len(links)} links from file {file_path}")
-    return links
+def _format_timestamp(timestamp: Optional[float]) -> str:
+    if not timestamp:
+        return "None"
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
 
 
 def maybe_parse_wiki_event(event: MessageEvent) -> dict[Any, Any] | None:
@@ -133,7 +413,7 @@ def maybe_parse_wiki_event(event: MessageEvent) -> dict[Any, Any] | None:
     if event.type != "message":
         return None
     try:
-        return json.loads(event.data)
+        return parse_event_data(event.data)
     except ValueError:
         logging.debug(f"Error parsing event data, continuing: {event.data}")
         return None
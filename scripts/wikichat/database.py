@@ -1,69 +1,287 @@
 """
 This file contains the code to setup the database. It will create the collections if they don't exist, and truncate them if they do.
 
-Importing the module initialises the database.
+The collections are in Astra DB unless the WIKICHAT_DATABASE environment variable is ``local``, then they are in the
+SQLite file WIKICHAT_LOCAL_DATABASE_FILE using :mod:`wikichat.utils.local_collection`, so the pipeline and the search
+commands can be run without Astra DB.
+
+Importing the module does not connect to the database, so commands that do not use it start quickly. The
+handles for EMBEDDINGS_COLLECTION, METADATA_COLLECTION and SUGGESTIONS_COLLECTION are made the first time one of
+them is used, and rotate_collections() changes which collections EMBEDDINGS_COLLECTION and METADATA_COLLECTION are,
+so read them from the module when they are needed, e.g. ``database.EMBEDDINGS_COLLECTION``, rather than importing
+them. Making a handle does not call the server, call create_collections() before writing to them.
+use_collections() can be called before then to use other collections, such as the local stand-ins used by the
+bench command.
 """
 
+import asyncio
 import logging
 import os
+import re
+import time
+from typing import TYPE_CHECKING, Any, Callable, Optional, Union
 
-from astrapy import DataAPIClient, AsyncCollection
-from astrapy.info import CollectionDefinition
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    # astrapy and NumPy take a while to import, they are imported when the collections are first used
+    from astrapy import AsyncCollection, AsyncDatabase
+    from wikichat.utils.local_collection import LocalCollection, LocalDatabase
 
 load_dotenv()
 
-# The client to connect to the Astra Data API
-ASTRA_DB_CLIENT = DataAPIClient()
-ASTRA_DB = ASTRA_DB_CLIENT.get_database(
-    os.environ["ASTRA_DB_API_ENDPOINT"],
-    token=os.environ["ASTRA_DB_APPLICATION_TOKEN"],
-    keyspace=os.getenv("ASTRA_DB_KEYSPACE"),
+# The collections from either backend have the async methods we use, e.g. insert_many, find and find_one_and_replace
+Collection = Union["AsyncCollection", "LocalCollection"]
+
+_DATABASE_BACKEND_ENV = "WIKICHAT_DATABASE"
+_LOCAL_DATABASE_FILE_ENV = "WIKICHAT_LOCAL_DATABASE_FILE"
+_DEFAULT_LOCAL_DATABASE_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "cache",
+    "local_database.sqlite",
 )
 
 # We have three collections
 _ARTICLE_EMBEDDINGS_NAME = "article_embeddings"
 _ARTICLE_METADATA_NAME = "article_metadata"
 _ARTICLE_SUGGESTIONS_NAME = "article_suggestions"
-_ALL_COLLECTION_NAMES: list[str] = [
+_ROTATED_COLLECTION_NAMES: list[str] = [
     _ARTICLE_EMBEDDINGS_NAME,
     _ARTICLE_METADATA_NAME,
-    _ARTICLE_SUGGESTIONS_NAME,
 ]
 
-# Create the collections on the server, this will fail gracefully if they already exist
-EMBEDDINGS_COLLECTION = ASTRA_DB.create_collection(
-    _ARTICLE_EMBEDDINGS_NAME,
-    definition=(CollectionDefinition.builder().set_vector_dimension(1024).build()),
-).to_async()
-METADATA_COLLECTION = ASTRA_DB.create_collection(_ARTICLE_METADATA_NAME).to_async()
-SUGGESTIONS_COLLECTION = ASTRA_DB.create_collection(
-    _ARTICLE_SUGGESTIONS_NAME
-).to_async()
-
-_ALL_COLLECTIONS: list[AsyncCollection] = [
-    EMBEDDINGS_COLLECTION,
-    METADATA_COLLECTION,
-    SUGGESTIONS_COLLECTION,
-]
-_ROTATED_COLLECTIONS: list[AsyncCollection] = [
-    EMBEDDINGS_COLLECTION,
-    METADATA_COLLECTION,
-]
+# The names rotate_collections() makes, the base name and the time suffix
+_PATTERN_ROTATED_NAME = re.compile(rf"({'|'.join(_ROTATED_COLLECTION_NAMES)})_(\d+)")
 
+# The module attributes for the collections, and the name of the collection each one is for
+_COLLECTION_ATTRS: dict[str, str] = {
+    "EMBEDDINGS_COLLECTION": _ARTICLE_EMBEDDINGS_NAME,
+    "METADATA_COLLECTION": _ARTICLE_METADATA_NAME,
+    "SUGGESTIONS_COLLECTION": _ARTICLE_SUGGESTIONS_NAME,
+}
+# The id of the suggestions doc that records the embeddings collection the chat app searches
+_RECENT_ARTICLES_ID = "recent_articles"
+
+# Makes the handle for a collection name, see _get_collection()
+_COLLECTION_FACTORY: Optional[Callable[[str], Any]] = None
+# Collection name to the handle for it
+_HANDLES: dict[str, Collection] = {}
+# Only one of these is set, depending on the backend, to create and list the collections
+_ASTRA_DB: Optional["AsyncDatabase"] = None
+_LOCAL_DATABASE: Optional["LocalDatabase"] = None
+_CREATE_LOCK = asyncio.Lock()
+_COLLECTIONS_CREATED: bool = False
+
+# The suffix on the names of the rotated collections we are writing to, empty for the unsuffixed names. Changed
+# by rotate_collections()
+_ROTATION_SUFFIX: str = ""
+# Dropping the collections we rotated away from, see drop_collections_later()
+_DROP_TASKS: set[asyncio.Task] = set()
+
+
+def use_collections(collection_factory: Callable[[str], Any]) -> None:
+    """Use the collections made by calling collection_factory with the collection name, rather than connecting
+    to Astra.
+
+    Must be called before the collections are first used, they only need the AsyncCollection methods the
+    pipeline calls. They are dropped by calling their async drop() method.
+    """
+    global _COLLECTION_FACTORY
+    if _COLLECTION_FACTORY is not None:
+        raise Exception("Database collections already in use")
+    _COLLECTION_FACTORY = collection_factory
+
+
+def _get_collection(name: str) -> Collection:
+    global _COLLECTION_FACTORY
+    if _COLLECTION_FACTORY is None:
+        backend = os.getenv(_DATABASE_BACKEND_ENV, "astra").lower()
+        if backend == "astra":
+            _COLLECTION_FACTORY = _open_astra_database()
+        elif backend == "local":
+            _COLLECTION_FACTORY = _open_local_database()
+        else:
+            raise ValueError(
+                f"Unknown database backend {_DATABASE_BACKEND_ENV}={backend}, expected astra or local"
+            )
+    if name not in _HANDLES:
+        _HANDLES[name] = _COLLECTION_FACTORY(name)
+    return _HANDLES[name]
 
-async def truncate_all_collections() -> None:
-    for collection in _ALL_COLLECTIONS:
-        await try_truncate_collection(collection)
 
+def _open_local_database() -> Callable[[str], Any]:
+    global _LOCAL_DATABASE
+    # only import NumPy when it is needed
+    from wikichat.utils.local_collection import LocalDatabase
+
+    _LOCAL_DATABASE = LocalDatabase(
+        os.getenv(_LOCAL_DATABASE_FILE_ENV) or _DEFAULT_LOCAL_DATABASE_FILE
+    )
+    return _LOCAL_DATABASE.get_collection
+
+
+def _open_astra_database() -> Callable[[str], Any]:
+    global _ASTRA_DB
+    from astrapy import DataAPIClient
+
+    # The client to connect to the Astra Data API
+    _ASTRA_DB = DataAPIClient().get_async_database(
+        os.environ["ASTRA_DB_API_ENDPOINT"],
+        token=os.environ["ASTRA_DB_APPLICATION_TOKEN"],
+        keyspace=os.getenv("ASTRA_DB_KEYSPACE"),
+    )
+    return _ASTRA_DB.get_collection
+
+
+def _rotated_name(name: str, suffix: str) -> str:
+    return f"{name}_{suffix}" if suffix and name in _ROTATED_COLLECTION_NAMES else name
+
+
+def _rotated_names(suffix: str) -> list[str]:
+    return [_rotated_name(name, suffix) for name in _ROTATED_COLLECTION_NAMES]
+
+
+async def _create_collections(names: list[str]) -> None:
+    """Create the collections if they do not exist.
+
+    The local database creates a collection when it makes the handle, and collections from use_collections() are
+    used as they are.
+    """
+    for name in names:
+        _get_collection(name)
+    if _ASTRA_DB is None:
+        return
+    from astrapy.info import CollectionDefinition
+
+    # this will fail gracefully if they already exist
+    await asyncio.gather(
+        *(
+            _ASTRA_DB.create_collection(
+                name,
+                definition=(
+                    CollectionDefinition.builder().set_vector_dimension(1024).build()
+                    if name.startswith(_ARTICLE_EMBEDDINGS_NAME)
+                    else None
+                ),
+            )
+            for name in names
+        )
+    )
+    logging.info(f"Created collections {names}")
 
-async def truncate_rotated_collections() -> None:
-    for collection in _ROTATED_COLLECTIONS:
-        await try_truncate_collection(collection)
+
+async def create_collections() -> None:
+    """Create the collections on the server if they do not exist, only the first call does anything.
+
+    The rotated collections are the ones the suggestions doc says the chat app is searching, so a restart carries on
+    with the collections from the last rotation.
+    """
+    global _COLLECTIONS_CREATED
+    async with _CREATE_LOCK:
+        if _COLLECTIONS_CREATED:
+            return
+        await _create_collections([_ARTICLE_SUGGESTIONS_NAME])
+        await use_searched_collections()
+        await _create_collections(_rotated_names(_ROTATION_SUFFIX))
+        _COLLECTIONS_CREATED = True
+
+
+async def use_searched_collections() -> None:
+    """Use the rotated collections the suggestions doc says the chat app is searching, the unsuffixed ones if
+    there is no doc."""
+    global _ROTATION_SUFFIX
+    recent_articles = await _get_collection(_ARTICLE_SUGGESTIONS_NAME).find_one(
+        filter={"_id": _RECENT_ARTICLES_ID},
+        projection={"embedding_collection": True},
+    )
+    embedding_collection = (recent_articles or {}).get("embedding_collection", "")
+    if embedding_collection.startswith(f"{_ARTICLE_EMBEDDINGS_NAME}_"):
+        _ROTATION_SUFFIX = embedding_collection[len(_ARTICLE_EMBEDDINGS_NAME) + 1 :]
+
+
+async def rotate_collections() -> list[str]:
+    """Create a new, empty, pair of embeddings and metadata collections and switch EMBEDDINGS_COLLECTION and
+    METADATA_COLLECTION to them.
+
+    Returns the names of the previous pair. They are not written to after the switch, but the chat app searches the
+    previous embeddings collection until the suggestions doc is changed to the new one, then drop them with
+    drop_collections_later().
+    """
+    global _ROTATION_SUFFIX
+    # the suffix is the time, always increasing so the names are never reused
+    suffix = str(max(int(time.time()), int(_ROTATION_SUFFIX or 0) + 1))
+    previous_names = _rotated_names(_ROTATION_SUFFIX)
+    await _create_collections(_rotated_names(suffix))
+    _ROTATION_SUFFIX = suffix
+    logging.info(
+        f"Rotated collections from {previous_names} to {_rotated_names(suffix)}"
+    )
+    return previous_names
+
+
+def drop_collections_later(names: list[str]) -> None:
+    """Drop the collections in the background, call wait_for_dropped_collections() before exiting"""
+    for name in names:
+        task = asyncio.create_task(_try_drop_collection(name), name=f"drop_{name}")
+        _DROP_TASKS.add(task)
+        task.add_done_callback(_DROP_TASKS.discard)
+
+
+async def drop_stale_collections_later() -> None:
+    """Drop the rotated collections older than the pair in use, left over from a switch that did not finish.
+
+    Only the names with the suffix rotate_collections() makes are dropped, and only when the suffix is before the one
+    in use. The unsuffixed pair and newer rotated pairs are left, another pipeline may be writing to them.
+    """
+    if _ASTRA_DB is not None:
+        names = await _ASTRA_DB.list_collection_names()
+    elif _LOCAL_DATABASE is not None:
+        names = await asyncio.to_thread(_LOCAL_DATABASE.list_collection_names)
+    else:
+        # the collections from use_collections() start empty
+        return
+    if not _ROTATION_SUFFIX:
+        return
+    stale_names = []
+    for name in names:
+        match = _PATTERN_ROTATED_NAME.fullmatch(name)
+        if match and int(match.group(2)) < int(_ROTATION_SUFFIX):
+            stale_names.append(name)
+    drop_collections_later(stale_names)
+
+
+async def wait_for_dropped_collections() -> None:
+    if _DROP_TASKS:
+        logging.info(f"Waiting to drop {len(_DROP_TASKS)} collections")
+        await asyncio.gather(*_DROP_TASKS)
+
+
+async def _try_drop_collection(name: str) -> None:
+    for i in range(5):
+        try:
+            logging.info(f"Attempt {i} Dropping collection {name}")
+            await _get_collection(name).drop()
+            _HANDLES.pop(name, None)
+            return
+        except Exception:
+            logging.exception(
+                f"Retrying, error dropping collection {name}", exc_info=True
+            )
+
+
+def __getattr__(name: str) -> Collection:
+    # called for module attributes that do not exist, see PEP 562
+    if name in _COLLECTION_ATTRS:
+        return _get_collection(_rotated_name(_COLLECTION_ATTRS[name], _ROTATION_SUFFIX))
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def truncate_all_collections() -> None:
+    for name in [*_rotated_names(_ROTATION_SUFFIX), _ARTICLE_SUGGESTIONS_NAME]:
+        await try_truncate_collection(_get_collection(name))
 
 
-async def try_truncate_collection(collection: AsyncCollection) -> None:
+async def try_truncate_collection(collection: Collection) -> None:
     # This can timeout sometimes, so lets retry :)
     for i in range(5):
         try:
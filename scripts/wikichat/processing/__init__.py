@@ -2,22 +2,13 @@
 The processing steps for ingesting wikipedia articles are in this module.
 """
 
-import asyncio
 import logging
-from typing import Any, Tuple
+from typing import Any, Optional
 
 from wikichat import database
-from wikichat.database import SUGGESTIONS_COLLECTION
-from wikichat.processing.articles import (
-    load_article,
-    chunk_article,
-    calc_chunk_diff,
-    vectorize_diff,
-    store_article_diff,
-)
-from wikichat.processing.model import RECENT_ARTICLES
+from wikichat.processing import chunk_hash_cache, suggestions
 from wikichat.utils.metrics import METRICS
-from wikichat.utils.pipeline import AsyncPipeline, AsyncStep
+from wikichat.utils.pipeline import AsyncPipeline, AsyncStep, AsyncBatchStep
 
 """
 Creates the processing pipeline for ingesting wikipedia articles, configuring how many async tasks to run for 
@@ -26,86 +17,215 @@ each step.
 
 
 def create_pipeline(
-    max_items: int = 100, rotate_collection_every: int = 0
+    max_items: int = 100,
+    rotate_collection_every: int = 0,
+    rotate_switch_after: int = 0,
+    queue_size: int = 0,
+    step_queue_sizes: Optional[dict[str, int]] = None,
+    chunk_batch_size: int = 10,
+    chunk_max_wait_ms: int = 20,
+    diff_batch_size: int = 20,
+    diff_max_wait_ms: int = 20,
+    embed_batch_size: int = 96,
+    embed_max_wait_ms: int = 50,
+    store_batch_size: int = 20,
+    store_max_in_flight: int = 4,
 ) -> AsyncPipeline:
-    return (
+    """Create the pipeline.
+
+    queue_size is the capacity of every step's source queue, 0 for unbounded. step_queue_sizes can override the
+    capacity for individual steps, keyed on the step (function) name.
+
+    The chunk step splits up to chunk_batch_size articles at a time in the CPU pool, waiting up to
+    chunk_max_wait_ms for more articles. The diff step reads the previous metadata for up to diff_batch_size articles in one request, waiting up to
+    diff_max_wait_ms for more articles. The vectorize step gathers new chunks from many articles into one call to Cohere, up to embed_batch_size
+    chunks or until it has waited embed_max_wait_ms for more articles.
+
+    The store step inserts and deletes chunks using batches of store_batch_size documents, with up to
+    store_max_in_flight requests at a time for each article.
+
+    The collections are rotated every rotate_collection_every chunks, and the chat app is switched to the new
+    collections after rotate_switch_after chunks have been inserted into them, see _RotationListener.
+    """
+    # imported here so importing wikichat.processing.model does not import the steps and the HTTP client they use
+    from wikichat.processing.articles import (
+        STORE_SETTINGS,
+        load_article,
+        chunk_articles,
+        calc_chunk_diffs,
+        vectorize_diffs,
+        store_article_diff,
+    )
+
+    step_queue_sizes = step_queue_sizes or {}
+    unknown_steps = set(step_queue_sizes) - {
+        func.__name__
+        for func in (
+            load_article,
+            chunk_articles,
+            calc_chunk_diffs,
+            vectorize_diffs,
+            store_article_diff,
+        )
+    }
+    if unknown_steps:
+        raise ValueError(f"Unknown pipeline steps in queue sizes: {unknown_steps}")
+
+    STORE_SETTINGS.batch_size = store_batch_size
+    STORE_SETTINGS.max_in_flight = store_max_in_flight
+
+    def _queue_size(func) -> int:
+        return step_queue_sizes.get(func.__name__, queue_size)
+
+    pipeline = (
         AsyncPipeline(max_items=max_items, error_listener=METRICS.listen_to_step_error)
-        .add_step(AsyncStep(load_article, 10))
-        .add_step(AsyncStep(chunk_article, 2))
-        .add_step(AsyncStep(calc_chunk_diff, 5))
-        .add_step(AsyncStep(vectorize_diff, 5))
+        .add_step(
+            AsyncStep(
+                load_article,
+                10,
+                listener=_start_article,
+                max_queue_size=_queue_size(load_article),
+            )
+        )
+        .add_step(
+            AsyncBatchStep(
+                chunk_articles,
+                2,
+                max_batch_size=chunk_batch_size,
+                max_wait_ms=chunk_max_wait_ms,
+                max_queue_size=_queue_size(chunk_articles),
+            )
+        )
+        .add_step(
+            AsyncBatchStep(
+                calc_chunk_diffs,
+                5,
+                max_batch_size=diff_batch_size,
+                max_wait_ms=diff_max_wait_ms,
+                max_queue_size=_queue_size(calc_chunk_diffs),
+            )
+        )
+        .add_step(
+            AsyncBatchStep(
+                vectorize_diffs,
+                5,
+                max_batch_size=embed_batch_size,
+                max_wait_ms=embed_max_wait_ms,
+                item_size=lambda article_diff: max(1, len(article_diff.new_chunks)),
+                max_queue_size=_queue_size(vectorize_diffs),
+            )
+        )
         .add_last_step(
             AsyncStep(
                 store_article_diff,
                 5,
-                listener=_RotationListener(rotate_collection_every)
-                if rotate_collection_every > 0
-                else None,
+                listener=(
+                    _RotationListener(rotate_collection_every, rotate_switch_after)
+                    if rotate_collection_every > 0
+                    else None
+                ),
+                max_queue_size=_queue_size(store_article_diff),
             )
         )
     )
+    pipeline.add_done_listener(_article_done)
+    return pipeline
+
+
+async def _start_article(step: AsyncStep, metadata: Any) -> bool:
+    # so the retention sweeper does not delete the article while we are storing it
+    from wikichat.processing import retention
+
+    await retention.article_started(metadata.url)
+    return True
+
+
+async def _article_done(metadata: Any, succeeded: bool) -> None:
+    from wikichat.processing import retention, wikipedia
+
+    retention.article_done(metadata.url)
+    if not succeeded:
+        # an article that failed may not be stored, fetch it in full when it is next edited
+        wikipedia.forget(metadata.url)
 
 
 """
 Handed to the AsyncStep to listen when a new article is about to the processed by the store_article_diff step. 
 
-We use this to check if we should rotate the collection, which means truncating the collections. We do this 
-because the script is capable of running for a long time, and we want to keep the collections from growing to hold
-all of wikipedia. 
+We use this to check if we should rotate the collection, which means starting again with new, empty, collections. We
+do this because the script is capable of running for a long time, and we want to keep the collections from growing
+to hold all of wikipedia. 
 """
 
 
 class _RotationListener:
-    def __init__(self, rotate_collection_every: int):
+    """Rotates the embeddings and metadata collections blue/green, so storing articles and searching never stop.
+
+    Rotating switches the store step to a new pair of collections, while the chat app carries on searching the
+    previous embeddings collection. Once switch_after chunks have been inserted into the new pair the suggestions doc
+    is changed so the chat app searches the new embeddings collection, and the previous pair is dropped in the
+    background. If the pipeline stops before then, the next run carries on with the previous pair and the new pair is
+    dropped as stale.
+    """
+
+    def __init__(self, rotate_collection_every: int, switch_after: int):
         self._rotate_collection_every = rotate_collection_every
-        self._rotate_lock = asyncio.Lock()
+        self._switch_after = switch_after
+        # set while one worker rotates or switches, the other workers carry on storing articles
+        self._busy: bool = False
+        # the collections we rotated away from, until the chat app is switched to the new ones
+        self._previous_collections: Optional[list[str]] = None
+        self._switch_at_chunks: int = 0
 
     async def __call__(self, step: AsyncStep, item: Any) -> bool:
-        should_rotate, rotations_count, chunks_inserted = await self._should_rotate()
-        if not should_rotate:
+        rotations_count, chunks_inserted = await METRICS.get_rotation_stats()
+        if self._busy:
             return True
 
-        logging.info(
-            f"Maybe starting collection rotation {rotations_count + 1} after {chunks_inserted} chunks inserted"
-        )
-        async with self._rotate_lock:
-            # Double check incase someone else rotated while we were waiting for the lock
-            rotations_count, chunks_inserted = await METRICS.get_rotation_stats()
-            (
-                should_rotate,
-                rotations_count,
-                chunks_inserted,
-            ) = await self._should_rotate()
-            if not should_rotate:
-                logging.info(
-                    f"Another worker rotated, current rotatations {rotations_count} and chunks inserted {chunks_inserted}"
-                )
-                return True
-
-            # We really mean it now !
-            logging.info(
-                f"Starting collection rotation {rotations_count + 1} after {chunks_inserted} chunks inserted"
-            )
-            # if we are in the _rotate_lock all other workers are waiting for us to finish
-            # so we can safely rotate the collections, which just means truncating them and clearing the recent articles
-            await database.truncate_rotated_collections()
-
-            # Change suggested articles to point to the new collection
-            # and clear the list of suggestions, they are not in the new collection.
-            recent_articles = await RECENT_ARTICLES.update_and_clone(
-                None, clear_list=True
-            )
-            await SUGGESTIONS_COLLECTION.find_one_and_replace(
-                filter={"_id": recent_articles._id},
-                replacement=recent_articles.to_dict(),  # type: ignore[attr-defined]
-                upsert=True,
-            )
-            await METRICS.update_rotation_stats(rotations=1)
+        self._busy = True
+        try:
+            if self._previous_collections is not None:
+                if chunks_inserted >= self._switch_at_chunks:
+                    await self._switch()
+            elif self._should_rotate(rotations_count, chunks_inserted):
+                await self._rotate(rotations_count, chunks_inserted)
+        finally:
+            self._busy = False
         return True
 
-    async def _should_rotate(self) -> Tuple[bool, int, int]:
-        rotations_count, chunks_inserted = await METRICS.get_rotation_stats()
-        should_rotate: bool = chunks_inserted > 0 and chunks_inserted >= (
+    def _should_rotate(self, rotations_count: int, chunks_inserted: int) -> bool:
+        return chunks_inserted > 0 and chunks_inserted >= (
             self._rotate_collection_every * (rotations_count + 1)
         )
-        return should_rotate, rotations_count, chunks_inserted
+
+    async def _rotate(self, rotations_count: int, chunks_inserted: int) -> None:
+        logging.info(
+            f"Starting collection rotation {rotations_count + 1} after {chunks_inserted} chunks inserted"
+        )
+        # the other workers use the new collections from their next read of database.EMBEDDINGS_COLLECTION etc.
+        # store_article_diff() stores in full the articles they diffed against, or were storing in, the previous pair
+        self._previous_collections = await database.rotate_collections()
+        chunk_hash_cache.clear(database.METADATA_COLLECTION.name)
+        # the articles are not in the new collections, fetch them in full when they are next edited
+        from wikichat.processing import wikipedia
+
+        wikipedia.forget_all()
+        await METRICS.update_rotation_stats(rotations=1)
+
+        _, chunks_inserted = await METRICS.get_rotation_stats()
+        self._switch_at_chunks = chunks_inserted + self._switch_after
+        if self._switch_after <= 0:
+            await self._switch()
+
+    async def _switch(self) -> None:
+        logging.info(
+            f"Switching the chat app to collection {database.EMBEDDINGS_COLLECTION.name}"
+        )
+        # Change suggested articles to point to the new collection, the recent articles were stored in it
+        await suggestions.update_recent_articles(
+            None,
+            write_now=True,
+            embedding_collection=database.EMBEDDINGS_COLLECTION.name,
+        )
+        database.drop_collections_later(self._previous_collections or [])
+        self._previous_collections = None
@@ -4,20 +4,16 @@ The processing steps for ingesting wikipedia articles are in this module.
 The processing/__init__.py file joins these functions together into a pipeline.
 """
 
-import hashlib
+import asyncio
 import logging
+from dataclasses import dataclass
 from datetime import datetime
-from typing import cast, Optional
+from typing import cast, Iterable, Optional
 
 from astrapy.exceptions import CollectionInsertManyException, DataAPIResponseException
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-from wikichat.database import (
-    EMBEDDINGS_COLLECTION,
-    METADATA_COLLECTION,
-    SUGGESTIONS_COLLECTION,
-)
-from wikichat.processing import embeddings, wikipedia
+from wikichat import database
+from wikichat.processing import chunk_hash_cache, embeddings, suggestions, wikipedia
 from wikichat.processing.model import (
     ArticleMetadata,
     Article,
@@ -29,18 +25,37 @@ from wikichat.processing.model import (
     VectoredChunkedArticleDiff,
     VectoredChunk,
     EmbeddingDocument,
-    RECENT_ARTICLES,
-    RecentArticles,
 )
-from wikichat.utils import batch_list
+from wikichat.utils import batch_list, gather_bounded
+from wikichat.utils.batch_writer import BatchWriter
+from wikichat.utils.cpu import run_cpu_bound
+from wikichat.utils.errors import DuplicateDocumentsError
 from wikichat.utils.metrics import METRICS
 from wikichat.utils.pipeline import AsyncPipeline
+from wikichat.utils.text_splitter import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    chunk_and_hash,
+)
 
 DOCUMENT_ALREADY_EXISTS_API_ERROR_CODE = "DOCUMENT_ALREADY_EXISTS"
 
-TEXT_SPLITTER = RecursiveCharacterTextSplitter(
-    chunk_size=1024, chunk_overlap=200, length_function=len
-)
+
+@dataclass
+class StoreSettings:
+    """How store_article_diff() writes to the embeddings collection, set by create_pipeline()"""
+
+    # number of documents in each insert_many or delete_many request
+    batch_size: int = 20
+    # number of requests that can be in flight at the same time, for each article or for all articles when the
+    # embedding writer is started
+    max_in_flight: int = 4
+
+
+STORE_SETTINGS = StoreSettings()
+
+# Optional writer that coalesces the chunks from many articles into full batches, see start_embedding_writer()
+_EMBEDDING_WRITER: Optional[BatchWriter] = None
 
 
 # ======================================================================================================================
@@ -53,32 +68,96 @@ async def load_article(meta: ArticleMetadata) -> Optional[Article]:
     return await wikipedia.scrape_article(meta)
 
 
-async def chunk_article(article: Article) -> ChunkedArticle:
-    chunks = TEXT_SPLITTER.split_text(article.content or "")
-    logging.debug(f"Split article {article.metadata.url} into {len(chunks)} chunks")
-
-    hashes = [hashlib.sha256(chunk.encode("utf-8")).hexdigest() for chunk in chunks]
-    await METRICS.update_chunks(chunks_created=len(chunks))
+async def chunk_articles(articles: list[Article]) -> list[ChunkedArticle]:
+    """Split a batch of articles into chunks and hash them, in the CPU pool if it is started"""
+    all_chunks: list[list[tuple[str, str]]] = await run_cpu_bound(
+        chunk_and_hash,
+        [article.content or "" for article in articles],
+        CHUNK_SIZE,
+        CHUNK_OVERLAP,
+    )
 
-    return ChunkedArticle(
-        article=article,
-        chunks=[
-            Chunk(
-                content=chunk,
-                metadata=ChunkMetadata(index=idx, length=len(chunk), hash=chunk_hash),
+    chunked_articles: list[ChunkedArticle] = []
+    for article, chunks in zip(articles, all_chunks):
+        logging.debug(f"Split article {article.metadata.url} into {len(chunks)} chunks")
+        chunked_articles.append(
+            ChunkedArticle(
+                article=article,
+                chunks=[
+                    Chunk(
+                        content=chunk,
+                        metadata=ChunkMetadata(
+                            index=idx, length=len(chunk), hash=chunk_hash
+                        ),
+                    )
+                    for idx, (chunk, chunk_hash) in enumerate(chunks)
+                ],
             )
-            for idx, (chunk, chunk_hash) in enumerate(zip(chunks, hashes))
-        ],
+        )
+    await METRICS.update_chunks(
+        chunks_created=sum(len(chunks) for chunks in all_chunks)
     )
+    return chunked_articles
 
 
-async def calc_chunk_diff(chunked_article: ChunkedArticle) -> ChunkedArticleDiff:
+async def calc_chunk_diffs(
+    chunked_articles: list[ChunkedArticle],
+) -> list[ChunkedArticleDiff]:
     """
-    Work out what chunks for this article are new or deleted, this is based on the chunk hash not the index
-    There are no modified chunks, a modified chunk is both a deleted and a new chunk
+    Work out what chunks for each article in the batch are new or deleted, this is based on the chunk hash not the
+    index. There are no modified chunks, a modified chunk is both a deleted and a new chunk.
 
+    The previous metadata is taken from the chunk_hash_cache if we have it, otherwise the metadata for all the
+    articles is read from the db in one request, and only the chunks_metadata is returned, not the
+    suggested_question_chunks. Returns a diff for each article in the same order.
     """
+    # if the collections are rotated while we read, the diffs are against the previous pair, see store_article_diff()
+    metadata_collection = database.METADATA_COLLECTION
+
+    # keyed on the article url, which is the _id of the metadata doc
+    prev_chunks_metadata: dict[str, dict[str, ChunkMetadata]] = {}
+    missing_urls: set[str] = set()
+    for chunked_article in chunked_articles:
+        url = chunked_article.article.metadata.url
+        cached = chunk_hash_cache.get(url)
+        if cached is None:
+            missing_urls.add(url)
+        else:
+            prev_chunks_metadata[url] = cached
+
+    if missing_urls:
+        logging.debug(f"Reading previous metadata for {len(missing_urls)} articles")
+        # the articles stored while we read are newer than what we read, fill() does not put them
+        cache_version = chunk_hash_cache.version()
+        prev_metadata_docs = await metadata_collection.find(
+            filter={"_id": {"$in": list(missing_urls)}},
+            projection={"chunks_metadata": True},
+        ).to_list()
+        # the cache is cleared if the collections are rotated while we read, fill() does not put the previous pair
+        for doc in prev_metadata_docs:
+            prev_chunks_metadata[doc["_id"]] = {
+                chunk_hash: ChunkMetadata(**chunk_meta)
+                for chunk_hash, chunk_meta in doc.get("chunks_metadata", {}).items()
+            }
+            chunk_hash_cache.fill(
+                doc["_id"], prev_chunks_metadata[doc["_id"]], cache_version
+            )
+
+    return [
+        await _diff_chunked_article(
+            chunked_article,
+            prev_chunks_metadata.get(chunked_article.article.metadata.url),
+            metadata_collection.name,
+        )
+        for chunked_article in chunked_articles
+    ]
 
+
+async def _diff_chunked_article(
+    chunked_article: ChunkedArticle,
+    prev_chunks_metadata: Optional[dict[str, ChunkMetadata]],
+    diffed_against: str,
+) -> ChunkedArticleDiff:
     new_metadata: ChunkedArticleMetadataOnly = (
         ChunkedArticleMetadataOnly.from_chunked_article(chunked_article)
     )
@@ -86,43 +165,38 @@ async def calc_chunk_diff(chunked_article: ChunkedArticle) -> ChunkedArticleDiff
     logging.debug(
         f"Calculating chunk delta for article {chunked_article.article.metadata.url}"
     )
-    # get the existing chunks from the db
-    prev_metadata_doc = await METADATA_COLLECTION.find_one(
-        filter={"_id": new_metadata._id}
-    )
 
-    if not prev_metadata_doc:
+    if prev_chunks_metadata is None:
         logging.debug("No previous metadata, all chunks are new")
         await METRICS.update_chunks(chunk_diff_new=len(chunked_article.chunks))
         return ChunkedArticleDiff(
-            chunked_article=chunked_article, new_chunks=chunked_article.chunks
+            chunked_article=chunked_article,
+            new_chunks=chunked_article.chunks,
+            diffed_against=diffed_against,
         )
     # We found existing article metadata, see if anything has changed
     await METRICS.update_database(articles_read=1)
-    prev_metadata: ChunkedArticleMetadataOnly = ChunkedArticleMetadataOnly.from_dict(  # type: ignore[attr-defined]
-        prev_metadata_doc
-    )
 
     logging.debug(
-        f"Found previous metadata with {len(prev_metadata.chunks_metadata)} chunks, comparing"
+        f"Found previous metadata with {len(prev_chunks_metadata)} chunks, comparing"
     )
 
     # we compare chunks using the hash, not the index
     new_chunks: list[Chunk] = [
         chunk
         for chunk in chunked_article.chunks
-        if chunk.metadata.hash not in prev_metadata.chunks_metadata.keys()
+        if chunk.metadata.hash not in prev_chunks_metadata.keys()
     ]
     # Can only record metadata for the deleted chunks (not the chunks) because we only store metadata about the chunks
     deleted_chunks: list[ChunkMetadata] = [
         chunk_meta
-        for chunk_meta in prev_metadata.chunks_metadata.values()
+        for chunk_meta in prev_chunks_metadata.values()
         if chunk_meta.hash not in new_metadata.chunks_metadata.keys()
     ]
     unchanged_chunks: list[Chunk] = [
         chunk
         for chunk in chunked_article.chunks
-        if chunk.metadata.hash in prev_metadata.chunks_metadata.keys()
+        if chunk.metadata.hash in prev_chunks_metadata.keys()
     ]
     await METRICS.update_chunks(
         chunk_diff_new=len(new_chunks),
@@ -138,24 +212,47 @@ async def calc_chunk_diff(chunked_article: ChunkedArticle) -> ChunkedArticleDiff
         new_chunks=new_chunks,
         deleted_chunks=deleted_chunks,
         unchanged_chunks=unchanged_chunks,
+        diffed_against=diffed_against,
     )
 
 
-async def vectorize_diff(
-    article_diff: ChunkedArticleDiff,
-) -> VectoredChunkedArticleDiff | None:
-    """Calc the vectors for all the chunks we want to store in the db"""
+async def vectorize_diffs(
+    article_diffs: list[ChunkedArticleDiff],
+) -> list[VectoredChunkedArticleDiff | None]:
+    """Calc the vectors for the new chunks in a batch of articles using a single call to get the embeddings.
+
+    Returns a result for each article in the same order, None if the article should be skipped.
+    """
 
+    all_chunks: list[Chunk] = [
+        chunk for article_diff in article_diffs for chunk in article_diff.new_chunks
+    ]
     logging.debug(
-        f"Getting embeddings for article {article_diff.chunked_article.article.metadata.url} "
-        "which has {len(article_diff.new_chunks)} new chunks"
+        f"Getting embeddings for {len(article_diffs)} articles which have {len(all_chunks)} new chunks"
     )
 
-    vectors = await embeddings.get_embeddings(
-        [chunk.content for chunk in article_diff.new_chunks]
+    all_vectors: list[list[float]] = (
+        await embeddings.get_cached_embeddings(
+            [chunk.content for chunk in all_chunks],
+            [chunk.metadata.hash for chunk in all_chunks],
+        )
+        if all_chunks
+        else []
     )
-    await METRICS.update_chunks(chunks_vectorized=len(vectors))
+    await METRICS.update_chunks(chunks_vectorized=len(all_vectors))
 
+    results: list[VectoredChunkedArticleDiff | None] = []
+    offset: int = 0
+    for article_diff in article_diffs:
+        vectors = all_vectors[offset : offset + len(article_diff.new_chunks)]
+        offset += len(article_diff.new_chunks)
+        results.append(await _to_vectored_diff(article_diff, vectors))
+    return results
+
+
+async def _to_vectored_diff(
+    article_diff: ChunkedArticleDiff, vectors: list[list[float]]
+) -> VectoredChunkedArticleDiff | None:
     # We can get vectors with all zeros, this could be because overloaded or objectionable content
     # this will be rare, so count the non zero vectors and if we have any zero vectors skip the article
     non_zero_vectors = list(vector for vector in vectors if any(x != 0 for x in vector))
@@ -184,86 +281,126 @@ async def vectorize_diff(
             )
         ],
         deleted_chunks=article_diff.deleted_chunks,
+        unchanged_chunks=article_diff.unchanged_chunks,
+        diffed_against=article_diff.diffed_against,
     )
 
 
 async def store_article_diff(
     article_diff: VectoredChunkedArticleDiff,
-) -> VectoredChunkedArticleDiff:
-    # HACK - update the meta data first, if there is an error we will fail before we insert the chunks
-    # this is not ideal, but I think it will reduce the amount of chunk collisions under load
-    await update_article_metadata(article_diff)
-    await insert_vectored_chunks(article_diff.new_chunks)
-    await delete_vectored_chunks(article_diff.deleted_chunks)
+) -> VectoredChunkedArticleDiff | None:
+    """Store the diff, returns None if the article was skipped.
 
+    The collections can be rotated by another worker at any time. If the diff was calculated against the previous
+    pair, or they are rotated while we are storing, the new pair may have none of the article so it is stored again
+    with every chunk new.
+    """
+    while True:
+        metadata_collection_name = database.METADATA_COLLECTION.name
+        if article_diff.diffed_against != metadata_collection_name:
+            logging.debug(
+                f"Collections rotated since article {article_diff.chunked_article.article.metadata.url} was diffed, storing all chunks"
+            )
+            maybe_diff = await _all_chunks_new(article_diff, metadata_collection_name)
+            if maybe_diff is None:
+                return None
+            article_diff = maybe_diff
+
+        # The new and deleted chunks are different hashes, so they can be written at the same time
+        await asyncio.gather(
+            insert_vectored_chunks(article_diff.new_chunks),
+            delete_vectored_chunks(article_diff.deleted_chunks),
+        )
+        # The metadata is only updated once the chunks have landed, if writing them fails the next time we see the
+        # article it is compared to the old metadata and the chunks are written again.
+        await update_article_metadata(article_diff)
+        if database.METADATA_COLLECTION.name == metadata_collection_name:
+            break
+
+    # only now is it safe to skip fetching the article again until it changes
+    wikipedia.record_stored(article_diff.chunked_article.article.metadata)
     return article_diff
 
 
-async def insert_vectored_chunks(vectored_chunks: list[VectoredChunk]) -> None:
-    # special logger to catch any places where we try to overwrite an existing chunk in the db
-    existing_chunk_logger = logging.getLogger("existing_chunks")
+async def _all_chunks_new(
+    article_diff: VectoredChunkedArticleDiff, diffed_against: str
+) -> VectoredChunkedArticleDiff | None:
+    """The diff with every chunk of the article new, vectorizing the chunks that were unchanged"""
+    vectors: list[list[float]] = (
+        await embeddings.get_cached_embeddings(
+            [chunk.content for chunk in article_diff.unchanged_chunks],
+            [chunk.metadata.hash for chunk in article_diff.unchanged_chunks],
+        )
+        if article_diff.unchanged_chunks
+        else []
+    )
+    await METRICS.update_chunks(chunks_vectorized=len(vectors))
+    unchanged_diff = await _to_vectored_diff(
+        ChunkedArticleDiff(
+            chunked_article=article_diff.chunked_article,
+            new_chunks=article_diff.unchanged_chunks,
+        ),
+        vectors,
+    )
+    if unchanged_diff is None:
+        return None
+    return VectoredChunkedArticleDiff(
+        chunked_article=article_diff.chunked_article,
+        new_chunks=article_diff.new_chunks + unchanged_diff.new_chunks,
+        diffed_against=diffed_against,
+    )
 
-    batch_size = 20
-    logging.debug(
-        f"Starting inserting {len(vectored_chunks)} vectored chunks into db using batches of {batch_size}"
+
+def start_embedding_writer(max_wait_ms: int) -> None:
+    """Start coalescing the inserts for all articles into batches of STORE_SETTINGS.batch_size
+
+    A batch is written when it is full or max_wait_ms after the first chunk was added to it, with up to
+    STORE_SETTINGS.max_in_flight batches in flight at once. Call stop_embedding_writer() when finished.
+    """
+    global _EMBEDDING_WRITER
+    if _EMBEDDING_WRITER is not None:
+        raise Exception("Embedding writer already started")
+    _EMBEDDING_WRITER = BatchWriter(
+        _insert_batch,
+        batch_size=STORE_SETTINGS.batch_size,
+        max_wait_ms=max_wait_ms,
+        max_in_flight=STORE_SETTINGS.max_in_flight,
     )
+    _EMBEDDING_WRITER.start()
 
-    start_all = datetime.now()
-    batch: list[VectoredChunk]
-    for batch_count, batch in batch_list(
-        vectored_chunks, batch_size, enumerate_batches=True
-    ):
-        start_batch = datetime.now()
-        article_embeddings: list[EmbeddingDocument] = list(
-            map(EmbeddingDocument.from_vectored_chunk, batch)
-        )
 
-        logging.debug(f"Inserting batch number {batch_count} with size {len(batch)}")
-        try:
-            await EMBEDDINGS_COLLECTION.insert_many(
-                [
-                    article_embedding.to_dict()  # type: ignore[attr-defined]
-                    for article_embedding in article_embeddings
-                ],
-            )
-        except CollectionInsertManyException as err:
-            # check that the error is solely due to already-existing documents
-            if any(
-                not isinstance(in_err, DataAPIResponseException)
-                for in_err in err.exceptions
-            ):
-                logging.error(
-                    f"Got non DOCUMENT_ALREADY_EXISTS errors, stopping: {err}"
-                )
-                raise
-            # here, can assume all in err.exceptions is a DataAPIResponseException:
-            error_codes = [
-                err_desc.error_code
-                for in_err in cast(list[DataAPIResponseException], err.exceptions)
-                for err_desc in in_err.error_descriptors
-            ]
-            if set(error_codes) - {DOCUMENT_ALREADY_EXISTS_API_ERROR_CODE} == set():
-                # We are OK with DOCUMENT_ALREADY_EXISTS errors
-                logging.debug(
-                    f"Got {len(error_codes)} DOCUMENT_ALREADY_EXISTS errors, ignoring."
-                )
-                await METRICS.update_database(chunk_collision=len(error_codes))
-
-                inserted_ids = err.inserted_ids
-                for article_embedding in article_embeddings:
-                    if article_embedding._id not in inserted_ids:
-                        # remove the vector, it will be too big to log
-                        doc = article_embedding.to_dict()  # type: ignore[attr-defined]
-                        doc.pop("$vector", None)
-                        existing_chunk_logger.warning(doc)
-            else:
-                logging.error(
-                    f"Got non DOCUMENT_ALREADY_EXISTS errors, stopping: {err}"
-                )
-                raise
+async def stop_embedding_writer() -> None:
+    global _EMBEDDING_WRITER
+    if _EMBEDDING_WRITER is None:
+        return
+    writer, _EMBEDDING_WRITER = _EMBEDDING_WRITER, None
+    await writer.stop()
+
 
+async def insert_vectored_chunks(vectored_chunks: list[VectoredChunk]) -> None:
+    article_embeddings: list[EmbeddingDocument] = list(
+        map(EmbeddingDocument.from_vectored_chunk, vectored_chunks)
+    )
+
+    start_all = datetime.now()
+    if _EMBEDDING_WRITER is not None:
+        logging.debug(
+            f"Starting inserting {len(vectored_chunks)} vectored chunks into db using the embedding writer"
+        )
+        await _EMBEDDING_WRITER.write(article_embeddings)
+    else:
+        batch_size = STORE_SETTINGS.batch_size
         logging.debug(
-            f"Finished inserting batch number {batch_count} duration {datetime.now() - start_batch}"
+            f"Starting inserting {len(vectored_chunks)} vectored chunks into db using batches of {batch_size}"
+        )
+        await gather_bounded(
+            (
+                _insert_batch(batch_count, batch)
+                for batch_count, batch in batch_list(
+                    article_embeddings, batch_size, enumerate_batches=True
+                )
+            ),
+            STORE_SETTINGS.max_in_flight,
         )
 
     await METRICS.update_database(chunks_inserted=len(vectored_chunks))
@@ -272,28 +409,102 @@ async def insert_vectored_chunks(vectored_chunks: list[VectoredChunk]) -> None:
     )
 
 
+async def _insert_batch(
+    batch_count: int, article_embeddings: list[EmbeddingDocument]
+) -> None:
+    start_batch = datetime.now()
+    logging.debug(
+        f"Inserting batch number {batch_count} with size {len(article_embeddings)}"
+    )
+    await METRICS.update_database(insert_requests=1)
+    try:
+        await database.EMBEDDINGS_COLLECTION.insert_many(
+            [
+                article_embedding.to_dict()  # type: ignore[attr-defined]
+                for article_embedding in article_embeddings
+            ],
+        )
+    except CollectionInsertManyException as err:
+        # check that the error is solely due to already-existing documents
+        if any(
+            not isinstance(in_err, DataAPIResponseException)
+            for in_err in err.exceptions
+        ):
+            logging.error(f"Got non DOCUMENT_ALREADY_EXISTS errors, stopping: {err}")
+            raise
+        # here, can assume all in err.exceptions is a DataAPIResponseException:
+        error_codes = [
+            err_desc.error_code
+            for in_err in cast(list[DataAPIResponseException], err.exceptions)
+            for err_desc in in_err.error_descriptors
+        ]
+        if set(error_codes) - {DOCUMENT_ALREADY_EXISTS_API_ERROR_CODE} == set():
+            # We are OK with DOCUMENT_ALREADY_EXISTS errors
+            logging.debug(
+                f"Got {len(error_codes)} DOCUMENT_ALREADY_EXISTS errors, ignoring."
+            )
+            await METRICS.update_database(chunk_collision=len(error_codes))
+            _log_existing_chunks(article_embeddings, err.inserted_ids)
+        else:
+            logging.error(f"Got non DOCUMENT_ALREADY_EXISTS errors, stopping: {err}")
+            raise
+    except DuplicateDocumentsError as err:
+        # the same as DOCUMENT_ALREADY_EXISTS from Astra, when using the local database
+        logging.debug(f"Got {len(err.duplicate_ids)} duplicate documents, ignoring.")
+        await METRICS.update_database(chunk_collision=len(err.duplicate_ids))
+        _log_existing_chunks(article_embeddings, err.inserted_ids)
+
+    logging.debug(
+        f"Finished inserting batch number {batch_count} duration {datetime.now() - start_batch}"
+    )
+
+
+def _log_existing_chunks(
+    article_embeddings: list[EmbeddingDocument], inserted_ids: list
+) -> None:
+    # special logger to catch any places where we try to overwrite an existing chunk in the db
+    existing_chunk_logger = logging.getLogger("existing_chunks")
+    for article_embedding in article_embeddings:
+        if article_embedding._id not in inserted_ids:
+            # remove the vector, it will be too big to log
+            doc = article_embedding.to_dict()  # type: ignore[attr-defined]
+            doc.pop("$vector", None)
+            existing_chunk_logger.warning(doc)
+
+
 async def delete_vectored_chunks(chunks: list[ChunkMetadata]) -> None:
-    batch_size = 20
+    batch_size = STORE_SETTINGS.batch_size
     logging.debug(
         f"Starting deleting {len(chunks)} article embedding chunks into db using batches of {batch_size}"
     )
 
     start_all = datetime.now()
-    for batch_count, batch in batch_list(chunks, batch_size, enumerate_batches=True):
-        start_batch = datetime.now()
-        logging.debug(f"Deleting batch number {batch_count} with size {len(batch)}")
-        await EMBEDDINGS_COLLECTION.delete_many(
-            filter={"_id": {"$in": [chunk.hash for chunk in batch]}}
-        )
-        logging.debug(
-            f"Finished deleting batch number {batch_count} duration {datetime.now() - start_batch}"
-        )
+    await gather_bounded(
+        (
+            _delete_batch(batch_count, batch)
+            for batch_count, batch in batch_list(
+                chunks, batch_size, enumerate_batches=True
+            )
+        ),
+        STORE_SETTINGS.max_in_flight,
+    )
     await METRICS.update_database(chunks_deleted=len(chunks))
     logging.debug(
         f"Finished deleting {len(chunks)} article embeddings total duration {datetime.now() - start_all}"
     )
 
 
+async def _delete_batch(batch_count: int, batch: list[ChunkMetadata]) -> None:
+    start_batch = datetime.now()
+    logging.debug(f"Deleting batch number {batch_count} with size {len(batch)}")
+    await database.EMBEDDINGS_COLLECTION.delete_many(
+        filter={"_id": {"$in": [chunk.hash for chunk in batch]}}
+    )
+    logging.debug(
+        f"Finished deleting batch number {batch_count} duration {datetime.now() - start_batch}"
+    )
+
+
 async def update_article_metadata(vectored_diff: VectoredChunkedArticleDiff) -> None:
     new_metadata: ChunkedArticleMetadataOnly = (
         ChunkedArticleMetadataOnly.from_vectored_diff(vectored_diff)
@@ -302,27 +513,21 @@ async def update_article_metadata(vectored_diff: VectoredChunkedArticleDiff) ->
         f"Updating article metadata for article url {new_metadata.article_metadata.url}"
     )
 
-    await METADATA_COLLECTION.find_one_and_replace(
+    await database.METADATA_COLLECTION.find_one_and_replace(
         filter={"_id": new_metadata._id},
         replacement=new_metadata.to_dict(),  # type: ignore[attr-defined]
         upsert=True,
     )
+    chunk_hash_cache.put(new_metadata._id, new_metadata.chunks_metadata)
 
-    # TODO COmment
-    recent_articles: RecentArticles = await RECENT_ARTICLES.update_and_clone(
-        new_metadata
-    )
-    await SUGGESTIONS_COLLECTION.find_one_and_replace(
-        filter={"_id": recent_articles._id},
-        replacement=recent_articles.to_dict(),  # type: ignore[attr-defined]
-        upsert=True,
-    )
+    # The recent articles are used by the app to suggest questions, the document is written in the background
+    await suggestions.update_recent_articles(new_metadata)
     await METRICS.update_database(articles_inserted=1)
     await METRICS.update_article(recent_url=new_metadata.article_metadata.url)
 
 
 async def process_article_metadata(
-    pipeline: AsyncPipeline, article_metadata: list[ArticleMetadata]
+    pipeline: AsyncPipeline, article_metadata: Iterable[ArticleMetadata]
 ) -> bool:
     """Process the article metadata into the DB
 
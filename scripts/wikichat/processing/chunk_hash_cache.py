@@ -0,0 +1,207 @@
+"""
+An in process cache of the chunks metadata for the articles we have stored, keyed on the article url.
+
+:func:`~wikichat.processing.articles.update_article_metadata` writes through to the cache after writing the
+metadata to the db, and :func:`~wikichat.processing.articles.calc_chunk_diffs` reads from it first and only reads
+the db for articles that are not in the cache. This saves reading the metadata for popular articles that are
+edited many times while we are listening.
+
+The db read can finish after a newer version of the article has been put, so calc_chunk_diffs records the cache
+:func:`version` before it reads and fills the cache with :func:`fill`, which skips the articles put or discarded
+since that version.
+
+The cache is only valid for the metadata collection it was filled from, it must be cleared when the collection is
+truncated or rotated, and an article discarded from it when its metadata is deleted. It can be saved to a file when
+the pipeline stops and loaded again when it starts, the file records the collection name so we do not load a cache
+for a different collection. The file is deleted when the cache is opened, so a run that is killed before it saves
+the cache does not leave a file that is out of date with the collection.
+
+Call :func:`open_cache` to enable the cache, the other functions do nothing when it is not open.
+"""
+
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Optional
+
+from wikichat.processing.model import ChunkMetadata
+from wikichat.utils.checkpoint import write_json_atomic
+
+
+class ChunkHashCache:
+    """Least recently used cache of article url to the metadata for its chunks, keyed on the chunk hash.
+
+    Only the index and length of each chunk are kept with the hash, so it is much smaller than the metadata doc.
+    """
+
+    def __init__(self, max_entries: int, collection_name: str):
+        self.max_entries: int = max_entries
+        self.collection_name: str = collection_name
+        # url -> chunk hash -> (index, length)
+        self._articles: OrderedDict[str, dict[str, tuple[int, int]]] = OrderedDict()
+        # incremented when an article is put or discarded, or the cache cleared
+        self._version: int = 0
+        # url -> the version it was last put or discarded at, for the max_entries most recently changed articles
+        self._changed: OrderedDict[str, int] = OrderedDict()
+        # the articles not in _changed were last changed at or before this version
+        self._forgotten_version: int = 0
+
+    def __len__(self) -> int:
+        return len(self._articles)
+
+    def get(self, url: str) -> Optional[dict[str, ChunkMetadata]]:
+        chunks = self._articles.get(url)
+        if chunks is None:
+            return None
+        self._articles.move_to_end(url)
+        return {
+            chunk_hash: ChunkMetadata(index=index, length=length, hash=chunk_hash)
+            for chunk_hash, (index, length) in chunks.items()
+        }
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def put(self, url: str, chunks_metadata: dict[str, ChunkMetadata]) -> None:
+        self._changed_now(url)
+        self._articles[url] = {
+            chunk_hash: (chunk_meta.index, chunk_meta.length)
+            for chunk_hash, chunk_meta in chunks_metadata.items()
+        }
+        self._articles.move_to_end(url)
+        while len(self._articles) > self.max_entries:
+            self._articles.popitem(last=False)
+
+    def fill(
+        self, url: str, chunks_metadata: dict[str, ChunkMetadata], read_version: int
+    ) -> None:
+        """Put the metadata read from the db, unless the article was put or discarded after read_version"""
+        if self._changed.get(url, self._forgotten_version) > read_version:
+            return
+        self.put(url, chunks_metadata)
+
+    def discard(self, url: str) -> None:
+        self._changed_now(url)
+        self._articles.pop(url, None)
+
+    def clear(self) -> None:
+        self._version += 1
+        self._changed.clear()
+        self._forgotten_version = self._version
+        self._articles.clear()
+
+    def _changed_now(self, url: str) -> None:
+        self._version += 1
+        self._changed[url] = self._version
+        self._changed.move_to_end(url)
+        while len(self._changed) > self.max_entries:
+            _, self._forgotten_version = self._changed.popitem(last=False)
+
+    def save(self, path: str) -> None:
+        # articles are saved oldest first so the LRU order is kept when loading
+        write_json_atomic(
+            path, {"collection_name": self.collection_name, "articles": self._articles}
+        )
+
+    def load(self, path: str) -> None:
+        with open(path, mode="r") as file:
+            saved = json.load(file)
+        if saved.get("collection_name") != self.collection_name:
+            logging.info(
+                f"Ignoring chunk hash cache {path}, it is for collection {saved.get('collection_name')} not {self.collection_name}"
+            )
+            return
+        for url, chunks in saved.get("articles", {}).items():
+            self._articles[url] = {
+                chunk_hash: (index, length)
+                for chunk_hash, (index, length) in chunks.items()
+            }
+        while len(self._articles) > self.max_entries:
+            self._articles.popitem(last=False)
+
+
+_CACHE: Optional[ChunkHashCache] = None
+_CACHE_PATH: Optional[str] = None
+
+
+def open_cache(
+    max_entries: int,
+    collection_name: str,
+    path: Optional[str] = None,
+    load_saved: bool = True,
+) -> None:
+    """Open the cache for the metadata collection.
+
+    If there is a path the cache is saved there by close_cache(), and loaded from there now if load_saved. Open the
+    cache before changing the collections, e.g. truncating them.
+    """
+    global _CACHE, _CACHE_PATH
+    if _CACHE is not None:
+        raise Exception("Chunk hash cache already open")
+    _CACHE = ChunkHashCache(max_entries, collection_name)
+    _CACHE_PATH = path
+    if path and load_saved and os.path.exists(path):
+        try:
+            _CACHE.load(path)
+        except Exception:
+            logging.exception(
+                f"Error loading chunk hash cache {path}, starting empty", exc_info=True
+            )
+            _CACHE.clear()
+    if path and os.path.exists(path):
+        # until close_cache() saves it again the file may not match the collection
+        os.remove(path)
+    logging.info(f"Opened chunk hash cache with {len(_CACHE)} articles")
+
+
+def close_cache() -> None:
+    """Close the cache, saving it if it was opened with a path."""
+    global _CACHE, _CACHE_PATH
+    if _CACHE is None:
+        return
+    cache, path = _CACHE, _CACHE_PATH
+    _CACHE, _CACHE_PATH = None, None
+    if path:
+        cache.save(path)
+        logging.info(f"Saved chunk hash cache with {len(cache)} articles to {path}")
+
+
+def get(url: str) -> Optional[dict[str, ChunkMetadata]]:
+    """Get the chunks metadata for the article, None if it is not in the cache"""
+    return _CACHE.get(url) if _CACHE is not None else None
+
+
+def put(url: str, chunks_metadata: dict[str, ChunkMetadata]) -> None:
+    if _CACHE is not None:
+        _CACHE.put(url, chunks_metadata)
+
+
+def version() -> int:
+    """The version to pass to fill() for metadata read from the db after now"""
+    return _CACHE.version if _CACHE is not None else 0
+
+
+def fill(
+    url: str, chunks_metadata: dict[str, ChunkMetadata], read_version: int
+) -> None:
+    """Put the metadata read from the db, unless the article was put, discarded or the cache cleared since
+    read_version"""
+    if _CACHE is not None:
+        _CACHE.fill(url, chunks_metadata, read_version)
+
+
+def discard(url: str) -> None:
+    """Remove the article, call when its metadata is deleted"""
+    if _CACHE is not None:
+        _CACHE.discard(url)
+
+
+def clear(collection_name: Optional[str] = None) -> None:
+    """Clear the cache, call when the metadata collection is truncated or rotated to the collection_name"""
+    if _CACHE is not None:
+        _CACHE.clear()
+        if collection_name:
+            _CACHE.collection_name = collection_name
+        logging.info("Cleared chunk hash cache")
@@ -0,0 +1,118 @@
+"""
+A local cache of embeddings keyed on the model, input type and the hash of the text that was embedded.
+
+Chunks are identified by the SHA-256 of their content, see :class:`~wikichat.processing.model.ChunkMetadata`, so
+when we see the same chunk again (after a collection rotation, a reload with --truncate_first, or an edit that is
+reverted) we can re-use the vector rather than calling Cohere again.
+
+The cache is a SQLite file with least recently used eviction once it holds more than max_entries vectors.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+
+class EmbeddingCache:
+    """SQLite backed cache of embeddings, safe to call from multiple threads."""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path: str = path
+        self.max_entries: int = max_entries
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # we are called using asyncio.to_thread() so the connection is shared between threads, the lock
+        # serialises access to it
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                input_type TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, input_type, text_hash)
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+        self._count: int = self._conn.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()[0]
+        logging.info(
+            f"Opened embedding cache {path} with {self._count} entries, max entries {max_entries}"
+        )
+
+    def get_many(
+        self, model: str, input_type: str, text_hashes: list[str]
+    ) -> dict[str, list[float]]:
+        """Get the vectors we have for the hashes, the returned dict only contains the hashes that were found."""
+        if not text_hashes:
+            return {}
+
+        found: dict[str, list[float]] = {}
+        unique_hashes = list(set(text_hashes))
+        with self._lock:
+            # SQLite limits the number of host parameters, so look up in batches
+            for offset in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[offset : offset + 500]
+                rows = self._conn.execute(
+                    f"""SELECT text_hash, vector FROM embeddings
+                    WHERE model = ? AND input_type = ? AND text_hash IN ({",".join("?" * len(batch))})""",
+                    [model, input_type, *batch],
+                ).fetchall()
+                for text_hash, vector in rows:
+                    found[text_hash] = array("d", vector).tolist()
+
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND input_type = ? AND text_hash = ?",
+                    [(time.time(), model, input_type, h) for h in found],
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(
+        self, model: str, input_type: str, vectors: dict[str, list[float]]
+    ) -> None:
+        """Add the vectors keyed on the text hash, evicting the least recently used if we are over max_entries"""
+        if not vectors:
+            return
+
+        now = time.time()
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?, ?)",
+                [
+                    (model, input_type, h, array("d", vector).tobytes(), now)
+                    for h, vector in vectors.items()
+                ],
+            )
+            self._count += self._conn.total_changes - before
+
+            if self._count > self.max_entries:
+                evict = self._count - self.max_entries
+                self._conn.execute(
+                    """DELETE FROM embeddings WHERE rowid IN (
+                        SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?
+                    )""",
+                    (evict,),
+                )
+                self._count -= evict
+                logging.debug(f"Evicted {evict} entries from the embedding cache")
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+        logging.info(f"Closed embedding cache {self.path} with {self._count} entries")
@@ -2,27 +2,71 @@
 Initialise and call the Cohere client to get embeddings
 """
 
+import asyncio
 import logging
 import os
-from typing import List
+from typing import TYPE_CHECKING, Any, List, Optional
 
-import cohere
 from dotenv import load_dotenv
 
-EMBED_RESULT_TYPE = cohere.types.embed_response.EmbeddingsByTypeEmbedResponse
+from wikichat.processing.embedding_cache import EmbeddingCache
+from wikichat.utils.metrics import METRICS
+
+if TYPE_CHECKING:
+    # cohere takes a while to import, it is imported when the client is first used
+    from cohere.types.embed_response import EmbeddingsByTypeEmbedResponse
 
 load_dotenv()
 
-COHERE_CLIENT = cohere.AsyncClient(os.getenv("COHERE_API_KEY"))
 EMBEDDING_MODEL = "embed-english-v3.0"
 
+# Made on first use so the key is only needed when we call Cohere, see use_client()
+_CLIENT: Optional[Any] = None
+
+# Optional cache of the embeddings we have already calculated, see open_cache()
+_CACHE: Optional[EmbeddingCache] = None
+
+
+def use_client(client: Optional[Any]) -> None:
+    """Use this client rather than the Cohere client, e.g. the stand-in used by the bench command.
+
+    It only needs the embed() call, None goes back to the Cohere client.
+    """
+    global _CLIENT
+    _CLIENT = client
+
+
+def _client() -> Any:
+    global _CLIENT
+    if _CLIENT is None:
+        import cohere
+
+        _CLIENT = cohere.AsyncClient(os.getenv("COHERE_API_KEY"))
+    return _CLIENT
+
+
+def open_cache(path: str, max_entries: int) -> None:
+    """Open the cache used by get_cached_embeddings(), call close_cache() when finished."""
+    global _CACHE
+    if _CACHE is not None:
+        raise Exception("Embedding cache already open")
+    _CACHE = EmbeddingCache(path, max_entries)
+
+
+def close_cache() -> None:
+    global _CACHE
+    if _CACHE is None:
+        return
+    cache, _CACHE = _CACHE, None
+    cache.close()
+
 
 async def get_embeddings(
     texts: list[str], input_type: str = "search_document"
 ) -> list[list[float]]:
     try:
         # Cohere client will batch up the texts to the size it wants, so send all the chunks at once
-        response: EMBED_RESULT_TYPE = await COHERE_CLIENT.embed(  # type: ignore[assignment]
+        response: EmbeddingsByTypeEmbedResponse = await _client().embed(  # type: ignore[assignment]
             texts=texts,
             model=EMBEDDING_MODEL,
             input_type=input_type,
@@ -36,3 +80,47 @@ async def get_embeddings(
     float_lists: List[List[float]] = response.embeddings.float  # type: ignore[attr-defined]
     assert len(float_lists) == len(texts)
     return float_lists
+
+
+async def get_cached_embeddings(
+    texts: list[str], text_hashes: list[str], input_type: str = "search_document"
+) -> list[list[float]]:
+    """Get the embeddings for the texts, only calling Cohere for the texts that are not in the cache.
+
+    text_hashes must be the hash of each text, e.g. the chunk hash. Works the same as get_embeddings() if the
+    cache is not open.
+    """
+    assert len(texts) == len(text_hashes)
+    cache = _CACHE
+    if cache is None:
+        return await get_embeddings(texts, input_type=input_type)
+
+    cached: dict[str, list[float]] = await asyncio.to_thread(
+        cache.get_many, EMBEDDING_MODEL, input_type, text_hashes
+    )
+
+    # the same text may be in the batch more than once, only embed it once
+    missing: dict[str, str] = {
+        text_hash: text
+        for text, text_hash in zip(texts, text_hashes)
+        if text_hash not in cached
+    }
+    # repeats of a missing text in the batch are neither hits nor misses, they are only sent to Cohere once
+    await METRICS.update_chunks(
+        embedding_cache_hits=sum(1 for text_hash in text_hashes if text_hash in cached),
+        embedding_cache_misses=len(missing),
+    )
+
+    if missing:
+        vectors = await get_embeddings(list(missing.values()), input_type=input_type)
+        new_vectors = dict(zip(missing.keys(), vectors))
+        cached.update(new_vectors)
+        # do not cache zero vectors, they are a failure we want to retry next time
+        await asyncio.to_thread(
+            cache.put_many,
+            EMBEDDING_MODEL,
+            input_type,
+            {h: v for h, v in new_vectors.items() if any(x != 0 for x in v)},
+        )
+
+    return [cached[text_hash] for text_hash in text_hashes]
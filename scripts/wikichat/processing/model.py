@@ -5,6 +5,7 @@ These should be plain data classes, and should not import other parts of the wik
 """
 
 import asyncio
+import time
 from typing import Optional
 from dataclasses import dataclass, field, replace
 
@@ -22,6 +23,18 @@ class ArticleMetadata:
 
     url: str
     title: Optional[str] = None
+    # the revision id from the edit event, if we are processing the article because it was edited
+    revision: Optional[int] = None
+    # the line in the links file we read the article from during a bulk load, not stored in the db
+    source_line: Optional[int] = field(
+        default=None, metadata=config(exclude=lambda _: True)
+    )
+    # the validators from the response the article was scraped from, remembered once the article is stored so the
+    # next fetch can be conditional, see wikipedia.record_stored(), not stored in the db
+    etag: Optional[str] = field(default=None, metadata=config(exclude=lambda _: True))
+    last_modified: Optional[str] = field(
+        default=None, metadata=config(exclude=lambda _: True)
+    )
 
 
 @dataclass
@@ -65,6 +78,8 @@ class ChunkedArticleDiff:
     new_chunks: list[Chunk] = field(default_factory=list)
     deleted_chunks: list[ChunkMetadata] = field(default_factory=list)
     unchanged_chunks: list[Chunk] = field(default_factory=list)
+    # the metadata collection the previous chunks were read from, the collections can be rotated before it is stored
+    diffed_against: Optional[str] = None
 
 
 @dataclass
@@ -83,6 +98,9 @@ class VectoredChunkedArticleDiff:
     chunked_article: ChunkedArticle
     new_chunks: list[VectoredChunk] = field(default_factory=list)
     deleted_chunks: list[ChunkMetadata] = field(default_factory=list)
+    # not vectorized, kept in case the article has to be stored in full, see store_article_diff()
+    unchanged_chunks: list[Chunk] = field(default_factory=list)
+    diffed_against: Optional[str] = None
 
 
 # ======================================================================================================================
@@ -102,6 +120,8 @@ class ChunkedArticleMetadataOnly:
     chunks_metadata: dict[str, ChunkMetadata] = field(default_factory=dict)
     # the recent chunks we can use to build a suggested question for the user
     suggested_question_chunks: list[Chunk] = field(default_factory=list)
+    # when the article was stored, seconds since the epoch, used to delete the oldest articles see retention.py
+    ingested_at: float = field(default_factory=time.time)
 
     @classmethod
     def from_chunked_article(
@@ -150,6 +170,8 @@ class EmbeddingDocument:
     # vector needs to be $vector when sent to the DB
     # see https://lidatong.github.io/dataclasses-json/#encode-or-decode-using-a-different-name
     vector: list[float] = field(metadata=config(field_name="$vector"))
+    # when the chunk was stored, seconds since the epoch
+    ingested_at: float = field(default_factory=time.time)
 
     @classmethod
     def from_vectored_chunk(cls, vectored_chunk: VectoredChunk) -> "EmbeddingDocument":
@@ -191,10 +213,15 @@ class RecentArticles:
         self._lock = asyncio.Lock()
 
     async def update_and_clone(
-        self, article: Optional[ChunkedArticleMetadataOnly], clear_list: bool = False
+        self,
+        article: Optional[ChunkedArticleMetadataOnly],
+        clear_list: bool = False,
+        embedding_collection: Optional[str] = None,
     ) -> "RecentArticles":
         max_recent_articles: int = 5
         async with self._lock:
+            if embedding_collection is not None:
+                self.embedding_collection = embedding_collection
             # allow None because it is called like this when switching collections
             if article is not None:
                 self.recent_articles = [
@@ -0,0 +1,240 @@
+"""
+Keeps the collections from growing to hold all of wikipedia by deleting the articles that were stored longest ago,
+an alternative to rotating the collections that keeps the articles that are still being edited.
+
+The metadata doc and the embedding docs for an article record when it was stored in ``ingested_at``, seconds since
+the epoch. When the sweeper is started with :func:`start_sweeper` a background task runs every sweep interval, it
+deletes the articles that have not been stored for max_age_secs, then if the embeddings collection has more than
+max_chunks documents it deletes the oldest articles until it is under. Articles are deleted batch_size at a time, the
+metadata docs first and then the chunks, using the same batches as the store step.
+
+The Data API only sorts a limited number of documents in memory, so the collection is not sorted to find the oldest
+articles. The sweeper bisects on ``ingested_at`` to find the oldest scan window with articles in it, deletes them in
+any order, and moves on to the next window. Articles stored before ``ingested_at`` was added count as stored now, they
+are deleted last and the field is set when they are next stored.
+
+The pipeline reads the metadata of an article to work out which chunks to store, so the sweeper skips the articles
+that are in the pipeline, see :func:`article_started`, and the pipeline waits for an article that is being deleted
+before it loads it again.
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Any, Optional
+
+from wikichat import database
+from wikichat.processing import chunk_hash_cache
+from wikichat.processing.model import ChunkMetadata
+from wikichat.utils.metrics import METRICS
+
+# the articles stored within this many seconds of each other are as old as each other when deleting the oldest
+_SCAN_WINDOW_SECS = 60.0
+
+# the number of times each article is in the pipeline, keyed on url, from when it starts loading until it leaves
+_IN_FLIGHT: Counter[str] = Counter()
+# the articles being deleted, set when the batch they are in has been deleted
+_DELETING: dict[str, asyncio.Event] = {}
+
+
+async def article_started(url: str) -> None:
+    """Called when the pipeline starts loading the article, waits if it is being deleted. Call article_done() when
+    it leaves the pipeline."""
+    deleting = _DELETING.get(url)
+    if deleting is not None:
+        await deleting.wait()
+    _IN_FLIGHT[url] += 1
+
+
+def article_done(url: str) -> None:
+    _IN_FLIGHT[url] -= 1
+    if _IN_FLIGHT[url] <= 0:
+        del _IN_FLIGHT[url]
+
+
+class RetentionSweeper:
+    """Deletes the oldest articles every sweep_interval_secs, max_age_secs and max_chunks are off when 0"""
+
+    def __init__(
+        self,
+        max_chunks: int,
+        max_age_secs: float,
+        sweep_interval_secs: float,
+        batch_size: int,
+    ):
+        self.max_chunks: int = max_chunks
+        self.max_age_secs: float = max_age_secs
+        self.sweep_interval_secs: float = sweep_interval_secs
+        self.batch_size: int = batch_size
+        self._task: Optional[asyncio.Task] = None
+        # set by stop(), the sweep finishes the batch it is deleting rather than being cancelled part way through
+        self._stopping = asyncio.Event()
+
+    def start(self) -> None:
+        if self._task is not None:
+            raise Exception("Retention sweeper already started")
+        self._task = asyncio.create_task(self._run(), name="retention_sweeper")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._stopping.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def sweep(self) -> None:
+        if self.max_age_secs > 0:
+            expired_before = time.time() - self.max_age_secs
+            while not self._stopping.is_set():
+                articles, _ = await self._delete_batch(
+                    filter={"ingested_at": {"$lt": expired_before}}
+                )
+                if not articles:
+                    break
+
+        if self.max_chunks > 0:
+            # the estimate is not updated straight away, so count down the chunks we delete
+            excess_chunks = (
+                await database.EMBEDDINGS_COLLECTION.estimated_document_count()
+                - self.max_chunks
+            )
+            scanned_to = 0.0
+            while excess_chunks > 0 and not self._stopping.is_set():
+                window_end = await self._oldest_window_end(scanned_to)
+                if window_end is None:
+                    break
+                excess_chunks -= await self._delete_excess(
+                    {"ingested_at": {"$gte": scanned_to, "$lt": window_end}},
+                    excess_chunks,
+                )
+                scanned_to = window_end
+            await self._delete_excess(
+                {"ingested_at": {"$exists": False}}, excess_chunks
+            )
+
+    async def _delete_excess(self, filter: dict[str, Any], excess_chunks: int) -> int:
+        """Delete the articles that match the filter until excess_chunks are deleted, returns the chunks deleted"""
+        deleted_chunks = 0
+        while deleted_chunks < excess_chunks and not self._stopping.is_set():
+            articles, chunks = await self._delete_batch(filter=filter)
+            if not articles:
+                break
+            deleted_chunks += chunks
+        return deleted_chunks
+
+    async def _oldest_window_end(self, stored_from: float) -> Optional[float]:
+        """Returns the end of the oldest scan window stored from stored_from that has articles in it, None if there
+        are no articles.
+
+        Searches on ingested_at with find_one so it works on collections larger than the Data API sorts in memory,
+        doubling the range from stored_from until it has articles in it and then bisecting it.
+        """
+        stored_to = time.time() + _SCAN_WINDOW_SECS
+        start, size = stored_from, _SCAN_WINDOW_SECS
+        while not await self._stored_between(start, min(start + size, stored_to)):
+            if start + size >= stored_to:
+                return None
+            start, size = start + size, size * 2
+        end = min(start + size, stored_to)
+        while end - start > _SCAN_WINDOW_SECS:
+            middle = (start + end) / 2
+            if await self._stored_between(start, middle):
+                end = middle
+            else:
+                start = middle
+        return end
+
+    async def _stored_between(self, start: float, end: float) -> bool:
+        doc = await database.METADATA_COLLECTION.find_one(
+            filter={"ingested_at": {"$gte": start, "$lt": end}},
+            projection={"_id": True},
+        )
+        return doc is not None
+
+    async def _delete_batch(self, filter: dict[str, Any]) -> tuple[int, int]:
+        """Delete up to batch_size articles, returns the number of articles and chunks deleted.
+
+        The articles in the pipeline are skipped, if every article found is in the pipeline nothing is deleted.
+        """
+        # imported here so importing this module does not import the steps and the HTTP client they use
+        from wikichat.processing import wikipedia
+        from wikichat.processing.articles import delete_vectored_chunks
+
+        metadata_docs = await database.METADATA_COLLECTION.find(
+            filter=filter,
+            projection={"chunks_metadata": True},
+            limit=self.batch_size,
+        ).to_list()
+        # no await from checking the articles in the pipeline to marking them as deleting, see article_started()
+        metadata_docs = [doc for doc in metadata_docs if doc["_id"] not in _IN_FLIGHT]
+        if not metadata_docs:
+            return 0, 0
+        urls = [doc["_id"] for doc in metadata_docs]
+        deleted = asyncio.Event()
+        for url in urls:
+            _DELETING[url] = deleted
+
+        try:
+            chunks = [
+                ChunkMetadata(**chunk_metadata)
+                for doc in metadata_docs
+                for chunk_metadata in doc.get("chunks_metadata", {}).values()
+            ]
+            logging.debug(
+                f"Retention deleting {len(urls)} articles with {len(chunks)} chunks"
+            )
+            # delete the metadata first, if deleting the chunks fails the article is stored in full when it is next
+            # edited
+            await database.METADATA_COLLECTION.delete_many(
+                filter={"_id": {"$in": urls}}
+            )
+            for url in urls:
+                chunk_hash_cache.discard(url)
+                wikipedia.forget(url)
+            await delete_vectored_chunks(chunks)
+        finally:
+            for url in urls:
+                del _DELETING[url]
+            deleted.set()
+        await METRICS.update_database(articles_expired=len(urls))
+        return len(urls), len(chunks)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._stopping.wait(), timeout=self.sweep_interval_secs
+                )
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.sweep()
+            except Exception:
+                logging.exception(
+                    "Error deleting the oldest articles, will retry", exc_info=True
+                )
+
+
+_SWEEPER: Optional[RetentionSweeper] = None
+
+
+def start_sweeper(
+    max_chunks: int, max_age_secs: float, sweep_interval_secs: float, batch_size: int
+) -> None:
+    """Start deleting the oldest articles in the background, call stop_sweeper() when finished"""
+    global _SWEEPER
+    if _SWEEPER is not None:
+        raise Exception("Retention sweeper already started")
+    _SWEEPER = RetentionSweeper(
+        max_chunks, max_age_secs, sweep_interval_secs, batch_size
+    )
+    _SWEEPER.start()
+
+
+async def stop_sweeper() -> None:
+    global _SWEEPER
+    if _SWEEPER is None:
+        return
+    sweeper, _SWEEPER = _SWEEPER, None
+    await sweeper.stop()
@@ -0,0 +1,119 @@
+"""
+Keeps the recent_articles document in the suggestions collection up to date.
+
+The recent articles are updated in memory for every article we store, see :data:`~wikichat.processing.model.RECENT_ARTICLES`.
+Writing the document every time means all the store workers write to the same document, which causes
+CONCURRENCY_FAILURE errors from the Data API. When the writer is started with :func:`start_writer` the document
+is written at most once every flush interval by a single background task, and once more when it is stopped.
+"""
+
+import asyncio
+import logging
+from typing import Optional
+
+from wikichat import database
+from wikichat.processing.model import (
+    ChunkedArticleMetadataOnly,
+    RECENT_ARTICLES,
+    RecentArticles,
+)
+
+# only one write to the document at a time
+_WRITE_LOCK = asyncio.Lock()
+
+
+class SuggestionsWriter:
+    """Writes the recent articles every flush_interval_secs if they have changed since the last write"""
+
+    def __init__(self, flush_interval_secs: float):
+        self.flush_interval_secs: float = flush_interval_secs
+        self._dirty: bool = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is not None:
+            raise Exception("Suggestions writer already started")
+        self._task = asyncio.create_task(self._run(), name="suggestions_writer")
+
+    async def stop(self) -> None:
+        """Stop the background task and write the recent articles one last time if they have changed"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def mark_dirty(self) -> None:
+        self._dirty = True
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            await _write()
+        except Exception:
+            # try again next time
+            self._dirty = True
+            raise
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval_secs)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception(
+                    "Error writing recent articles, will retry", exc_info=True
+                )
+
+
+_WRITER: Optional[SuggestionsWriter] = None
+
+
+def start_writer(flush_interval_secs: float) -> None:
+    """Start writing the recent articles in the background, call stop_writer() when finished"""
+    global _WRITER
+    if _WRITER is not None:
+        raise Exception("Suggestions writer already started")
+    _WRITER = SuggestionsWriter(flush_interval_secs)
+    _WRITER.start()
+
+
+async def stop_writer() -> None:
+    global _WRITER
+    if _WRITER is None:
+        return
+    writer, _WRITER = _WRITER, None
+    await writer.stop()
+
+
+async def update_recent_articles(
+    article: Optional[ChunkedArticleMetadataOnly],
+    clear_list: bool = False,
+    write_now: bool = False,
+    embedding_collection: Optional[str] = None,
+) -> None:
+    """Add the article to the recent articles, see RecentArticles.update_and_clone()
+
+    The document is written by the background writer if it is started and write_now is False, otherwise it is
+    written before returning. embedding_collection changes the collection the chat app searches.
+    """
+    await RECENT_ARTICLES.update_and_clone(
+        article, clear_list=clear_list, embedding_collection=embedding_collection
+    )
+    if _WRITER is not None and not write_now:
+        _WRITER.mark_dirty()
+        return
+    await _write()
+
+
+async def _write() -> None:
+    async with _WRITE_LOCK:
+        # clone inside the lock so we never overwrite a newer version of the recent articles
+        recent_articles: RecentArticles = await RECENT_ARTICLES.update_and_clone(None)
+        await database.SUGGESTIONS_COLLECTION.find_one_and_replace(
+            filter={"_id": recent_articles._id},
+            replacement=recent_articles.to_dict(),  # type: ignore[attr-defined]
+            upsert=True,
+        )
@@ -3,110 +3,254 @@ This module contains functions to read wikipedia articles
 """
 
 import logging
-import re
-from dataclasses import replace
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from typing import Optional
 
 import aiohttp
-from bs4 import BeautifulSoup, ResultSet as bs4ResultSet, Tag
 
 from wikichat.processing.model import ArticleMetadata, Article
+from wikichat.utils.cpu import run_cpu_bound
+from wikichat.utils.html_parsing import (
+    CONTENT_ELEMENT_ID,
+    ParsedPage,
+    parse_article_html,
+)
 from wikichat.utils.metrics import METRICS
 
-CONTENT_ELEMENT_ID = "mw-content-text"
-VALID_TAGS = ["p", "h1", "h2", "h3", "h4", "h5", "h6"]
-TITLE_ELEMENT_ID = "firstHeading"
 
-# Remove content inside square brackets and the brackets themselves
-PATTERN_SQUARE_BRACKETS = re.compile(r"\[.*?\]")
-PATTERN_UNWANTED_CHARS = re.compile(r'[^a-zA-Z0-9\s,"()[\]{}:]')
-PATTERN_SPACES = re.compile(r"\s+")
+@dataclass
+class _Validators:
+    """What we know about the last time we fetched a page, used to make a conditional request for it"""
+
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # the revision from the edit event that caused the fetch, if any
+    revision: Optional[int] = None
+
+    def request_headers(self) -> dict[str, str]:
+        headers: dict[str, str] = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class RevalidationCache:
+    """Least recently used cache of url to the validators from the last time we fetched the page"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries: int = max_entries
+        self._validators: OrderedDict[str, _Validators] = OrderedDict()
+
+    def get(self, url: str) -> Optional[_Validators]:
+        validators = self._validators.get(url)
+        if validators is not None:
+            self._validators.move_to_end(url)
+        return validators
+
+    def put(self, url: str, validators: _Validators) -> None:
+        self._validators[url] = validators
+        self._validators.move_to_end(url)
+        while len(self._validators) > self.max_entries:
+            self._validators.popitem(last=False)
+
+    def discard(self, url: str) -> None:
+        self._validators.pop(url, None)
+
+    def clear(self) -> None:
+        self._validators.clear()
+
+
+@dataclass
+class _FetchedPage:
+    html: bytes = b""
+    encoding: Optional[str] = None
+    validators: _Validators = field(default_factory=_Validators)
+    not_modified: bool = False
+
+
+# Shared by all the scraper workers so they re-use warm connections, see open_session()
+_SESSION: Optional[aiohttp.ClientSession] = None
+# Only used when the session is open, see open_session()
+_REVALIDATION_CACHE: Optional[RevalidationCache] = None
+
+
+async def open_session(
+    connections_per_host: int = 20,
+    dns_cache_secs: int = 300,
+    revalidation_cache_size: int = 0,
+) -> aiohttp.ClientSession:
+    """Open the long-lived session used by scrape_article(), call close_session() when finished.
+
+    The connector keeps connections alive between requests and caches DNS lookups, so the scraper workers do not
+    pay for a new connection, DNS lookup and TLS handshake for every article. aiohttp does not support HTTP/1.1
+    pipelining, so connections_per_host limits how many requests are in flight to a host at once.
+
+    If revalidation_cache_size is more than 0 we remember the ETag, Last-Modified and edit revision for that many
+    pages. Pages are then fetched with If-None-Match / If-Modified-Since, and an article that has not been
+    modified, or is for a revision we have already stored, is skipped. The validators are only recorded by
+    record_stored() once the article is stored, and must be forgotten when the article is deleted from the
+    database, see forget() and forget_all().
+    """
+    global _SESSION, _REVALIDATION_CACHE
+    if _SESSION is not None:
+        raise Exception("Session already open")
+    if revalidation_cache_size > 0:
+        _REVALIDATION_CACHE = RevalidationCache(revalidation_cache_size)
+
+    connector = aiohttp.TCPConnector(
+        limit=0,
+        limit_per_host=connections_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=dns_cache_secs,
+        keepalive_timeout=30,
+    )
+    _SESSION = aiohttp.ClientSession(connector=connector)
+    logging.debug(
+        f"Opened scraper session with {connections_per_host} connections per host"
+    )
+    return _SESSION
+
+
+async def close_session() -> None:
+    global _SESSION, _REVALIDATION_CACHE
+    if _SESSION is None:
+        return
+    session, _SESSION = _SESSION, None
+    _REVALIDATION_CACHE = None
+    await session.close()
+    logging.debug("Closed scraper session")
 
 
 async def scrape_article(meta: ArticleMetadata) -> Article | None:
-    """Loads the article content from the URL and cleans it up"""
+    """Loads the article content from the URL and cleans it up
+
+    Fetching is done on the event loop, parsing and cleaning the HTML is done in the CPU pool if it is started.
+    """
 
     logging.debug(f"Scraping article {meta.url}")
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(meta.url, allow_redirects=True) as response:
-                if response.status == 200:
-                    html: str = await response.text()
-                else:
-                    logging.error(
-                        f"Continuing after error fetching {meta.url}, unexpected status code {response.status}"
-                    )
-                    return None
-        except aiohttp.ClientError as e:
-            logging.error(f"Continuing after error fetching {meta.url} - {e}")
-            logging.debug(f"Continuing after error fetching {meta.url}", exc_info=True)
-            return None
+    revalidation_cache = _REVALIDATION_CACHE
+    prev_validators = revalidation_cache.get(meta.url) if revalidation_cache else None
+    if (
+        prev_validators is not None
+        and meta.revision is not None
+        and meta.revision == prev_validators.revision
+    ):
+        logging.debug(
+            f"Skipping article {meta.url} because we already stored revision {meta.revision}"
+        )
+        await METRICS.update_article(not_modified=1)
+        return None
+
+    headers = prev_validators.request_headers() if prev_validators else {}
+    if _SESSION is None:
+        # not running in a pipeline, use a session just for this article
+        async with aiohttp.ClientSession() as session:
+            fetched = await _fetch_html(session, meta, headers)
+    else:
+        fetched = await _fetch_html(_SESSION, meta, headers)
+    if fetched is None:
+        return None
+    if fetched.not_modified:
+        logging.debug(f"Skipping article {meta.url} because it was not modified")
+        await METRICS.update_article(not_modified=1)
+        return None
 
-    # lxml is faster but html5lib is more lenient with broken HTML.
-    # install the libraries with pip install  html5lib
-    soup: BeautifulSoup = BeautifulSoup(html, "lxml")
+    page: ParsedPage = await run_cpu_bound(
+        parse_article_html, meta.url, fetched.html, fetched.encoding
+    )
 
-    redirects_to = _redirects_to(meta, soup)
-    if redirects_to:
+    if page.redirects_to:
         # Do not process pages that direct to another,
         # because different articles with diff URLs have the same content and we get a bunch of chunk collisions
         logging.debug(
-            f"Skipping article {meta.url} because it redirects to {redirects_to}"
+            f"Skipping article {meta.url} because it redirects to {page.redirects_to}"
         )
         await METRICS.update_article(redirects=1)
         return None
 
-    content = soup.find(id=CONTENT_ELEMENT_ID)
-    if not content:
+    if page.content is None:
         logging.error(
             f"Continuing after error fetching {meta.url}, could not find content element {CONTENT_ELEMENT_ID}"
         )
         return None
 
-    # Remove images
-    if isinstance(content, Tag):
-        for img in content.find_all("img"):
-            img.decompose()
-
-    # Extract text content from specific tags
-    cleaned_content: str
-    if isinstance(content, Tag):
-        all_elements: bs4ResultSet = content.find_all(VALID_TAGS)
-        cleaned_content = " ".join([element.get_text() for element in all_elements])
-    else:
-        cleaned_content = ""
-    cleaned_content = PATTERN_SQUARE_BRACKETS.sub("", cleaned_content)
-    cleaned_content = PATTERN_UNWANTED_CHARS.sub("", cleaned_content)
-    cleaned_content = PATTERN_SPACES.sub(" ", cleaned_content)
-
-    logging.debug(f"Scraped article {meta.url} with {len(cleaned_content)} characters")
-    return Article(metadata=_maybe_update_metadata(meta, soup), content=cleaned_content)
-
-
-def _redirects_to(meta: ArticleMetadata, soup: BeautifulSoup) -> str | None:
-    # Next is handling wiki redirects, these are not normal HTTP 302 redirects
-    # see https://en.wikipedia.org/wiki/Wikipedia:Redirect
-    # Best I can find is look for <link rel="canonical" href="https://en.wikipedia.org/wiki/We_Are_the_World">
-    # Example is:
-    # https://en.wikipedia.org/wiki/USA_for_Africa redirects to https://en.wikipedia.org/wiki/We_Are_the_World
-    # Canonical will be the same as the URL for articles that do not redirect
-    canonical_link = soup.find("link", attrs={"rel": "canonical"})
-    new_url = (
-        str(canonical_link.get("href")) if isinstance(canonical_link, Tag) else None
+    logging.debug(f"Scraped article {meta.url} with {len(page.content)} characters")
+    return Article(
+        metadata=replace(
+            _maybe_update_metadata(meta, page.title),
+            etag=fetched.validators.etag,
+            last_modified=fetched.validators.last_modified,
+        ),
+        content=page.content,
     )
 
-    return new_url if new_url and new_url != meta.url else None
+
+def record_stored(meta: ArticleMetadata) -> None:
+    """Remember the validators the article was scraped with, call once the article has been stored.
+
+    Recording them any earlier would skip the next fetch of an article that failed or was skipped after it was
+    fetched.
+    """
+    if _REVALIDATION_CACHE is not None:
+        _REVALIDATION_CACHE.put(
+            meta.url,
+            _Validators(
+                etag=meta.etag,
+                last_modified=meta.last_modified,
+                revision=meta.revision,
+            ),
+        )
+
+
+def forget(url: str) -> None:
+    """Forget the validators for the article, call when it failed or was deleted so it is fetched in full next time"""
+    if _REVALIDATION_CACHE is not None:
+        _REVALIDATION_CACHE.discard(url)
+
+
+def forget_all() -> None:
+    """Forget the validators for every article, call when the collections are truncated or rotated"""
+    if _REVALIDATION_CACHE is not None:
+        _REVALIDATION_CACHE.clear()
+
+
+async def _fetch_html(
+    session: aiohttp.ClientSession, meta: ArticleMetadata, headers: dict[str, str]
+) -> _FetchedPage | None:
+    """Fetch the page, returning the raw bytes, the charset and the validators from the response"""
+    try:
+        async with session.get(
+            meta.url, allow_redirects=True, headers=headers
+        ) as response:
+            validators = _Validators(
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+            if response.status == 304:
+                return _FetchedPage(validators=validators, not_modified=True)
+            if response.status == 200:
+                return _FetchedPage(
+                    html=await response.read(),
+                    encoding=response.charset,
+                    validators=validators,
+                )
+            logging.error(
+                f"Continuing after error fetching {meta.url}, unexpected status code {response.status}"
+            )
+            return None
+    except aiohttp.ClientError as e:
+        logging.error(f"Continuing after error fetching {meta.url} - {e}")
+        logging.debug(f"Continuing after error fetching {meta.url}", exc_info=True)
+        return None
 
 
 def _maybe_update_metadata(
-    meta: ArticleMetadata, soup: BeautifulSoup
+    meta: ArticleMetadata, new_title: Optional[str]
 ) -> ArticleMetadata:
-    replace_meta = False
-    # first look for the wikipedia title element, this the title seen on the page and does not include the site name
-    # try the standard HTML title element, maybe not a wikipedia article
-    title_element = soup.find(id=TITLE_ELEMENT_ID) or soup.find("title")
-    new_title = title_element.get_text() if title_element else None
     if new_title and new_title != meta.title:
-        replace_meta = True
         logging.debug(f"Updating title for {meta.url} from {meta.title} to {new_title}")
-
-    return replace(meta, title=new_title) if replace_meta else meta
+        return replace(meta, title=new_title)
+    return meta
@@ -1,4 +1,5 @@
-from typing import Any, Generator
+import asyncio
+from typing import Any, Awaitable, Generator, Iterable
 
 
 def batch_list(
@@ -14,3 +15,18 @@ def batch_list(
             batch_count += 1
         else:
             yield full_list[offset : offset + batch_size]
+
+
+async def gather_bounded(
+    aws: Iterable[Awaitable[Any]], max_in_flight: int
+) -> list[Any]:
+    """
+    Like asyncio.gather() but only awaits max_in_flight of the awaitables at a time, results are in the same order.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_in_flight))
+
+    async def _bounded(aw: Awaitable[Any]) -> Any:
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(_bounded(aw) for aw in aws))
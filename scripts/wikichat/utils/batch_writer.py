@@ -0,0 +1,120 @@
+"""
+Coalesces small writes from many callers into full batches.
+
+Used by :mod:`wikichat.processing.articles` to insert the chunks from many articles into the embeddings collection
+with fewer requests, see :func:`~wikichat.processing.articles.start_embedding_writer`.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+
+class BatchWriter:
+    """Buffers items from all callers of :meth:`write` and calls the flush_func with batches of them.
+
+    A batch is flushed when the buffer has batch_size items, or max_wait_ms after the first item was buffered,
+    with up to max_in_flight flushes running at once. :meth:`write` returns once all of the callers items have been
+    flushed, and raises the error if the flush of any of them failed.
+    """
+
+    def __init__(
+        self,
+        flush_func: Callable[[int, list[Any]], Awaitable[None]],
+        batch_size: int,
+        max_wait_ms: int,
+        max_in_flight: int,
+    ):
+        self._flush_func = flush_func
+        self.batch_size: int = batch_size
+        self.max_wait_ms: int = max_wait_ms
+        self.flush_count: int = 0
+
+        self._buffer: list[tuple[Any, asyncio.Future]] = []
+        self._not_empty = asyncio.Event()
+        self._full = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(max(1, max_in_flight))
+        self._flush_tasks: set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is not None:
+            raise Exception("Writer already started")
+        self._task = asyncio.create_task(self._run(), name="batch_writer")
+
+    async def stop(self) -> None:
+        """Flush anything still buffered and wait for all flushes to finish."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while self._buffer:
+            await self._flush_next()
+        await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    async def write(self, items: list[Any]) -> None:
+        if not items:
+            return
+        loop = asyncio.get_running_loop()
+        futures: list[asyncio.Future] = []
+        for item in items:
+            future = loop.create_future()
+            future.add_done_callback(_retrieve_exception)
+            self._buffer.append((item, future))
+            futures.append(future)
+        self._not_empty.set()
+        if len(self._buffer) >= self.batch_size:
+            self._full.set()
+        await asyncio.gather(*futures)
+
+    async def _run(self) -> None:
+        while True:
+            await self._not_empty.wait()
+            if len(self._buffer) < self.batch_size:
+                try:
+                    await asyncio.wait_for(
+                        self._full.wait(), timeout=self.max_wait_ms / 1000
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush_next()
+
+    async def _flush_next(self) -> None:
+        # wait for a free slot before taking the batch, so it fills up while we wait
+        await self._semaphore.acquire()
+        batch = self._buffer[: self.batch_size]
+        self._buffer = self._buffer[self.batch_size :]
+        if len(self._buffer) < self.batch_size:
+            self._full.clear()
+        if not self._buffer:
+            self._not_empty.clear()
+        if not batch:
+            self._semaphore.release()
+            return
+
+        self.flush_count += 1
+        task = asyncio.create_task(self._flush(self.flush_count, batch))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self, flush_count: int, batch: list[tuple[Any, asyncio.Future]]):
+        try:
+            await self._flush_func(flush_count, [item for item, _ in batch])
+        except Exception as e:
+            logging.debug(f"Error flushing batch {flush_count}", exc_info=True)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            self._semaphore.release()
+
+
+def _retrieve_exception(future: asyncio.Future) -> None:
+    # a failed flush sets the error on the futures of every caller in the batch, mark it retrieved so a future no
+    # caller awaits is not logged as never retrieved when it is garbage collected
+    if not future.cancelled():
+        future.exception()
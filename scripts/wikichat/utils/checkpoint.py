@@ -0,0 +1,135 @@
+"""
+Checkpoints saved to local files so a command can carry on where it stopped.
+
+:class:`ListenerCheckpoint` records how far :func:`~wikichat.commands.pipeline.listen_for_changes` got through the
+Wikipedia changes stream, so it can ask the stream to resume from there after reconnecting or restarting.
+:class:`LoadCheckpoint` records the lines of the links file :func:`~wikichat.commands.pipeline.load_base_data` has
+finished with, so a load can be resumed with ``--resume``.
+"""
+
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+
+def write_json_atomic(path: str, doc: Any) -> None:
+    """Write the doc as JSON to a temp file and move it over the path, so the file is never half written"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode="w") as file:
+        json.dump(doc, file)
+    os.replace(tmp_path, path)
+
+
+def read_json(path: str) -> Optional[Any]:
+    """Read the JSON doc from the path, None if the file does not exist or cannot be read"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, mode="r") as file:
+            return json.load(file)
+    except Exception:
+        logging.exception(
+            f"Error reading checkpoint {path}, ignoring it", exc_info=True
+        )
+        return None
+
+
+@dataclass
+class ListenerCheckpoint:
+    """Position in the Wikipedia changes stream, every edit up to and including this event has left the pipeline.
+
+    last_event_id is the SSE event id, sent back to the stream in the Last-Event-ID header to resume after it.
+    event_timestamp is the unix time of the event, used to resume with the since parameter if we have no id.
+    """
+
+    last_event_id: Optional[str] = None
+    event_timestamp: Optional[float] = None
+
+    def is_empty(self) -> bool:
+        return not self.last_event_id and self.event_timestamp is None
+
+    def save(self, path: str) -> None:
+        write_json_atomic(
+            path,
+            {
+                "last_event_id": self.last_event_id,
+                "event_timestamp": self.event_timestamp,
+            },
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "ListenerCheckpoint":
+        saved = read_json(path)
+        if not isinstance(saved, dict):
+            return cls()
+        return cls(
+            last_event_id=saved.get("last_event_id"),
+            event_timestamp=saved.get("event_timestamp"),
+        )
+
+
+@dataclass
+class LoadCheckpoint:
+    """The lines of a links file that have been processed, line numbers start at 1.
+
+    Articles finish the pipeline out of order, so we keep done_through, the end of the unbroken run of processed
+    lines from the start of the file, and the processed lines after it. Those are saved as ranges, which stay short
+    because the only gaps after done_through are the articles still in the pipeline or that failed.
+    """
+
+    file_path: str
+    # every line up to and including this one has been processed
+    done_through: int = 0
+    _done_after: set[int] = field(default_factory=set)
+
+    def mark_done(self, line: int) -> None:
+        if line <= self.done_through:
+            return
+        self._done_after.add(line)
+        while self.done_through + 1 in self._done_after:
+            self.done_through += 1
+            self._done_after.remove(self.done_through)
+
+    def is_done(self, line: int) -> bool:
+        return line <= self.done_through or line in self._done_after
+
+    def done_ranges(self) -> list[tuple[int, int]]:
+        """The lines after done_through that have been processed, as inclusive (first, last) ranges"""
+        ranges: list[tuple[int, int]] = []
+        for line in sorted(self._done_after):
+            if ranges and ranges[-1][1] == line - 1:
+                ranges[-1] = (ranges[-1][0], line)
+            else:
+                ranges.append((line, line))
+        return ranges
+
+    def save(self, path: str) -> None:
+        write_json_atomic(
+            path,
+            {
+                "file_path": self.file_path,
+                "done_through": self.done_through,
+                "done_ranges": self.done_ranges(),
+            },
+        )
+
+    @classmethod
+    def load(cls, path: str, file_path: str) -> "LoadCheckpoint":
+        """Load the checkpoint for the links file, an empty checkpoint if the saved one is for a different file"""
+        checkpoint = cls(file_path=file_path)
+        saved = read_json(path)
+        if not isinstance(saved, dict):
+            return checkpoint
+        if saved.get("file_path") != file_path:
+            logging.info(
+                f"Ignoring load checkpoint {path}, it is for file {saved.get('file_path')} not {file_path}"
+            )
+            return checkpoint
+        checkpoint.done_through = saved.get("done_through", 0)
+        for first, last in saved.get("done_ranges", []):
+            checkpoint._done_after.update(range(first, last + 1))
+        return checkpoint
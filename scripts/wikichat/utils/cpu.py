@@ -0,0 +1,52 @@
+"""
+A process pool for the CPU bound parts of the pipeline, such as parsing HTML, so they do not block the event loop.
+
+Functions run in the pool must be picklable, so they need to be defined at the top level of a module. They should
+be in modules that do not import :mod:`wikichat.processing` or :mod:`wikichat.database`, because the worker
+processes import the module to find the function.
+
+The workers are started from a forkserver, or spawned where there is no forkserver, rather than forked, so they do
+not get a copy of the event loop, its threads and the open connections.
+
+If the pool has not been started the functions are called directly on the event loop.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+_EXECUTOR: Optional[ProcessPoolExecutor] = None
+
+
+def start_pool(max_workers: int) -> None:
+    """Start the process pool, call stop_pool() when finished"""
+    global _EXECUTOR
+    if _EXECUTOR is not None:
+        raise Exception("CPU pool already started")
+    start_method = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn"
+    )
+    _EXECUTOR = ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context(start_method)
+    )
+    logging.info(f"Started CPU pool with {max_workers} {start_method} workers")
+
+
+def stop_pool() -> None:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        return
+    executor, _EXECUTOR = _EXECUTOR, None
+    executor.shutdown(wait=True, cancel_futures=True)
+    logging.debug("Stopped CPU pool")
+
+
+async def run_cpu_bound(func: Callable[..., Any], *args: Any) -> Any:
+    """Call the func with the args in the process pool, or directly if the pool is not started"""
+    if _EXECUTOR is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(_EXECUTOR, func, *args)
@@ -0,0 +1,116 @@
+"""
+Collapses bursts of items with the same key into the last item of the burst.
+
+Used by :func:`~wikichat.commands.pipeline.listen_for_changes` so a page that is edited many times in quick
+succession, such as during a revert war or a live sports event, goes through the pipeline once with the latest
+edit rather than once for every edit.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+@dataclass
+class _Held:
+    item: Any
+    first_secs: float
+    last_secs: float
+    # from the first add() for the key
+    tag: Any = None
+
+
+class KeyedDebouncer:
+    """Holds the latest item for each key until there have been no new items for the key for quiet_secs, or the
+    first item for the key was held max_hold_secs ago, then calls the emit_func with it and its tag.
+
+    The emit_func returns False when it will not accept any more items, after that new items are dropped and
+    :attr:`accepting` is False.
+    """
+
+    def __init__(
+        self,
+        emit_func: Callable[[Any, Any], Awaitable[bool]],
+        quiet_secs: float,
+        max_hold_secs: float,
+    ):
+        self._emit_func = emit_func
+        self.quiet_secs: float = quiet_secs
+        self.max_hold_secs: float = max(quiet_secs, max_hold_secs)
+        self.accepting: bool = True
+
+        # dict keeps insertion order so items that are due at the same time are emitted in the order we first saw them
+        self._held: dict[Hashable, _Held] = {}
+        self._not_empty = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._held)
+
+    def start(self) -> None:
+        if self._task is not None:
+            raise Exception("Debouncer already started")
+        self._task = asyncio.create_task(self._run(), name="debouncer")
+
+    async def stop(self) -> None:
+        """Stop the background task and emit everything that is still held."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._emit_due(due_by=float("inf"))
+
+    def add(self, key: Hashable, item: Any, tag: Any = None) -> bool:
+        """Hold the item replacing any item already held for the key, returns True if it replaced an item.
+
+        The tag is kept from the first item added for the key, see :meth:`oldest_tag`.
+        """
+        if not self.accepting:
+            return False
+        now = time.monotonic()
+        held = self._held.get(key)
+        if held is not None:
+            held.item = item
+            held.last_secs = now
+            return True
+        self._held[key] = _Held(item=item, first_secs=now, last_secs=now, tag=tag)
+        self._not_empty.set()
+        return False
+
+    def oldest_tag(self) -> Any:
+        """The tag of the key that has been held the longest, None if nothing is held."""
+        for held in self._held.values():
+            return held.tag
+        return None
+
+    def _due_secs(self, held: _Held) -> float:
+        return min(
+            held.last_secs + self.quiet_secs, held.first_secs + self.max_hold_secs
+        )
+
+    async def _run(self) -> None:
+        while True:
+            await self._not_empty.wait()
+            # a new key is never due before the keys we already hold, and adding to a key only makes it due later,
+            # so we can sleep until the earliest key is due without being woken by add()
+            next_due = min(self._due_secs(held) for held in self._held.values())
+            delay = next_due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self._emit_due(due_by=time.monotonic())
+            except Exception:
+                logging.exception("Error emitting debounced items", exc_info=True)
+
+    async def _emit_due(self, due_by: float) -> None:
+        due_keys = [
+            key for key, held in self._held.items() if self._due_secs(held) <= due_by
+        ]
+        for key in due_keys:
+            held = self._held.pop(key)
+            if self.accepting and not await self._emit_func(held.item, held.tag):
+                self.accepting = False
+        if not self._held:
+            self._not_empty.clear()
@@ -0,0 +1,17 @@
+"""
+Errors raised by the wikichat utils, kept apart from the modules that raise them so code that only handles an error
+does not import the dependencies of the code that raises it.
+"""
+
+from typing import Any
+
+
+class DuplicateDocumentsError(Exception):
+    """Raised by insert_many() when documents with some of the ids already exist, the other documents are inserted"""
+
+    def __init__(self, inserted_ids: list[Any], duplicate_ids: list[Any]):
+        super().__init__(
+            f"{len(duplicate_ids)} documents already exist, inserted {len(inserted_ids)}"
+        )
+        self.inserted_ids: list[Any] = inserted_ids
+        self.duplicate_ids: list[Any] = duplicate_ids
@@ -0,0 +1,51 @@
+"""
+Decodes events from the Wikipedia recent changes stream.
+
+The stream has the changes to every wiki, and we only want edits to english Wikipedia articles which are a small
+fraction of them. :func:`might_be_article_edit` checks the raw event data with a regex so we only decode the events
+that could be edits to articles, and :func:`parse_event_data` uses orjson to decode them if it is installed.
+:func:`is_bot_event` lets the listener count the bot events it skipped without decoding them.
+
+Run :mod:`wikichat.benchmarks.events` to compare them with decoding every event with the json module.
+"""
+
+import json
+import re
+from typing import Any, Callable
+
+try:
+    import orjson  # type: ignore[import-not-found]
+
+    _loads: Callable[[str | bytes], Any] = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    _loads = json.loads
+    JSON_BACKEND = "json"
+
+# Wikipedia Recent Changes schema see
+# https://schema.wikimedia.org/repositories/primary/jsonschema/mediawiki/recentchange/latest.yaml
+_ENWIKI_RE = re.compile(r'"wiki"\s*:\s*"enwiki"')
+_ARTICLE_NAMESPACE_RE = re.compile(r'"namespace"\s*:\s*0\s*[,}]')
+_BOT_RE = re.compile(r'"bot"\s*:\s*true')
+
+
+def might_be_article_edit(data: str) -> bool:
+    """False if the raw event data is definitely not for an english Wikipedia article, without decoding it.
+
+    This can return True for events we do not want, the decoded event still needs to be checked. Canary events
+    are always let through so they are counted.
+    """
+    return (
+        _ENWIKI_RE.search(data) is not None
+        and _ARTICLE_NAMESPACE_RE.search(data) is not None
+    ) or '"canary"' in data
+
+
+def is_bot_event(data: str) -> bool:
+    """True if the raw event data is for an edit by a bot, without decoding it"""
+    return _BOT_RE.search(data) is not None
+
+
+def parse_event_data(data: str) -> Any:
+    """Decode the event data, raises ValueError if it is not valid JSON"""
+    return _loads(data)
@@ -0,0 +1,66 @@
+"""
+Fixed memory latency histograms, used by :class:`~wikichat.utils.pipeline.AsyncStep` to record how long items wait in
+the step queue and how long the step takes to process them.
+
+The buckets are the same for every histogram, so the counts from two snapshots can be subtracted to get the
+percentiles for the time between them, see :meth:`~wikichat.utils.metrics._Metrics.describe`.
+"""
+
+import bisect
+from typing import Optional
+
+# bucket upper bounds in seconds, from 50 microseconds to 10 minutes with each bucket 25% larger than the last,
+# so a percentile is at most 25% above the true value
+_MIN_SECS = 0.00005
+_MAX_SECS = 600.0
+_GROWTH = 1.25
+
+
+def _bucket_bounds() -> list[float]:
+    bounds = [_MIN_SECS]
+    while bounds[-1] < _MAX_SECS:
+        bounds.append(bounds[-1] * _GROWTH)
+    return bounds
+
+
+BUCKET_BOUNDS: list[float] = _bucket_bounds()
+
+
+class LatencyHistogram:
+    """Counts of durations in log spaced buckets, the last bucket counts everything over the largest bound."""
+
+    def __init__(self):
+        self.counts: list[int] = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.total: int = 0
+        self.sum_secs: float = 0.0
+
+    def record(self, secs: float) -> None:
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, secs)] += 1
+        self.total += 1
+        self.sum_secs += secs
+
+    def snapshot(self) -> list[int]:
+        return list(self.counts)
+
+    def since(self, previous: Optional[list[int]]) -> list[int]:
+        """The counts recorded since the previous snapshot"""
+        if previous is None:
+            return self.snapshot()
+        return [now - before for now, before in zip(self.counts, previous)]
+
+
+def percentile(counts: list[int], fraction: float) -> Optional[float]:
+    """The upper bound in seconds of the bucket the percentile falls in, None if there are no counts.
+
+    The fraction is between 0 and 1, e.g. 0.99 for the 99th percentile.
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = fraction * total
+    seen = 0
+    for i, count in enumerate(counts):
+        seen += count
+        if seen >= rank and count:
+            return BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else float("inf")
+    return float("inf")
@@ -0,0 +1,90 @@
+"""
+Parses and cleans the HTML for a wikipedia article.
+
+This is CPU bound, so :mod:`wikichat.processing.wikipedia` runs it in the pool from :mod:`wikichat.utils.cpu`.
+It only takes and returns plain values and does not import the rest of the application, so it is cheap to send to
+and import in the worker processes.
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from bs4 import BeautifulSoup, ResultSet as bs4ResultSet, Tag
+
+CONTENT_ELEMENT_ID = "mw-content-text"
+VALID_TAGS = ["p", "h1", "h2", "h3", "h4", "h5", "h6"]
+TITLE_ELEMENT_ID = "firstHeading"
+
+# Remove content inside square brackets and the brackets themselves
+PATTERN_SQUARE_BRACKETS = re.compile(r"\[.*?\]")
+PATTERN_UNWANTED_CHARS = re.compile(r'[^a-zA-Z0-9\s,"()[\]{}:]')
+PATTERN_SPACES = re.compile(r"\s+")
+
+
+@dataclass
+class ParsedPage:
+    """The parts of the page we need, content is None if the page did not have a content element"""
+
+    title: Optional[str] = None
+    content: Optional[str] = None
+    redirects_to: Optional[str] = None
+
+
+def parse_article_html(
+    url: str, html: bytes, encoding: Optional[str] = None
+) -> ParsedPage:
+    """Parse the page, returning the cleaned text content and title or the url it redirects to"""
+
+    # lxml is faster but html5lib is more lenient with broken HTML.
+    # install the libraries with pip install  html5lib
+    soup: BeautifulSoup = BeautifulSoup(html, "lxml", from_encoding=encoding)
+
+    redirects_to = _redirects_to(url, soup)
+    if redirects_to:
+        return ParsedPage(redirects_to=redirects_to)
+
+    title = _title(soup)
+    content = soup.find(id=CONTENT_ELEMENT_ID)
+    if not content:
+        return ParsedPage(title=title)
+
+    # Remove images
+    if isinstance(content, Tag):
+        for img in content.find_all("img"):
+            img.decompose()
+
+    # Extract text content from specific tags
+    cleaned_content: str
+    if isinstance(content, Tag):
+        all_elements: bs4ResultSet = content.find_all(VALID_TAGS)
+        cleaned_content = " ".join([element.get_text() for element in all_elements])
+    else:
+        cleaned_content = ""
+    cleaned_content = PATTERN_SQUARE_BRACKETS.sub("", cleaned_content)
+    cleaned_content = PATTERN_UNWANTED_CHARS.sub("", cleaned_content)
+    cleaned_content = PATTERN_SPACES.sub(" ", cleaned_content)
+
+    return ParsedPage(title=title, content=cleaned_content)
+
+
+def _redirects_to(url: str, soup: BeautifulSoup) -> str | None:
+    # Next is handling wiki redirects, these are not normal HTTP 302 redirects
+    # see https://en.wikipedia.org/wiki/Wikipedia:Redirect
+    # Best I can find is look for <link rel="canonical" href="https://en.wikipedia.org/wiki/We_Are_the_World">
+    # Example is:
+    # https://en.wikipedia.org/wiki/USA_for_Africa redirects to https://en.wikipedia.org/wiki/We_Are_the_World
+    # Canonical will be the same as the URL for articles that do not redirect
+    canonical_link = soup.find("link", attrs={"rel": "canonical"})
+    new_url = (
+        str(canonical_link.get("href")) if isinstance(canonical_link, Tag) else None
+    )
+
+    return new_url if new_url and new_url != url else None
+
+
+def _title(soup: BeautifulSoup) -> str | None:
+    # first look for the wikipedia title element, this the title seen on the page and does not include the site name
+    # try the standard HTML title element, maybe not a wikipedia article
+    title_element = soup.find(id=TITLE_ELEMENT_ID) or soup.find("title")
+    return title_element.get_text() if title_element else None
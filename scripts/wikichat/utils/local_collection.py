@@ -0,0 +1,465 @@
+"""
+A local database with collections that can be used in place of the Astra DB collections, see
+:mod:`wikichat.database` for how it is selected.
+
+The documents for all the collections are kept in one SQLite file, with the ``$vector`` of each document stored
+as float32. A ``$vector`` sort is a brute force cosine similarity over every vector in the collection using NumPy,
+the vectors are loaded into memory on the first sort after the collection changes.
+
+Only the parts of the Data API the wikichat code uses are supported:
+
+* Filters on fields with equality and the ``$in``, ``$nin``, ``$eq``, ``$ne``, ``$lt``, ``$lte``, ``$gt`` and ``$gte``
+  operators. Filters that only use ``_id`` are done in SQLite, others are checked against every document.
+* Inclusive or exclusive projections, with dotted paths into sub documents and lists of sub documents.
+* Sorting on ``$vector``, with ``include_similarity``, or on fields.
+
+The SQLite calls are made with :func:`asyncio.to_thread` so they do not block the event loop.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from typing import Any, AsyncIterator, Callable, Optional
+
+import numpy as np
+
+from wikichat.utils.errors import DuplicateDocumentsError
+
+# SQLite limits the number of host parameters, so look up ids in batches
+_MAX_PARAMS = 500
+
+_COMPARISONS: dict[str, Callable[[Any, Any], bool]] = {
+    "$eq": lambda value, arg: value == arg,
+    "$ne": lambda value, arg: value != arg,
+    "$in": lambda value, arg: value in arg,
+    "$nin": lambda value, arg: value not in arg,
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$lte": lambda value, arg: value is not None and value <= arg,
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$gte": lambda value, arg: value is not None and value >= arg,
+    "$exists": lambda value, arg: (value is not None) == bool(arg),
+}
+
+
+class LocalDatabase:
+    """The SQLite file the collections are stored in, safe to use from multiple threads."""
+
+    def __init__(self, path: str):
+        self.path: str = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the collections use asyncio.to_thread() so the connection is shared between threads, the lock
+        # serialises access to it
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.commit()
+        logging.info(f"Opened local database {path}")
+
+    def get_collection(self, name: str) -> "LocalCollection":
+        """Get the collection, creating it if it does not exist"""
+        with self._lock:
+            self._conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS "{name}" (
+                    id TEXT PRIMARY KEY,
+                    doc TEXT NOT NULL,
+                    vector BLOB
+                )"""
+            )
+            self._conn.commit()
+        return LocalCollection(self, name)
+
+    def list_collection_names(self) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ).fetchall()
+        return [name for (name,) in rows]
+
+    def drop_collection(self, name: str) -> None:
+        """Drop the collection and its documents, does nothing if it does not exist"""
+        with self._lock:
+            self._conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+        logging.info(f"Closed local database {self.path}")
+
+
+class LocalCursor:
+    """The documents found by LocalCollection.find(), read them with to_list() or async for"""
+
+    def __init__(self, read_func: Callable[[], list[dict[str, Any]]]):
+        self._read_func = read_func
+
+    async def to_list(self) -> list[dict[str, Any]]:
+        return await asyncio.to_thread(self._read_func)
+
+    async def __aiter__(self) -> AsyncIterator[dict[str, Any]]:
+        for doc in await self.to_list():
+            yield doc
+
+
+class LocalCollection:
+    """A collection in the LocalDatabase, has the same async methods as the astrapy AsyncCollection"""
+
+    def __init__(self, database: LocalDatabase, name: str):
+        self.name: str = name
+        self._database = database
+        # the ids and unit length vectors for $vector sorts, None when the collection has changed since they
+        # were loaded
+        self._vector_ids: Optional[list[str]] = None
+        self._vectors: Optional[np.ndarray] = None
+
+    # ==================================================================================================================
+    # Data API methods
+    # ==================================================================================================================
+
+    async def insert_many(self, documents: list[dict[str, Any]], **kwargs) -> None:
+        await asyncio.to_thread(self._insert_many, documents)
+
+    async def delete_many(self, filter: dict[str, Any], **kwargs) -> int:
+        """Delete the documents that match the filter, returns the number deleted"""
+        return await asyncio.to_thread(self._delete_many, filter)
+
+    async def find_one_and_replace(
+        self,
+        filter: dict[str, Any],
+        replacement: dict[str, Any],
+        upsert: bool = False,
+        **kwargs,
+    ) -> Optional[dict[str, Any]]:
+        """Replace the first document that matches the filter, returns the document before it was replaced"""
+        return await asyncio.to_thread(
+            self._find_one_and_replace, filter, replacement, upsert
+        )
+
+    def find(
+        self,
+        filter: Optional[dict[str, Any]] = None,
+        projection: Optional[dict[str, Any]] = None,
+        sort: Optional[dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        include_similarity: bool = False,
+        **kwargs,
+    ) -> LocalCursor:
+        return LocalCursor(
+            lambda: [
+                _project(doc, projection, include_similarity)
+                for doc in self._find(filter or {}, sort, limit)
+            ]
+        )
+
+    async def find_one(
+        self,
+        filter: Optional[dict[str, Any]] = None,
+        projection: Optional[dict[str, Any]] = None,
+        sort: Optional[dict[str, Any]] = None,
+        **kwargs,
+    ) -> Optional[dict[str, Any]]:
+        docs = await self.find(
+            filter, projection=projection, sort=sort, limit=1
+        ).to_list()
+        return docs[0] if docs else None
+
+    async def drop(self) -> None:
+        await asyncio.to_thread(self._database.drop_collection, self.name)
+        self._changed()
+
+    async def count_documents(self, filter: dict[str, Any], **kwargs) -> int:
+        return await asyncio.to_thread(lambda: len(self._find(filter, None, None)))
+
+    async def estimated_document_count(self, **kwargs) -> int:
+        return await asyncio.to_thread(self._count_rows)
+
+    # ==================================================================================================================
+    # Run in a thread
+    # ==================================================================================================================
+
+    def _insert_many(self, documents: list[dict[str, Any]]) -> None:
+        inserted_ids: list[Any] = []
+        duplicate_ids: list[Any] = []
+        with self._database._lock:
+            for doc in documents:
+                doc_id = doc.get("_id") or str(uuid.uuid4())
+                cursor = self._database._conn.execute(
+                    f'INSERT OR IGNORE INTO "{self.name}" VALUES (?, ?, ?)',
+                    _to_row(doc_id, doc),
+                )
+                if cursor.rowcount:
+                    inserted_ids.append(doc_id)
+                else:
+                    duplicate_ids.append(doc_id)
+            self._database._conn.commit()
+            self._changed()
+        if duplicate_ids:
+            raise DuplicateDocumentsError(inserted_ids, duplicate_ids)
+
+    def _delete_many(self, filter: dict[str, Any]) -> int:
+        with self._database._lock:
+            if not filter:
+                deleted = self._database._conn.execute(
+                    f'DELETE FROM "{self.name}"'
+                ).rowcount
+            else:
+                ids = [doc["_id"] for doc in self._find_unlocked(filter)]
+                deleted = 0
+                for offset in range(0, len(ids), _MAX_PARAMS):
+                    batch = ids[offset : offset + _MAX_PARAMS]
+                    deleted += self._database._conn.execute(
+                        f'DELETE FROM "{self.name}" WHERE id IN ({",".join("?" * len(batch))})',
+                        batch,
+                    ).rowcount
+            self._database._conn.commit()
+            self._changed()
+        return deleted
+
+    def _count_rows(self) -> int:
+        with self._database._lock:
+            (count,) = self._database._conn.execute(
+                f'SELECT COUNT(*) FROM "{self.name}"'
+            ).fetchone()
+        return count
+
+    def _find_one_and_replace(
+        self, filter: dict[str, Any], replacement: dict[str, Any], upsert: bool
+    ) -> Optional[dict[str, Any]]:
+        with self._database._lock:
+            found = self._find_unlocked(filter, limit=1)
+            if not found and not upsert:
+                return None
+            previous: Optional[dict[str, Any]] = found[0] if found else None
+            if previous is not None:
+                doc_id = previous["_id"]
+            else:
+                doc_id = (
+                    filter.get("_id") or replacement.get("_id") or str(uuid.uuid4())
+                )
+            self._database._conn.execute(
+                f'INSERT OR REPLACE INTO "{self.name}" VALUES (?, ?, ?)',
+                _to_row(doc_id, replacement),
+            )
+            self._database._conn.commit()
+            self._changed()
+        return previous
+
+    def _find(
+        self,
+        filter: dict[str, Any],
+        sort: Optional[dict[str, Any]],
+        limit: Optional[int],
+    ) -> list[dict[str, Any]]:
+        with self._database._lock:
+            return self._find_unlocked(filter, sort, limit)
+
+    def _find_unlocked(
+        self,
+        filter: dict[str, Any],
+        sort: Optional[dict[str, Any]] = None,
+        limit: Optional[int] = None,
+    ) -> list[dict[str, Any]]:
+        if sort and "$vector" in sort:
+            return self._vector_search(filter, sort["$vector"], limit)
+
+        docs: list[dict[str, Any]] = [
+            doc for doc in self._candidate_docs(filter) if _matches(doc, filter)
+        ]
+        for field, direction in reversed(list((sort or {}).items())):
+            docs.sort(key=lambda doc: _sort_key(doc, field), reverse=direction < 0)
+        return docs[:limit] if limit else docs
+
+    def _candidate_docs(self, filter: dict[str, Any]) -> list[dict[str, Any]]:
+        """The docs that may match the filter, only the docs with the ids if the filter is on _id"""
+        match filter.get("_id"):
+            case {"$in": list(ids)} if len(filter["_id"]) == 1:
+                return self._docs_by_id(ids)
+            case str(doc_id):
+                return self._docs_by_id([doc_id])
+        rows = self._database._conn.execute(
+            f'SELECT id, doc, vector FROM "{self.name}"'
+        ).fetchall()
+        return [_from_row(*row) for row in rows]
+
+    def _docs_by_id(self, ids: list[str]) -> list[dict[str, Any]]:
+        docs: list[dict[str, Any]] = []
+        for offset in range(0, len(ids), _MAX_PARAMS):
+            batch = ids[offset : offset + _MAX_PARAMS]
+            rows = self._database._conn.execute(
+                f'SELECT id, doc, vector FROM "{self.name}" WHERE id IN ({",".join("?" * len(batch))})',
+                batch,
+            ).fetchall()
+            docs.extend(_from_row(*row) for row in rows)
+        return docs
+
+    def _vector_search(
+        self, filter: dict[str, Any], vector: list[float], limit: Optional[int]
+    ) -> list[dict[str, Any]]:
+        if self._vectors is None or self._vector_ids is None:
+            rows = self._database._conn.execute(
+                f'SELECT id, vector FROM "{self.name}" WHERE vector IS NOT NULL'
+            ).fetchall()
+            self._vector_ids = [row[0] for row in rows]
+            self._vectors = _unit_rows(
+                np.array(
+                    [np.frombuffer(row[1], dtype=np.float32) for row in rows],
+                    dtype=np.float32,
+                ).reshape(len(rows), -1)
+            )
+        if not self._vector_ids:
+            return []
+
+        query = _unit_rows(np.array([vector], dtype=np.float32))[0]
+        # cosine similarity scaled to 0..1 like the Data API $similarity
+        similarities = (self._vectors @ query + 1) / 2
+        ordered = np.argsort(-similarities)
+        docs: list[dict[str, Any]] = []
+        # read the documents in order of similarity until we have enough that match the filter
+        for offset in range(0, len(ordered), _MAX_PARAMS):
+            order = ordered[offset : offset + _MAX_PARAMS]
+            by_id = {
+                doc["_id"]: doc
+                for doc in self._docs_by_id([self._vector_ids[i] for i in order])
+            }
+            for i in order:
+                doc = by_id.get(self._vector_ids[i])
+                if doc is not None and _matches(doc, filter):
+                    docs.append({**doc, "$similarity": float(similarities[i])})
+                    if limit and len(docs) >= limit:
+                        return docs
+        return docs
+
+    def _changed(self) -> None:
+        self._vector_ids = None
+        self._vectors = None
+
+
+def _sort_key(doc: dict[str, Any], field: str) -> tuple[bool, Any]:
+    # None sorts before everything, like a missing field in the Data API
+    value = _get_path(doc, field)
+    return (False, 0) if value is None else (True, value)
+
+
+def _to_row(doc_id: Any, doc: dict[str, Any]) -> tuple[Any, str, Optional[bytes]]:
+    vector = doc.get("$vector")
+    body = {key: value for key, value in doc.items() if key != "$vector"}
+    body["_id"] = doc_id
+    return (
+        doc_id,
+        json.dumps(body),
+        None if vector is None else np.asarray(vector, dtype=np.float32).tobytes(),
+    )
+
+
+def _from_row(doc_id: Any, body: str, vector: Optional[bytes]) -> dict[str, Any]:
+    doc: dict[str, Any] = json.loads(body)
+    if vector is not None:
+        doc["$vector"] = np.frombuffer(vector, dtype=np.float32).tolist()
+    return doc
+
+
+def _unit_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _get_path(doc: dict[str, Any], path: str) -> Any:
+    value: Any = doc
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _matches(doc: dict[str, Any], filter: dict[str, Any]) -> bool:
+    for path, condition in filter.items():
+        value = _get_path(doc, path)
+        if isinstance(condition, dict) and any(
+            key.startswith("$") for key in condition
+        ):
+            for operator, arg in condition.items():
+                comparison = _COMPARISONS.get(operator)
+                if comparison is None:
+                    raise ValueError(
+                        f"Filter operator {operator} not supported by the local database"
+                    )
+                if not comparison(value, arg):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(
+    doc: dict[str, Any],
+    projection: Optional[dict[str, Any]],
+    include_similarity: bool = False,
+) -> dict[str, Any]:
+    """Apply the projection, $vector and $similarity are only included if they are asked for like the Data API"""
+    include_vector = bool(projection and projection.get("$vector"))
+    fields = {
+        path: bool(value)
+        for path, value in (projection or {}).items()
+        if path != "$vector"
+    }
+    doc = {
+        key: value
+        for key, value in doc.items()
+        if (key != "$vector" or include_vector)
+        and (key != "$similarity" or include_similarity)
+    }
+    if not fields:
+        return doc
+
+    include_id = fields.pop("_id", True)
+    if fields and all(fields.values()):
+        projected = _include_paths(doc, [path.split(".") for path in fields])
+        for key in ("$vector", "$similarity"):
+            if key in doc:
+                projected[key] = doc[key]
+    else:
+        projected = doc
+        for path, include in fields.items():
+            if not include:
+                _exclude_path(projected, path.split("."))
+    if include_id and "_id" in doc:
+        projected["_id"] = doc["_id"]
+    elif not include_id:
+        projected.pop("_id", None)
+    return projected
+
+
+def _include_paths(value: Any, paths: list[list[str]]) -> Any:
+    if isinstance(value, list):
+        return [_include_paths(item, paths) for item in value]
+    if not isinstance(value, dict):
+        return value
+    included: dict[str, Any] = {}
+    for key in dict.fromkeys(path[0] for path in paths):
+        if key not in value:
+            continue
+        sub_paths = [path[1:] for path in paths if path[0] == key]
+        if any(not sub_path for sub_path in sub_paths):
+            included[key] = value[key]
+        else:
+            included[key] = _include_paths(value[key], sub_paths)
+    return included
+
+
+def _exclude_path(value: Any, path: list[str]) -> None:
+    if isinstance(value, list):
+        for item in value:
+            _exclude_path(item, path)
+    elif isinstance(value, dict):
+        if len(path) == 1:
+            value.pop(path[0], None)
+        elif path[0] in value:
+            _exclude_path(value[path[0]], path[1:])
@@ -3,18 +3,29 @@ Metrics to track the progress of loading and listening to Wikipedia articles.
 
 Metrics should only be updated via the single METRICS object, which is a singleton.
 
+Everything runs on one event loop, so the ``update_*`` methods change the counters without a lock. They never await,
+so an update cannot be interleaved with another update or with taking a snapshot. They are still ``async`` so the
+callers do not change, and they must not be called from other threads. Run :mod:`wikichat.benchmarks.metrics` to see
+the cost of an update.
+
 The pipeline will create an async tak to call :meth:`~Metrics.metrics_reporter_task` to report the metrics every N seconds.
 """
 
 import asyncio
+import copy
 import json
 import logging
 import time
 from dataclasses import dataclass, field
 from datetime import timedelta
+from operator import attrgetter
 from typing import Any, Optional, Tuple
 
-from wikichat.utils.pipeline import AsyncPipeline
+from wikichat.utils.histogram import percentile
+from wikichat.utils.pipeline import AsyncPipeline, AsyncStep
+
+# the latency percentiles shown for each step
+PERCENTILES = (0.5, 0.95, 0.99)
 
 
 @dataclass
@@ -23,24 +34,33 @@ class ListenerMetrics:
     canary_events: int = 0
     bot_events: int = 0
     skipped_events: int = 0
+    prefiltered_events: int = 0
     enwiki_edits: int = 0
+    merged_edits: int = 0
+    catchup_edits: int = 0
+    live_edits: int = 0
+    # how old the last edit was when we got it
+    event_lag_secs: float = 0.0
 
 
 @dataclass
 class ArticleMetrics:
     redirects: int = 0
     zero_vectors: int = 0
+    not_modified: int = 0
     recent_urls: list[str] = field(default_factory=list)
 
 
 @dataclass
 class DBMetrics:
     chunks_inserted: int = 0
+    insert_requests: int = 0
     chunks_deleted: int = 0
     chunk_collision: int = 0
 
     articles_inserted: int = 0
     articles_read: int = 0
+    articles_expired: int = 0
 
 
 @dataclass
@@ -50,6 +70,8 @@ class Chunks:
     chunk_diff_deleted: int = 0
     chunk_diff_unchanged: int = 0
     chunks_vectorized: int = 0
+    embedding_cache_hits: int = 0
+    embedding_cache_misses: int = 0
 
 
 @dataclass
@@ -57,6 +79,21 @@ class RotatingCollections:
     rotations: int = 0
 
 
+@dataclass
+class MetricsSnapshot:
+    """A copy of the metrics at time_secs, see :meth:`_Metrics.snapshot`"""
+
+    time_secs: float
+    listener: ListenerMetrics = field(default_factory=ListenerMetrics)
+    database: DBMetrics = field(default_factory=DBMetrics)
+    chunks: Chunks = field(default_factory=Chunks)
+    rotating_collections: RotatingCollections = field(
+        default_factory=RotatingCollections
+    )
+    article: ArticleMetrics = field(default_factory=ArticleMetrics)
+    error_by_code: dict[str, int] = field(default_factory=dict)
+
+
 @dataclass
 class _Metrics:
     _listener: ListenerMetrics = field(default_factory=ListenerMetrics)
@@ -71,7 +108,11 @@ class _Metrics:
 
     def __post_init__(self):
         self._start_secs = time.time()
-        self._async_lock = asyncio.Lock()
+        # used by describe() to show the rates and latencies since the last report
+        self._last_report: Optional[MetricsSnapshot] = None
+        self._last_step_counts: dict[
+            str, tuple[Optional[list[int]], Optional[list[int]]]
+        ] = {}
 
     async def update_listener(
         self,
@@ -79,16 +120,26 @@ class _Metrics:
         canary_events: int = 0,
         bot_events: int = 0,
         skipped_events: int = 0,
+        prefiltered_events: int = 0,
         enwiki_edits: int = 0,
+        merged_edits: int = 0,
+        catchup_edits: int = 0,
+        live_edits: int = 0,
+        event_lag_secs: Optional[float] = None,
     ):
-        async with self._async_lock:
-            self._listener.total_events += total_events
-            self._listener.canary_events += canary_events
-            self._listener.bot_events += bot_events
-            self._listener.skipped_events += skipped_events
-            self._listener.enwiki_edits += enwiki_edits
-            return None
-            # return self._maybe_describe(pipeline=pipeline) if describe else None
+        self._listener.total_events += total_events
+        self._listener.canary_events += canary_events
+        self._listener.bot_events += bot_events
+        self._listener.skipped_events += skipped_events
+        self._listener.prefiltered_events += prefiltered_events
+        self._listener.enwiki_edits += enwiki_edits
+        self._listener.merged_edits += merged_edits
+        self._listener.catchup_edits += catchup_edits
+        self._listener.live_edits += live_edits
+        if event_lag_secs is not None:
+            self._listener.event_lag_secs = event_lag_secs
+        return None
+        # return self._maybe_describe(pipeline=pipeline) if describe else None
 
     async def update_database(
         self,
@@ -98,21 +149,22 @@ class _Metrics:
         chunk_collision: int = 0,
         articles_inserted: int = 0,
         articles_read: int = 0,
+        insert_requests: int = 0,
+        articles_expired: int = 0,
     ):
-        async with self._async_lock:
-            self._database.chunks_inserted += chunks_inserted
-            self._database.chunks_deleted += chunks_deleted
-            self._database.chunk_collision += chunk_collision
-            self._database.articles_inserted += articles_inserted
-            self._database.articles_read += articles_read
+        self._database.chunks_inserted += chunks_inserted
+        self._database.insert_requests += insert_requests
+        self._database.chunks_deleted += chunks_deleted
+        self._database.chunk_collision += chunk_collision
+        self._database.articles_inserted += articles_inserted
+        self._database.articles_read += articles_read
+        self._database.articles_expired += articles_expired
 
     async def get_rotation_stats(self) -> Tuple[int, int]:
-        async with self._async_lock:
-            return self._rotating_collections.rotations, self._database.chunks_inserted
+        return self._rotating_collections.rotations, self._database.chunks_inserted
 
     async def update_rotation_stats(self, rotations: int = 0):
-        async with self._async_lock:
-            self._rotating_collections.rotations += rotations
+        self._rotating_collections.rotations += rotations
 
     async def update_chunks(
         self,
@@ -121,25 +173,29 @@ class _Metrics:
         chunk_diff_deleted: int = 0,
         chunk_diff_unchanged: int = 0,
         chunks_vectorized: int = 0,
+        embedding_cache_hits: int = 0,
+        embedding_cache_misses: int = 0,
     ):
-        async with self._async_lock:
-            self._chunks.chunks_created += chunks_created
-            self._chunks.chunk_diff_new += chunk_diff_new
-            self._chunks.chunk_diff_deleted += chunk_diff_deleted
-            self._chunks.chunk_diff_unchanged += chunk_diff_unchanged
-            self._chunks.chunks_vectorized += chunks_vectorized
+        self._chunks.chunks_created += chunks_created
+        self._chunks.chunk_diff_new += chunk_diff_new
+        self._chunks.chunk_diff_deleted += chunk_diff_deleted
+        self._chunks.chunk_diff_unchanged += chunk_diff_unchanged
+        self._chunks.chunks_vectorized += chunks_vectorized
+        self._chunks.embedding_cache_hits += embedding_cache_hits
+        self._chunks.embedding_cache_misses += embedding_cache_misses
 
     async def update_article(
         self,
         redirects: int = 0,
         zero_vectors: int = 0,
+        not_modified: int = 0,
         recent_url: Optional[str] = None,
     ):
-        async with self._async_lock:
-            self._article.redirects += redirects
-            self._article.zero_vectors += zero_vectors
-            if recent_url:
-                self._article.recent_urls.append(recent_url)
+        self._article.redirects += redirects
+        self._article.zero_vectors += zero_vectors
+        self._article.not_modified += not_modified
+        if recent_url:
+            self._article.recent_urls.append(recent_url)
 
     async def listen_to_step_error(self, error: Exception):
         # see if we can track the error counts
@@ -170,15 +226,44 @@ class _Metrics:
             these_errors[name] = 1
 
         if these_errors:
-            async with self._async_lock:
-                for code, count in these_errors.items():
-                    self._error_by_code[code] = self._error_by_code.get(code, 0) + count
+            for code, count in these_errors.items():
+                self._error_by_code[code] = self._error_by_code.get(code, 0) + count
+
+    async def snapshot(self) -> "MetricsSnapshot":
+        """Copy of all the counters"""
+        return self._snapshot()
+
+    def _snapshot(self) -> "MetricsSnapshot":
+        # there are no awaits while copying, so no update can happen part way through
+        return MetricsSnapshot(
+            time_secs=time.time(),
+            listener=copy.deepcopy(self._listener),
+            database=copy.deepcopy(self._database),
+            chunks=copy.deepcopy(self._chunks),
+            rotating_collections=copy.deepcopy(self._rotating_collections),
+            article=copy.deepcopy(self._article),
+            error_by_code=dict(self._error_by_code),
+        )
 
     async def describe(self, pipeline: AsyncPipeline) -> str:
-        now = time.time()
+        now: MetricsSnapshot = self._snapshot()
+        self._article.recent_urls.clear()
+        previous: MetricsSnapshot = self._last_report or MetricsSnapshot(
+            time_secs=self._start_secs
+        )
+        self._last_report = now
+
+        processing_time: timedelta = timedelta(seconds=now.time_secs - self._start_secs)
+        interval_secs: float = max(now.time_secs - previous.time_secs, 0.001)
 
-        def _pprint(x):
-            return f"{x:>8} (total) {round(x / processing_time.total_seconds(), 2):>8} (op/s)"
+        def _pprint_count(x, before):
+            # the total, the rate over the whole run, and the rate since the last report
+            recent = (x - before) / interval_secs
+            return f"{x:>8} (total) {round(x / max(processing_time.total_seconds(), 0.001), 2):>8} (op/s) {round(recent, 2):>8} (op/s last interval)"
+
+        def _pprint(path):
+            get = attrgetter(path)
+            return _pprint_count(get(now), get(previous))
 
         def _pprint_urls(urls):
             if not urls:
@@ -191,46 +276,107 @@ class _Metrics:
             if not errors:
                 return "None"
             return "\n    ".join(
-                [f"{code:24}: {_pprint(count)}" for code, count in errors.items()]
+                [
+                    f"{code:24}: {_pprint_count(count, previous.error_by_code.get(code, 0))}"
+                    for code, count in errors.items()
+                ]
             )
 
-        async with self._async_lock:
-            processing_time: timedelta = timedelta(seconds=now - self._start_secs)
+        def _ppms(secs: Optional[float]) -> str:
+            if secs is None:
+                return "-"
+            ms = secs * 1000
+            return f"{ms:.2f}" if ms < 10 else f"{ms:.0f}"
+
+        def _pplatency(step: AsyncStep, wait: list[int], service: list[int]) -> str:
+            return (
+                f"{step.name + ':':24}{sum(service):>8} (items)"
+                f"  wait {'/'.join(_ppms(percentile(wait, p)) for p in PERCENTILES):>18}"
+                f"  service {'/'.join(_ppms(percentile(service, p)) for p in PERCENTILES):>18}"
+            )
 
-            desc = f"""
+        def _ppsteps_whole_run():
+            if not pipeline:
+                return "None"
+            return "\n    ".join(
+                _pplatency(
+                    step,
+                    step.wait_histogram.snapshot(),
+                    step.service_histogram.snapshot(),
+                )
+                for step in pipeline.steps
+            )
+
+        def _ppsteps_interval():
+            # percentiles of the items each step processed since the last report
+            if not pipeline:
+                return "None"
+            lines = []
+            for step in pipeline.steps:
+                previous_wait, previous_service = self._last_step_counts.get(
+                    step.name, (None, None)
+                )
+                lines.append(
+                    _pplatency(
+                        step,
+                        step.wait_histogram.since(previous_wait),
+                        step.service_histogram.since(previous_service),
+                    )
+                )
+                self._last_step_counts[step.name] = (
+                    step.wait_histogram.snapshot(),
+                    step.service_histogram.snapshot(),
+                )
+            return "\n    ".join(lines)
+
+        return f"""
 Processing:
     Total Time (h:mm:s):    {processing_time}
     Report interval (s):    {self.report_interval_secs}
 Wikipedia Listener:      
-    Total events:           {_pprint(self._listener.total_events)}
-    Canary events:          {_pprint(self._listener.canary_events)}
-    Bot events:             {_pprint(self._listener.bot_events)}
-    Skipped events:         {_pprint(self._listener.skipped_events)}
-    enwiki edits:           {_pprint(self._listener.enwiki_edits)}
+    Total events:           {_pprint("listener.total_events")}
+    Canary events:          {_pprint("listener.canary_events")}
+    Bot events:             {_pprint("listener.bot_events")}
+    Skipped events:         {_pprint("listener.skipped_events")}
+    Pre-filtered events:    {_pprint("listener.prefiltered_events")}
+    enwiki edits:           {_pprint("listener.enwiki_edits")}
+    Merged edits:           {_pprint("listener.merged_edits")}
+    Catch-up edits:         {_pprint("listener.catchup_edits")}
+    Live edits:             {_pprint("listener.live_edits")}
+    Event lag (s):          {round(now.listener.event_lag_secs, 1)}
 Chunks: 
-    Chunks created:         {_pprint(self._chunks.chunks_created)}
-    Chunk diff new:         {_pprint(self._chunks.chunk_diff_new)}
-    Chunk diff deleted:     {_pprint(self._chunks.chunk_diff_deleted)}
-    Chunk diff unchanged:   {_pprint(self._chunks.chunk_diff_unchanged)}
-    Chunks vectorized:      {_pprint(self._chunks.chunks_vectorized)}
+    Chunks created:         {_pprint("chunks.chunks_created")}
+    Chunk diff new:         {_pprint("chunks.chunk_diff_new")}
+    Chunk diff deleted:     {_pprint("chunks.chunk_diff_deleted")}
+    Chunk diff unchanged:   {_pprint("chunks.chunk_diff_unchanged")}
+    Chunks vectorized:      {_pprint("chunks.chunks_vectorized")}
+    Embedding cache hits:   {_pprint("chunks.embedding_cache_hits")}
+    Embedding cache misses: {_pprint("chunks.embedding_cache_misses")}
 Database:
-    Rotations:              {_pprint(self._rotating_collections.rotations)}
-    Chunks inserted:        {_pprint(self._database.chunks_inserted)}
-    Chunks deleted:         {_pprint(self._database.chunks_deleted)}
-    Chunk collisions:       {_pprint(self._database.chunk_collision)}
-    Articles read:          {_pprint(self._database.articles_read)}
-    Articles inserted:      {_pprint(self._database.articles_inserted)}
+    Rotations:              {_pprint("rotating_collections.rotations")}
+    Chunks inserted:        {_pprint("database.chunks_inserted")}
+    Insert requests:        {_pprint("database.insert_requests")}
+    Chunks deleted:         {_pprint("database.chunks_deleted")}
+    Chunk collisions:       {_pprint("database.chunk_collision")}
+    Articles read:          {_pprint("database.articles_read")}
+    Articles inserted:      {_pprint("database.articles_inserted")}
+    Articles expired:       {_pprint("database.articles_expired")}
 Pipeline:
-    {pipeline.queue_depths() if pipeline else ""}
+    Queue depths:           {pipeline.queue_depths() if pipeline else ""}
+    Queue high water:       {pipeline.queue_high_water_marks() if pipeline else ""}
+    Queue capacity:         {pipeline.queue_capacities() if pipeline else ""}
+Step latency (ms p50/p95/p99, whole run):
+    {_ppsteps_whole_run()}
+Step latency (ms p50/p95/p99, last interval):
+    {_ppsteps_interval()}
 Errors:
-    {_pperrors(self._error_by_code)}
+    {_pperrors(now.error_by_code)}
 Articles:
-    Skipped - redirect:     {_pprint(self._article.redirects)}  
-    Skipped - zero vector:  {_pprint(self._article.zero_vectors)}
-    Recent URLs:            {_pprint_urls(self._article.recent_urls)}  
+    Skipped - redirect:     {_pprint("article.redirects")}  
+    Skipped - zero vector:  {_pprint("article.zero_vectors")}
+    Skipped - not modified: {_pprint("article.not_modified")}
+    Recent URLs:            {_pprint_urls(now.article.recent_urls)}  
             """
-            self._article.recent_urls.clear()
-            return desc
 
     async def metrics_reporter_task(
         self, pipeline: AsyncPipeline, interval_seconds: int = 10
@@ -8,14 +8,29 @@ This is used by :mod:`wikichat.processing` to build a pipeline of commands defin
 import asyncio
 import contextvars
 import logging
+import time
+from dataclasses import dataclass
 from typing import Any, Awaitable, Callable, Optional, Union
 
+from wikichat.utils.histogram import LatencyHistogram
+
 # used by the pipeline and the log filter to get the worker name
 WORKER_NAME_CONTEXT_VAR = contextvars.ContextVar(
     "worker_name", default="unknown_worker"
 )
 
 
+@dataclass(eq=False)
+class _QueueItem:
+    """An item in a step source queue, compared by identity"""
+
+    item: Any
+    # the item put into the pipeline that this item was made from, passed to the done listener
+    origin: Any
+    # time.perf_counter() when the item was added to the queue
+    enqueued_secs: float
+
+
 class AsyncStep:
     """A step in the pipeline that will call the func for each object added to it's source queue"""
 
@@ -24,6 +39,7 @@ class AsyncStep:
         func: Callable[[Any], Any],
         num_tasks: int,
         listener: Optional[Callable[["AsyncStep", Any], Awaitable[bool]]] = None,
+        max_queue_size: int = 0,
     ):
         self.func: Callable[[Any], Any] = func
         self.name: str = self.func.__name__
@@ -31,8 +47,18 @@ class AsyncStep:
 
         self._listener = listener
         self._error_listener: Optional[Callable[[Exception], Awaitable[None]]] = None
+        # set by the pipeline, called when an item leaves the pipeline at this step
+        self._done_listener: Optional[Callable[[Any, bool], Awaitable[None]]] = None
 
-        self._source: asyncio.Queue = asyncio.Queue()
+        # A bounded source queue makes add_item() block when this step is saturated, so back pressure flows
+        # all the way up to put_to_first_step(). 0 means unbounded.
+        self.max_queue_size: int = max_queue_size
+        self._source: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        # the largest the source queue has been, used to size the queues and workers
+        self.queue_high_water: int = 0
+        # how long items wait in the source queue, and how long the func takes to process them
+        self.wait_histogram: LatencyHistogram = LatencyHistogram()
+        self.service_histogram: LatencyHistogram = LatencyHistogram()
         self._next_step: Union["AsyncStep", None] = None
 
         # see start_tasks
@@ -53,13 +79,24 @@ class AsyncStep:
             for i in range(self.num_tasks)
         ]
 
-    async def add_item(self, item: Any) -> bool:
-        await self._source.put(item)
+    async def add_item(self, item: Any, origin: Any = None) -> bool:
+        # blocks while the queue is full
+        await self._source.put(
+            _QueueItem(
+                item=item,
+                origin=item if origin is None else origin,
+                enqueued_secs=time.perf_counter(),
+            )
+        )
+        self.queue_high_water = max(self.queue_high_water, self._source.qsize())
         return True
 
     async def _worker(self, worker_name: str):
         while True:
-            item = await self._source.get()
+            queue_item: _QueueItem = await self._source.get()
+            item = queue_item.item
+            started_secs: float = time.perf_counter()
+            self.wait_histogram.record(started_secs - queue_item.enqueued_secs)
             # We call the listener here before passing to the worker.
             # The listener can decide to not pass the item to the worker, or if somethign should be done
             # before the worker starts. The listener can use a lock to step all other workers starting until it is done.
@@ -72,30 +109,138 @@ class AsyncStep:
                 else:
                     process_item = await self._listener(self, item)
                 if not process_item:
+                    await self._item_done(queue_item.origin, True)
                     continue
                 result = await self.func(item)
+                self.service_histogram.record(time.perf_counter() - started_secs)
 
                 if result is not None and self._next_step:
                     # there is no dest when this is the last step
-                    await self._next_step.add_item(result)
+                    await self._next_step.add_item(result, queue_item.origin)
+                else:
+                    await self._item_done(queue_item.origin, True)
             except Exception as e:
-                logging.exception(
-                    f"Error in worker, item will be dropped - {e}", exc_info=True
-                )
-                # Second log is to get the details into the debug so we can fix, first is to get it into
-                # heroku or other log aggregators
-                logging.debug(f"Error in worker {worker_name}", exc_info=True)
-                if self._error_listener:
-                    try:
-                        await self._error_listener(e)
-                    except Exception as e2:
-                        logging.exception(
-                            f"Error in error listener - {e2}", exc_info=False
+                await self._handle_error(worker_name, e)
+                await self._item_done(queue_item.origin, False)
+            finally:
+                WORKER_NAME_CONTEXT_VAR.reset(context_token)
+                # task_done() is in the finally so a continue does not leave the queue unfinished
+                self._source.task_done()
+
+    async def _handle_error(self, worker_name: str, e: Exception):
+        logging.exception(f"Error in worker, item will be dropped - {e}", exc_info=True)
+        # Second log is to get the details into the debug so we can fix, first is to get it into
+        # heroku or other log aggregators
+        logging.debug(f"Error in worker {worker_name}", exc_info=True)
+        if self._error_listener:
+            try:
+                await self._error_listener(e)
+            except Exception as e2:
+                logging.exception(f"Error in error listener - {e2}", exc_info=False)
+
+    async def _item_done(self, origin: Any, succeeded: bool):
+        """The item made from the origin has left the pipeline, succeeded is False if that was due to an error"""
+        if self._done_listener:
+            try:
+                await self._done_listener(origin, succeeded)
+            except Exception as e:
+                logging.exception(f"Error in done listener - {e}", exc_info=False)
+
+
+class AsyncBatchStep(AsyncStep):
+    """A step that calls the func with a batch of items taken from it's source queue.
+
+    A worker waits for the first item, then keeps taking items until the batch reaches max_batch_size or
+    max_wait_ms has passed since the first item. The size of an item is 1 unless an item_size func is given,
+    e.g. to batch on the number of chunks in the articles rather than the number of articles.
+
+    The func must return a list with a result for each item in the batch, in the same order. Results that are
+    None are not passed to the next step.
+    """
+
+    def __init__(
+        self,
+        func: Callable[[list[Any]], Awaitable[list[Any]]],
+        num_tasks: int,
+        max_batch_size: int,
+        max_wait_ms: int,
+        item_size: Optional[Callable[[Any], int]] = None,
+        listener: Optional[Callable[["AsyncStep", Any], Awaitable[bool]]] = None,
+        max_queue_size: int = 0,
+    ):
+        super().__init__(
+            func, num_tasks, listener=listener, max_queue_size=max_queue_size
+        )
+        self.max_batch_size: int = max_batch_size
+        self.max_wait_ms: int = max_wait_ms
+        self._item_size: Callable[[Any], int] = item_size or (lambda item: 1)
+
+    async def _next_batch(self) -> list[_QueueItem]:
+        batch: list[_QueueItem] = [await self._source.get()]
+        batch_size: int = self._item_size(batch[0].item)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while batch_size < self.max_batch_size:
+            if self._source.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    # the item stays in the queue if the get is cancelled by the timeout
+                    item = await asyncio.wait_for(self._source.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self._source.get_nowait()
+            batch.append(item)
+            batch_size += self._item_size(item.item)
+        return batch
+
+    async def _worker(self, worker_name: str):
+        while True:
+            taken: list[_QueueItem] = await self._next_batch()
+            started_secs: float = time.perf_counter()
+            for queue_item in taken:
+                self.wait_histogram.record(started_secs - queue_item.enqueued_secs)
+            # the items that have not left this step yet, they are done with an error if the step fails
+            pending: list[_QueueItem] = list(taken)
+            context_token = WORKER_NAME_CONTEXT_VAR.set(worker_name)
+            try:
+                batch: list[_QueueItem] = taken
+                if self._listener is not None:
+                    batch = []
+                    for queue_item in taken:
+                        if await self._listener(self, queue_item.item):
+                            batch.append(queue_item)
+                        else:
+                            pending.remove(queue_item)
+                            await self._item_done(queue_item.origin, True)
+                if batch:
+                    results = await self.func([queue_item.item for queue_item in batch])
+                    # every item in the batch waits for the whole batch
+                    service_secs: float = time.perf_counter() - started_secs
+                    for _ in batch:
+                        self.service_histogram.record(service_secs)
+                    if len(results) != len(batch):
+                        raise ValueError(
+                            f"Batch step {self.name} returned {len(results)} results for {len(batch)} items"
                         )
+                    for queue_item, result in zip(batch, results):
+                        pending.remove(queue_item)
+                        if result is not None and self._next_step:
+                            await self._next_step.add_item(result, queue_item.origin)
+                        else:
+                            await self._item_done(queue_item.origin, True)
+            except Exception as e:
+                await self._handle_error(worker_name, e)
+                for queue_item in pending:
+                    await self._item_done(queue_item.origin, False)
             finally:
                 WORKER_NAME_CONTEXT_VAR.reset(context_token)
 
-            self._source.task_done()
+            for _ in taken:
+                self._source.task_done()
 
 
 class AsyncPipeline:
@@ -110,12 +255,30 @@ class AsyncPipeline:
         self._put_count: int = 0
         self.max_items: int = max_items
         self._error_listener = error_listener
+        # see add_done_listener()
+        self._done_listeners: list[Callable[[Any, bool], Awaitable[None]]] = []
         self._async_lock = asyncio.Lock()
 
+    def add_done_listener(
+        self, listener: Callable[[Any, bool], Awaitable[None]]
+    ) -> None:
+        """Add a listener called with each item put into the pipeline when it leaves the pipeline.
+
+        The item leaves when the last step has finished with it, when a step returns None for it, or when a step
+        raises an error for it. The listener is called with the item that was put to the first step and True,
+        or False if it left because of an error. The listeners are called in the order they were added.
+        """
+        self._done_listeners.append(listener)
+
+    async def _item_done(self, origin: Any, succeeded: bool) -> None:
+        for listener in self._done_listeners:
+            await listener(origin, succeeded)
+
     def add_step(self, step: AsyncStep) -> "AsyncPipeline":
         if self.steps:
             self.steps[-1]._next_step = step
         step._error_listener = self._error_listener
+        step._done_listener = self._item_done
         self.steps.append(step)
         # start now because we may have changed the source queue
         step.start_tasks()
@@ -139,6 +302,12 @@ class AsyncPipeline:
     def queue_depths(self) -> dict[str, int]:
         return {step.name: step._source.qsize() for step in self.steps}
 
+    def queue_high_water_marks(self) -> dict[str, int]:
+        return {step.name: step.queue_high_water for step in self.steps}
+
+    def queue_capacities(self) -> dict[str, int]:
+        return {step.name: step.max_queue_size for step in self.steps}
+
     async def join_all_steps(self):
         logging.info("Waiting for all step source queues to be empty")
         for step in self.steps:
@@ -0,0 +1,153 @@
+"""
+Serves the pipeline metrics in the Prometheus text format, so they can be scraped and alerted on.
+
+Started by the pipeline commands when ``--metrics_port`` is set, the metrics are at ``http://<host>:<port>/metrics``.
+Each request takes a snapshot of :data:`~wikichat.utils.metrics.METRICS` and formats it, see
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import logging
+from dataclasses import fields
+from typing import Optional
+
+from aiohttp import web
+
+from wikichat.utils.histogram import BUCKET_BOUNDS, LatencyHistogram
+from wikichat.utils.metrics import METRICS, MetricsSnapshot
+from wikichat.utils.pipeline import AsyncPipeline
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# the sections of the snapshot exported as counters, and the fields that are not counters
+_COUNTER_SECTIONS = (
+    "listener",
+    "database",
+    "chunks",
+    "rotating_collections",
+    "article",
+)
+_GAUGE_FIELDS = {"event_lag_secs"}
+_SKIP_FIELDS = {"recent_urls"}
+
+
+def render(snapshot: MetricsSnapshot, pipeline: Optional[AsyncPipeline]) -> str:
+    """Format the snapshot and the pipeline queues and latencies as Prometheus text"""
+    lines: list[str] = []
+
+    def _metric(name: str, metric_type: str, help_text: str) -> None:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+    for section in _COUNTER_SECTIONS:
+        section_metrics = getattr(snapshot, section)
+        for metric_field in fields(section_metrics):
+            if metric_field.name in _SKIP_FIELDS:
+                continue
+            value = getattr(section_metrics, metric_field.name)
+            if metric_field.name in _GAUGE_FIELDS:
+                name = f"wikichat_{section}_{metric_field.name}"
+                _metric(name, "gauge", f"{section} {metric_field.name}")
+            else:
+                name = f"wikichat_{section}_{metric_field.name}_total"
+                _metric(name, "counter", f"{section} {metric_field.name}")
+            lines.append(f"{name} {value}")
+
+    _metric("wikichat_errors_total", "counter", "Errors by API error code or type")
+    for code, count in snapshot.error_by_code.items():
+        lines.append(f'wikichat_errors_total{{code="{_escape(code)}"}} {count}')
+
+    if pipeline is not None:
+        for name, help_text, values in (
+            (
+                "wikichat_queue_depth",
+                "Items waiting in the step queue",
+                pipeline.queue_depths(),
+            ),
+            (
+                "wikichat_queue_high_water",
+                "Largest the step queue has been",
+                pipeline.queue_high_water_marks(),
+            ),
+            (
+                "wikichat_queue_capacity",
+                "Size of the step queue, 0 is unbounded",
+                pipeline.queue_capacities(),
+            ),
+        ):
+            _metric(name, "gauge", help_text)
+            for step_name, value in values.items():
+                lines.append(f'{name}{{step="{step_name}"}} {value}')
+
+        for name, help_text, attr in (
+            (
+                "wikichat_step_wait_seconds",
+                "Time items waited in the step queue",
+                "wait_histogram",
+            ),
+            (
+                "wikichat_step_service_seconds",
+                "Time the step took to process items",
+                "service_histogram",
+            ),
+        ):
+            _metric(name, "histogram", help_text)
+            for step in pipeline.steps:
+                _histogram_lines(lines, name, step.name, getattr(step, attr))
+
+    lines.append("")
+    return "\n".join(lines)
+
+
+def _histogram_lines(
+    lines: list[str], name: str, step_name: str, histogram: LatencyHistogram
+) -> None:
+    # prometheus buckets are cumulative, the last bucket is everything
+    cumulative = 0
+    counts = histogram.snapshot()
+    for bound, count in zip(BUCKET_BOUNDS, counts):
+        cumulative += count
+        lines.append(
+            f'{name}_bucket{{step="{step_name}",le="{bound:.6g}"}} {cumulative}'
+        )
+    lines.append(f'{name}_bucket{{step="{step_name}",le="+Inf"}} {sum(counts)}')
+    lines.append(f'{name}_sum{{step="{step_name}"}} {histogram.sum_secs}')
+    lines.append(f'{name}_count{{step="{step_name}"}} {sum(counts)}')
+
+
+def _escape(label_value: str) -> str:
+    return label_value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+_RUNNER: Optional[web.AppRunner] = None
+
+
+async def start_server(
+    pipeline: AsyncPipeline, port: int, host: str = "127.0.0.1"
+) -> None:
+    """Serve the metrics on the port, call stop_server() when finished"""
+    global _RUNNER
+    if _RUNNER is not None:
+        raise Exception("Metrics server already started")
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        snapshot = await METRICS.snapshot()
+        return web.Response(
+            body=render(snapshot, pipeline).encode("utf-8"),
+            headers={"Content-Type": CONTENT_TYPE},
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    _RUNNER = runner
+    logging.info(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+
+
+async def stop_server() -> None:
+    global _RUNNER
+    if _RUNNER is None:
+        return
+    runner, _RUNNER = _RUNNER, None
+    await runner.cleanup()
@@ -0,0 +1,127 @@
+"""
+Splits article text into chunks, and hashes the chunks.
+
+:class:`RecursiveTextSplitter` produces exactly the same chunks as LangChain's ``RecursiveCharacterTextSplitter``
+with the default separators, ``keep_separator=True``, ``strip_whitespace=True`` and ``length_function=len``,
+which is how we used it before. It avoids the regex splitting and the list copying LangChain does when merging
+splits, which is where it spends most of its time on long articles.
+
+:func:`chunk_and_hash` is CPU bound, :mod:`wikichat.processing.articles` runs it in the pool from
+:mod:`wikichat.utils.cpu`. Like :mod:`wikichat.utils.html_parsing` it does not import the rest of the
+application. ``tests/test_text_splitter.py`` checks the chunks and their hashes are the same as LangChain's.
+"""
+
+import hashlib
+from typing import Optional
+
+DEFAULT_SEPARATORS = ["\n\n", "\n", " ", ""]
+
+# The chunk sizes used for the articles
+CHUNK_SIZE = 1024
+CHUNK_OVERLAP = 200
+
+
+class RecursiveTextSplitter:
+    """Split text on the first separator found in it, recursively splitting pieces that are still too big,
+    then merge the pieces into chunks of up to chunk_size characters that overlap by up to chunk_overlap.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = CHUNK_SIZE,
+        chunk_overlap: int = CHUNK_OVERLAP,
+        separators: Optional[list[str]] = None,
+    ):
+        if chunk_overlap > chunk_size:
+            raise ValueError(
+                f"Got a larger chunk overlap ({chunk_overlap}) than chunk size ({chunk_size}), should be smaller."
+            )
+        self.chunk_size: int = chunk_size
+        self.chunk_overlap: int = chunk_overlap
+        self.separators: list[str] = separators or DEFAULT_SEPARATORS
+
+    def split_text(self, text: str) -> list[str]:
+        return self._split_text(text, self.separators)
+
+    def _split_text(self, text: str, separators: list[str]) -> list[str]:
+        final_chunks: list[str] = []
+
+        # use the first separator that is in the text, the empty separator splits into characters
+        separator = separators[-1]
+        new_separators: list[str] = []
+        for i, sep in enumerate(separators):
+            if sep == "":
+                separator = sep
+                break
+            if sep in text:
+                separator = sep
+                new_separators = separators[i + 1 :]
+                break
+
+        good_splits: list[str] = []
+        for split in _split_keep_separator(text, separator):
+            if len(split) < self.chunk_size:
+                good_splits.append(split)
+                continue
+            if good_splits:
+                final_chunks.extend(self._merge_splits(good_splits))
+                good_splits = []
+            if not new_separators:
+                final_chunks.append(split)
+            else:
+                final_chunks.extend(self._split_text(split, new_separators))
+        if good_splits:
+            final_chunks.extend(self._merge_splits(good_splits))
+        return final_chunks
+
+    def _merge_splits(self, splits: list[str]) -> list[str]:
+        # The separator is kept at the start of each split, so they are joined with an empty separator.
+        # The current doc is splits[start:end], moving start rather than copying the list when we drop
+        # splits from the front of the doc to make the overlap.
+        chunk_size = self.chunk_size
+        chunk_overlap = self.chunk_overlap
+
+        docs: list[str] = []
+        start = 0
+        total = 0
+        for end, split in enumerate(splits):
+            split_len = len(split)
+            if total + split_len > chunk_size:
+                if end > start:
+                    doc = "".join(splits[start:end]).strip()
+                    if doc:
+                        docs.append(doc)
+                    while total > chunk_overlap or (
+                        total + split_len > chunk_size and total > 0
+                    ):
+                        total -= len(splits[start])
+                        start += 1
+            total += split_len
+
+        doc = "".join(splits[start:]).strip()
+        if doc:
+            docs.append(doc)
+        return docs
+
+
+def _split_keep_separator(text: str, separator: str) -> list[str]:
+    """Split the text keeping the separator at the start of each split, dropping empty splits"""
+    if not separator:
+        return list(text)
+    parts = text.split(separator)
+    splits = [parts[0]] + [separator + part for part in parts[1:]]
+    return [split for split in splits if split != ""]
+
+
+def chunk_and_hash(
+    texts: list[str], chunk_size: int, chunk_overlap: int
+) -> list[list[tuple[str, str]]]:
+    """Split each text into chunks, returning a list of (chunk, sha256 hex digest of the chunk) for each text"""
+    splitter = RecursiveTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [
+        [
+            (chunk, hashlib.sha256(chunk.encode("utf-8")).hexdigest())
+            for chunk in splitter.split_text(text)
+        ]
+        for text in texts
+    ]